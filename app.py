@@ -1,16 +1,128 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import argparse
 from food_service import FoodService
 
 # Application entrypoint:
-if __name__ == '__main__':
-    app = FoodService(url_conf=os.path.abspath('./config/location.ini'),
-                      db_conf=os.path.abspath('./config/db.ini'))
+#   app.py                  crawl every page on its own refresh schedule.
+#   app.py crawl --once     crawl every page once and exit (for cron jobs and one-off containers).
+#   app.py plan             print the urls a crawl would fetch, without touching the database.
+#   app.py migrate          create the database tables and indexes, then exit.
+#   app.py export FILE      stream stored menus to gzip-compressed JSON Lines or SQLite.
+#   app.py enqueue          add the next 15 days of pages to the shared work queue.
+#   app.py worker           crawl pages from the shared work queue (run as many as needed).
+
+
+def parse_args(argv: list) -> argparse.Namespace:
+    """Parses the command line. Without a command the crawler runs on its schedule, like it always
+    has.
+
+    :param argv: command line arguments, without the program name.
+    :return: parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description='Crawls and stores UCR dining hall menus.')
+    parser.add_argument('--config-dir', default='./config',
+                        help='directory holding location.ini, db.ini and crawl.ini.')
+    commands = parser.add_subparsers(dest='command')
+
+    crawl = commands.add_parser('crawl', aliases=['schedule'], help='crawl menus.')
+    crawl.add_argument('--once', action='store_true',
+                       help='crawl every page once and exit; the exit status is 1 if any page '
+                            'could not be downloaded.')
+    crawl.add_argument('--interval', type=int, default=24,
+                       help='longest time in hours between refreshes of a page (default 24).')
+    crawl.add_argument('--profile', action='store_true',
+                       help='profile every run and write the reports to the [PROFILE] Dir.')
+
+    commands.add_parser('plan', help='print the day and url of every page a crawl would fetch.')
+    commands.add_parser('migrate', help='create the database tables and indexes.')
+    export = commands.add_parser('export', help='export stored menus for analytics.')
+    export.add_argument('output', help='file to write, e.g. menus.jsonl.gz or menus.sqlite3.')
+    export.add_argument('--format', choices=['jsonl', 'sqlite'], default='jsonl',
+                        help='gzip-compressed JSON Lines (default) or a SQLite snapshot.')
+    export.add_argument('--start', help='ISO 8601 date of the first menu to export.')
+    export.add_argument('--end', help='ISO 8601 date of the last menu to export.')
+    export.add_argument('--items', action='store_true',
+                        help='export one row per menu item instead of (or, for SQLite, next to) '
+                             'whole menus.')
+    export.add_argument('--state',
+                        help='file keeping the watermark of the last export; only menus written '
+                             'since then are exported.')
+
+    commands.add_parser('enqueue', help='add the next 15 days of pages to the work queue.')
+    worker = commands.add_parser('worker', help='crawl pages from the work queue.')
+    worker.add_argument('--profile', action='store_true',
+                        help='profile every run and write the reports to the [PROFILE] Dir.')
+
+    args = parser.parse_args(argv)
+
+    if args.command in (None, 'schedule'):
+        args.command = 'crawl'
+        args.once = getattr(args, 'once', False)
+        args.interval = getattr(args, 'interval', 24)
+        args.profile = getattr(args, 'profile', False)
+
+    return args
+
+
+def main(argv: list) -> int:
+    """Runs the command given on the command line.
+
+    :param argv: command line arguments, without the program name.
+    :return: exit status.
+    """
+    args = parse_args(argv)
+    config_dir = os.path.abspath(args.config_dir)
+
+    app = FoodService(url_conf=os.path.join(config_dir, 'location.ini'),
+                      db_conf=os.path.join(config_dir, 'db.ini'),
+                      crawl_conf=os.path.join(config_dir, 'crawl.ini'))
+
+    if getattr(args, 'profile', False):
+        app.profile_every = 1
 
     try:
-        # Run every 24 hours.
-        app.run_schedule(interval=24)
-    except KeyboardInterrupt or SystemExit:
+        if args.command == 'plan':
+            for url, day in app.plan():
+                print('{0}\t{1}'.format(day, url))
+
+            return 0
+
+        # Make sure the tables and indexes exist first.
+        app.migrate()
+
+        if args.command == 'migrate':
+            print('Database is up to date.')
+        elif args.command == 'export':
+            result = app.export(args.output, args.format, args.start, args.end, args.items,
+                                args.state)
+            print('Exported {0} menus ({1} item rows) to {2}.'.format(
+                result.get('menus'), result.get('rows'), result.get('path')))
+        elif args.command == 'enqueue':
+            print('Queued {0} urls.'.format(app.enqueue()))
+        elif args.command == 'worker':
+            app.work()
+        elif args.command == 'crawl' and args.once:
+            written = app.run()
+            print('Wrote {0} menus; {1} urls failed, {2} left for the next run.'.format(
+                len(written), len(app.failed_urls), len(app.unfinished_urls)))
+
+            if app.last_summary.get('profile'):
+                print('Profile: {0}'.format(app.last_summary.get('profile')))
+
+            return 1 if app.failed_urls else 0
+        elif args.command == 'crawl':
+            app.run_schedule(interval=args.interval)
+
+        return 0
+    except (KeyboardInterrupt, SystemExit):
         print("\nStopping...")
+        return 0
+    finally:
         app.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
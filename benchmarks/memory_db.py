@@ -0,0 +1,180 @@
+import json
+from datetime import datetime, timedelta
+from threading import Lock
+from ucrfood.storage import Database, rows_written_total
+
+
+class MemoryDatabase(Database):
+    """
+    Description: in-memory stand-in for ucrfood.Database, so the pipeline can be benchmarked
+    without a RethinkDB server. Writes go through the same catalog encoding, menu diffs and history
+    as the real backends (see Database._deltas); only the storage is a dict. Menus are stored as
+    JSON strings to account for the cost of encoding them for the wire. The work queue and the
+    changefeed are not implemented.
+    """
+    name = 'memory'
+
+    def __init__(self, port: int = None, uname: str = None, db_pass: str = None, host: str = None):
+        super().__init__()
+
+        self.menus = {}
+        self.versions = {}
+        self.history = []
+        self.postings = {}
+        self.catalog_rows = {}
+        self.migrations = set()
+        self.round_trips = 0
+        self.__version = 0
+        self.__lock = Lock()
+
+    @classmethod
+    def from_config(cls, db_conf):
+        return cls()
+
+    def migrate(self):
+        self._migrate_data()
+
+    def _finished_migrations(self) -> set:
+        return set(self.migrations)
+
+    def _finish_migration(self, name: str):
+        self.migrations.add(name)
+
+    def _catalog_ids(self, texts: set) -> list:
+        with self.__lock:
+            self.round_trips += 1
+
+            for text in sorted(texts):
+                self.catalog_rows.setdefault(text, len(self.catalog_rows) + 1)
+
+            return [{'id': self.catalog_rows[t], 'text': t} for t in texts]
+
+    def _catalog_texts(self, ids: set) -> list:
+        with self.__lock:
+            self.round_trips += 1
+            return [{'id': i, 'text': t} for t, i in self.catalog_rows.items() if i in ids]
+
+    def __put(self, menu: dict):
+        """Stores an encoded menu, stamping it with the next version. Call with the lock held.
+        """
+        self.__version += 1
+        self.menus[menu.get('id')] = json.dumps(menu)
+        self.versions[menu.get('id')] = self.__version
+
+    def upsert_menus(self, menus: list, chunk_size: int = 200) -> int:
+        written = 0
+
+        for i in range(0, len(menus), chunk_size):
+            chunk = menus[i:i + chunk_size]
+            keys = [self._with_key(m).get('id') for m in chunk]
+
+            with self.__lock:
+                self.round_trips += 1
+                stored = {k: json.loads(self.menus[k]) for k in keys if k in self.menus}
+
+            inserts, updates, history = self._deltas(chunk, stored)
+
+            with self.__lock:
+                self.round_trips += 1
+
+                for menu in inserts:
+                    self.__put(menu)
+
+                for doc, fields, patches in updates:
+                    if not fields and not patches:
+                        continue
+
+                    menu = dict(stored.get(doc.get('id')), **fields)
+                    menu['menus'] = list(menu.get('menus'))
+
+                    for index, meal in patches:
+                        menu['menus'][index] = meal
+
+                    self.__put(menu)
+
+                self.history.extend(history)
+
+            written += len(inserts) + len(updates)
+
+        rows_written_total.inc(written)
+
+        return written
+
+    def update_menu_on_date(self, date: str, menu: dict):
+        menu = dict(self._encode([menu])[0], id=self.menu_key(menu.get('location').get('num'),
+                                                               date))
+        menu['time_info'] = dict(menu.get('time_info'), menu_date=date)
+
+        with self.__lock:
+            self.round_trips += 1
+            self.__put(menu)
+
+    def get_menu_history(self, location_num: str, start_date: str, end_date: str) -> list:
+        with self.__lock:
+            self.round_trips += 1
+            found = [h for h in self.history if h.get('location') == location_num
+                     and start_date <= h.get('menu_date') <= end_date]
+
+        return sorted(found, key=lambda h: h.get('menu_date'))
+
+    def replace_item_postings(self, menu_ids: list, postings: list, chunk_size: int = 1000):
+        with self.__lock:
+            self.round_trips += 1 + (len(postings) + chunk_size - 1) // chunk_size
+            ids = set(menu_ids)
+            self.postings = {k: p for k, p in self.postings.items() if p.get('menu_id') not in ids}
+            self.postings.update((p.get('id'), p) for p in postings)
+
+    def find_item_postings(self, token: str, prefix: bool = False, start_date: str = None,
+                           end_date: str = None) -> list:
+        with self.__lock:
+            self.round_trips += 1
+            return [p for p in self.postings.values()
+                    if (p.get('token').startswith(token) if prefix else p.get('token') == token)
+                    and (not start_date or p.get('menu_date') >= start_date)
+                    and (not end_date or p.get('menu_date') <= end_date)]
+
+    def __stored(self) -> list:
+        """Returns every stored menu (still encoded) with its version, in (date, id) order.
+        """
+        with self.__lock:
+            self.round_trips += 1
+            menus = [(json.loads(m), self.versions.get(k)) for k, m in self.menus.items()]
+
+        return sorted(menus, key=lambda m: (m[0].get('time_info').get('menu_date'),
+                                            m[0].get('id')))
+
+    def get_page_info_within_range(self, day_delta: int) -> list:
+        start_date = datetime.now().date().isoformat()
+        end_date = (datetime.now().date() + timedelta(days=day_delta)).isoformat()
+
+        return [{'sum': m.get('sum'), 'url': m.get('url')} for m, _ in self.__stored()
+                if start_date <= m.get('time_info').get('menu_date') < end_date]
+
+    def get_menu(self, location_num: str, menu_date: str) -> dict:
+        with self.__lock:
+            self.round_trips += 1
+            menu = self.menus.get(self.menu_key(location_num, menu_date))
+
+        return self._decode([json.loads(menu)])[0] if menu else None
+
+    def get_menus(self, location_num: str, start_date: str, end_date: str) -> list:
+        return self._decode([m for m, _ in self.__stored()
+                             if m.get('location').get('num') == location_num
+                             and start_date <= m.get('time_info').get('menu_date') <= end_date])
+
+    def export_watermark(self) -> int:
+        with self.__lock:
+            return self.__version
+
+    def stream_menus(self, start_date: str = None, end_date: str = None, since: int = None,
+                     until: int = None, batch_size: int = 500):
+        last = end_date or '\uffff'
+        menus = [m for m, v in self.__stored()
+                 if (start_date or '') <= m.get('time_info').get('menu_date') <= last
+                 and v > (since or 0) and (until is None or v <= until)]
+
+        for i in range(0, len(menus), batch_size):
+            yield from self._decode(menus[i:i + batch_size])
+
+    def disconnect(self):
+        pass
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""Offline benchmark for the crawl pipeline.
+
+Serves the recorded pages in benchmarks/fixtures from a local HTTP server, swaps ucrfood.Database
+for an in-memory stand-in (or uses the embedded SQLite backend) and times FoodService.run at several
+multiples of the location count.
+Every scale runs in its own process so peak RSS and process counts don't leak between them.
+
+Usage:
+    python -m benchmarks.run --scale 1 10 100 --latency 0.02 [--storage sqlite]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import multiprocessing
+from functools import wraps
+from tempfile import TemporaryDirectory
+from threading import Thread, Event, Lock, active_count
+
+# Make the application importable when run from the repository root.
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import ucrfood  # noqa: E402
+from ucrfood.food_sort import FoodSort  # noqa: E402
+from ucrfood.http_client import HttpClient  # noqa: E402
+from ucrfood.sqlite_db import SQLiteDatabase  # noqa: E402
+from ucrfood.parsers import parsers, SoupParser, LxmlParser  # noqa: E402
+from benchmarks.server import FixtureServer  # noqa: E402
+from benchmarks.memory_db import MemoryDatabase  # noqa: E402
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class StageTimer:
+    """
+    Description: collects latencies for each pipeline stage from any thread.
+    """
+    def __init__(self):
+        self.samples = {}
+        self.__lock = Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self.__lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage: str, func):
+        """Returns func, timed under the given stage.
+        """
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+
+        return timed
+
+    def summary(self) -> dict:
+        """Returns count, total, mean, p50 and p95 in milliseconds for every stage.
+        """
+        result = {}
+
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            result[stage] = {'count': len(samples),
+                             'total_ms': sum(samples) * 1000,
+                             'mean_ms': sum(samples) / len(samples) * 1000,
+                             'p50_ms': samples[len(samples) // 2] * 1000,
+                             'p95_ms': samples[int(len(samples) * 0.95)] * 1000}
+
+        return result
+
+
+class ResourceSampler(Thread):
+    """
+    Description: records the largest number of live child processes and threads during a run.
+    """
+    def __init__(self, interval: float = 0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.max_processes = 1
+        self.max_threads = 1
+        self.__stop = Event()
+
+    def run(self):
+        while not self.__stop.is_set():
+            self.max_processes = max(self.max_processes,
+                                     len(multiprocessing.active_children()) + 1)
+            self.max_threads = max(self.max_threads, active_count())
+            self.__stop.wait(self.interval)
+
+    def stop(self):
+        self.__stop.set()
+        self.join()
+
+
+def instrument(timer: StageTimer, storage: str):
+    """Times the fetch, checksum, parse and write stages. Parsing is only timed when it happens
+    in the fetching threads (i.e. --parse-workers 0).
+    """
+    HttpClient.get = timer.wrap('fetch', HttpClient.get)
+
+    get_page_sum = FoodSort.__dict__['_FoodSort__get_page_sum'].__func__
+    FoodSort._FoodSort__get_page_sum = staticmethod(timer.wrap('checksum', get_page_sum))
+
+    for backend in parsers.values():
+        backend.parse = timer.wrap('parse', backend.parse)
+
+    if storage == 'sqlite':
+        SQLiteDatabase.upsert_menus = timer.wrap('write', SQLiteDatabase.upsert_menus)
+        return
+
+    MemoryDatabase.upsert_menus = timer.wrap('write', MemoryDatabase.upsert_menus)
+
+    # FoodService looks the database class up on the package at connection time.
+    ucrfood.Database = MemoryDatabase
+
+
+def write_configs(config_dir: str, base_url: str, locations: int, args) -> dict:
+    """Writes the ini files FoodService needs for the given number of locations.
+    """
+    paths = {name: os.path.join(config_dir, name + '.ini') for name in ('location', 'db', 'crawl')}
+
+    with open(paths['location'], 'w') as f:
+        f.write('[MAIN]\nBaseURL = {0}\n'.format(base_url))
+
+        for i in range(locations):
+            f.write('\n[LOCATION{0}]\nLocationNum = {0:02d}\nLocationName = Hall{0}\n'.format(i))
+
+    with open(paths['db'], 'w') as f:
+        if args.storage == 'sqlite':
+            f.write('[STORAGE]\nBackend = sqlite\nPath = {0}\n\n'.format(
+                os.path.join(config_dir, 'ucrfood.sqlite3')))
+
+        f.write('[DB_INFO]\nDBUsername = bench\n\n[CONNECTION]\nHost = 127.0.0.1\nPort = 0\n\n'
+                '[AUTH]\nDBPassword =\n')
+
+    with open(paths['crawl'], 'w') as f:
+        f.write('[POOL]\nFetchWorkers = {0}\nParseWorkers = {1}\n\n[PARSER]\nBackend = {2}\n\n'
+                '[WRITE]\nBatchSize = {3}\n'.format(args.fetch_workers, args.parse_workers,
+                                                     args.parser, args.batch_size))
+
+    return paths
+
+
+def run_single(scale: int, args) -> dict:
+    """Benchmarks a cold run (nothing stored) and a warm run (nothing changed) at one scale.
+    """
+    from food_service import FoodService
+
+    timer = StageTimer()
+    instrument(timer, args.storage)
+
+    server = FixtureServer(FIXTURE_DIR, latency=args.latency)
+    server.start()
+
+    result = {'scale': scale, 'locations': args.locations * scale}
+
+    with TemporaryDirectory() as config_dir:
+        paths = write_configs(config_dir, server.base_url, result['locations'], args)
+
+        service = FoodService(db_conf=paths['db'], url_conf=paths['location'],
+                              crawl_conf=paths['crawl'])
+        service.migrate()
+
+        sampler = ResourceSampler()
+        sampler.start()
+
+        for run_name in ('cold', 'warm'):
+            timer.samples.clear()
+            served = server.requests_served
+
+            start = time.perf_counter()
+            written = service.run()
+            elapsed = time.perf_counter() - start
+
+            pages = server.requests_served - served
+            result[run_name] = {'seconds': elapsed,
+                                'pages': pages,
+                                'pages_per_sec': pages / elapsed if elapsed else 0,
+                                'menus_written': len(written),
+                                'stages': timer.summary()}
+
+        sampler.stop()
+        service.stop()
+
+    server.stop()
+
+    usage_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    result['peak_rss_mb'] = max(usage_self, usage_children) / 1024
+    result['max_processes'] = sampler.max_processes
+    result['max_threads'] = sampler.max_threads
+
+    return result
+
+
+def check_parsers(repeat: int = 20) -> dict:
+    """Checks that every parser backend produces identical menus for every fixture and times them.
+    """
+    pages = [open(os.path.join(FIXTURE_DIR, f), 'rb').read()
+             for f in sorted(os.listdir(FIXTURE_DIR)) if f.endswith('.html')]
+
+    reference = [SoupParser().parse(p) for p in pages]
+    result = {}
+
+    for backend in (SoupParser(), LxmlParser()):
+        start = time.perf_counter()
+
+        for _ in range(repeat):
+            menus = [backend.parse(p) for p in pages]
+
+        result[backend.name] = {'identical': json.dumps(menus) == json.dumps(reference),
+                                'ms_per_page': (time.perf_counter() - start) / repeat /
+                                len(pages) * 1000}
+
+    return result
+
+
+def print_report(results: list, parser_check: dict):
+    """Prints a table for humans.
+    """
+    print('\nParser backends (fixture corpus):')
+    for name, r in parser_check.items():
+        print('  {0:6} {1:8.3f} ms/page  identical to soup: {2}'.format(name, r['ms_per_page'],
+                                                                       r['identical']))
+
+    for r in results:
+        print('\nScale {0}x ({1} locations), peak RSS {2:.1f} MB, max processes {3}, '
+              'max threads {4}'.format(r['scale'], r['locations'], r['peak_rss_mb'],
+                                       r['max_processes'], r['max_threads']))
+
+        for run_name in ('cold', 'warm'):
+            run = r[run_name]
+            print('  {0}: {1} pages in {2:.2f}s ({3:.1f} pages/s), {4} menus written'.format(
+                run_name, run['pages'], run['seconds'], run['pages_per_sec'],
+                run['menus_written']))
+
+            for stage in ('fetch', 'checksum', 'parse', 'write'):
+                s = run['stages'].get(stage)
+                if s:
+                    print('    {0:9} n={1:<6} mean {2:8.3f} ms  p50 {3:8.3f} ms  p95 {4:8.3f} ms'
+                          .format(stage, s['count'], s['mean_ms'], s['p50_ms'], s['p95_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark for the UCR-Food pipeline.')
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 10, 100],
+                        help='multiples of the location count to run at')
+    parser.add_argument('--locations', type=int, default=4, help='location count at 1x')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the local server waits before each response')
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--parse-workers', type=int, default=0)
+    parser.add_argument('--parser', default='lxml', choices=sorted(parsers))
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--storage', default='memory', choices=['memory', 'sqlite'],
+                        help='in-memory stand-in or the embedded SQLite backend')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # Child process: run one scale and hand the result back on the last line of stdout.
+        print(json.dumps(run_single(args.scale[0], args)))
+        return
+
+    results = []
+
+    for scale in args.scale:
+        command = [sys.executable, '-m', 'benchmarks.run', '--single',
+                   '--scale', str(scale),
+                   '--locations', str(args.locations),
+                   '--latency', str(args.latency),
+                   '--fetch-workers', str(args.fetch_workers),
+                   '--parse-workers', str(args.parse_workers),
+                   '--parser', args.parser,
+                   '--batch-size', str(args.batch_size),
+                   '--storage', args.storage]
+
+        output = subprocess.check_output(command, cwd=REPO_DIR)
+        results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+    parser_check = check_parsers()
+    print_report(results, parser_check)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'parsers': parser_check, 'runs': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
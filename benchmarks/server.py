@@ -0,0 +1,108 @@
+import os
+import time
+from glob import glob
+from hashlib import md5
+from threading import Lock, Thread
+from urllib.parse import urlparse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+class FixtureServer(ThreadingMixIn, HTTPServer):
+    """
+    Description: local stand-in for the dining menu site. Serves the recorded menu pages in
+    benchmarks/fixtures, picking one for every url based on its query string, after a configurable
+    delay. Responses carry an ETag so conditional requests can be answered with 304s.
+    Methods:
+    - start : serves requests from a background thread.
+    - stop : shuts the server down.
+    """
+    daemon_threads = True
+
+    def __init__(self, fixture_dir: str, latency: float = 0.0, port: int = 0):
+        """Loads the fixtures and binds the server.
+
+        :param fixture_dir: directory holding the *.html fixtures.
+        :param latency: seconds to wait before answering each request.
+        :param port: port to listen on; 0 picks a free one.
+        """
+        self.latency = latency
+
+        # Requests are handled by a thread each, so the count is updated under a lock.
+        self.requests_served = 0
+        self.__requests_lock = Lock()
+
+        # Fixture pages and their ETags.
+        self.pages = []
+
+        for filename in sorted(glob(os.path.join(fixture_dir, '*.html'))):
+            with open(filename, 'rb') as f:
+                body = f.read()
+            self.pages.append((body, '"{0}"'.format(md5(body).hexdigest())))
+
+        if not self.pages:
+            raise Exception('{0}: No fixtures found.'.format(fixture_dir))
+
+        super().__init__(('127.0.0.1', port), FixtureHandler)
+
+    @property
+    def base_url(self) -> str:
+        """Returns the url to use as BaseURL in location.ini.
+
+        :return: url of the menu page.
+        """
+        return 'http://127.0.0.1:{0}/shortmenu.aspx'.format(self.server_address[1])
+
+    def page_for(self, query: str) -> tuple:
+        """Picks the fixture served for the given query string.
+
+        :param query: query string of the request.
+        :return: tuple of page body and ETag.
+        """
+        index = int(md5(query.encode('utf-8')).hexdigest(), 16) % len(self.pages)
+        return self.pages[index]
+
+    def count_request(self):
+        """Adds one to the number of requests served.
+        """
+        with self.__requests_lock:
+            self.requests_served += 1
+
+    def start(self):
+        """Serves requests from a background thread.
+        """
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """Shuts the server down.
+        """
+        self.shutdown()
+        self.server_close()
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.server.count_request()
+
+        body, etag = self.server.page_for(urlparse(self.path).query)
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep benchmark output clean.
+        pass
@@ -1,26 +1,89 @@
 import ucrfood
+import os
+import json
 import time
-import sched
+from threading import Event, Thread
+from contextlib import nullcontext
+from ucrfood.metrics import metrics
 from datetime import datetime, timedelta
 from urllib.parse import quote_plus, unquote
 
+# Whole run metrics, used to alert when throughput drops.
+run_seconds = metrics.histogram('ucrfood_run_seconds', 'Duration of crawl runs.',
+                                buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+run_pages_per_second = metrics.gauge('ucrfood_run_pages_per_second', 'Throughput of last run.')
+
 
 class FoodService:
-    def __init__(self, db_conf: str, url_conf: str):
+    def __init__(self, db_conf: str, url_conf: str, crawl_conf: str = None):
         """Sets up the configuration parser for each ini file. Instantiates class specific vars.
 
         :param db_conf: path to database configuration file.
         :param url_conf: path to url configuration file.
+        :param crawl_conf: (optional) path to crawler configuration file. Defaults are used for
+        anything missing from it.
         """
         self.__db_conf = ucrfood.Config(db_conf)
         self.__url_conf = ucrfood.Config(url_conf)
+        self.__crawl_conf = ucrfood.Config(crawl_conf or 'crawl.ini')
 
         self.base_urls = []
         self.__db_conn = None
+        self.__item_index = None
+        self.__http = None
+        self.__queue = None
+
+        # Set when the service is asked to stop.
+        self.__stopping = Event()
+
+        # Telemetry endpoint and per run summaries.
+        self.__metrics_server = None
+        self.metrics_port = 0
+        self.summary_dir = None
+        self.last_summary = {}
+
+        # Urls that could not be downloaded during the last run, even after retrying, and urls
+        # left when its deadline passed.
+        self.failed_urls = set()
+        self.unfinished_urls = []
+
+        # Longest time in seconds a run may take (0 for no limit), and file keeping unfinished
+        # urls for the next run.
+        self.run_deadline = 1800
+        self.carryover_file = None
+
+        # Worker pool limits.
+        self.fetch_workers = 8
+        self.parse_workers = 0
+
+        # Name of the menu parser backend, and parsed menus kept between runs by page sum.
+        self.parser = 'lxml'
+        self.parse_cache = None
 
-        # Generate base urls and create database connection.
+        # Maximum number of menus written to the database at once.
+        self.write_batch_size = 200
+
+        # Profile every nth run (0 to never profile), where reports go and how much they list.
+        self.profile_every = 0
+        self.profile_dir = './profiles'
+        self.profile_top = 25
+        self.profile_memory_samples = 0
+        self.__runs = 0
+
+        # Work queue settings for distributed crawling.
+        self.queue_lease = 120
+        self.queue_batch_size = 50
+        self.queue_poll = 5
+        self.queue_max_attempts = 5
+
+        # HTTP client settings, kept until the client is first needed.
+        self.__http_conf = {}
+
+        # Generate base urls and read crawler settings. The database connection, HTTP client and
+        # metrics server are only created once a command needs them, so short commands like
+        # printing the url block start fast and don't need the database to be up.
         self.__gen_base_urls()
-        self.__gen_db_conn()
+        self.__gen_crawl_settings()
 
     def __gen_base_urls(self):
         """Constructs the dictionary containing all of the url parameters and url base and then
@@ -44,25 +107,114 @@ class FoodService:
                 full_url = '{base}?{args}'.format(base=base_url, args='&'.join(url_args))
                 self.base_urls.append(full_url)
 
+    def __gen_crawl_settings(self):
+        """Reads the worker pool limits, parser backend, write batch size, metrics and HTTP
+        settings from the crawler configuration file. The file and each of its keys are optional.
+        """
+        self.__crawl_conf.construct_dict()
+
+        pool = self.__crawl_conf.get('POOL') or {}
+        self.fetch_workers = int(pool.get('fetchworkers', self.fetch_workers))
+        self.parse_workers = int(pool.get('parseworkers', self.parse_workers))
+
+        parser = self.__crawl_conf.get('PARSER') or {}
+        self.parser = parser.get('backend', self.parser)
+        self.parse_cache = ucrfood.ParseCache(max_bytes=int(parser.get('cachebytes', 16777216)))
+
+        write = self.__crawl_conf.get('WRITE') or {}
+        self.write_batch_size = int(write.get('batchsize', self.write_batch_size))
+
+        run = self.__crawl_conf.get('RUN') or {}
+        self.run_deadline = float(run.get('deadline', self.run_deadline))
+        self.carryover_file = run.get('carryoverfile') or None
+
+        profile = self.__crawl_conf.get('PROFILE') or {}
+        self.profile_every = int(profile.get('every', self.profile_every))
+        self.profile_dir = profile.get('dir') or self.profile_dir
+        self.profile_top = int(profile.get('top', self.profile_top))
+        self.profile_memory_samples = int(profile.get('memorysamples',
+                                                      self.profile_memory_samples))
+
+        queue = self.__crawl_conf.get('QUEUE') or {}
+        self.queue_lease = int(queue.get('leaseseconds', self.queue_lease))
+        self.queue_batch_size = int(queue.get('batchsize', self.queue_batch_size))
+        self.queue_poll = float(queue.get('poll', self.queue_poll))
+        self.queue_max_attempts = int(queue.get('maxattempts', self.queue_max_attempts))
+
+        # Serve metrics locally if a port is configured.
+        metrics_conf = self.__crawl_conf.get('METRICS') or {}
+        self.summary_dir = metrics_conf.get('summarydir') or None
+        self.metrics_port = int(metrics_conf.get('port') or 0)
+
+        self.__http_conf = self.__crawl_conf.get('HTTP') or {}
+
+    def __gen_metrics_server(self):
+        """Starts serving metrics if a port is configured and the server isn't running yet.
+        """
+        if self.metrics_port and not self.__metrics_server:
+            self.__metrics_server = ucrfood.MetricsServer(metrics, self.metrics_port)
+            self.__metrics_server.start()
+
+    def __gen_http(self):
+        """Creates the HTTP client. There is one pooled client for the lifetime of the service so
+        connections, cached responses and the learned concurrency limit carry over between runs.
+
+        :return: HttpClient.
+        """
+        if self.__http:
+            return self.__http
+
+        http = self.__http_conf
+        max_concurrency = int(http.get('maxconcurrency', self.fetch_workers))
+        limiter = ucrfood.HostLimiter(initial=int(http.get('initialconcurrency',
+                                                           max(1, max_concurrency // 2))),
+                                      min_limit=int(http.get('minconcurrency', 1)),
+                                      max_limit=max_concurrency,
+                                      latency_target=float(http.get('latencytarget', 2.0)))
+
+        self.__http = ucrfood.HttpClient(cache_dir=http.get('cachedir') or None,
+                                         pool_size=self.fetch_workers,
+                                         timeout=float(http.get('timeout', 30)),
+                                         limiter=limiter,
+                                         retries=int(http.get('retries', 3)),
+                                         backoff=float(http.get('backoff', 0.5)),
+                                         max_backoff=float(http.get('maxbackoff', 60)),
+                                         connect_timeout=float(http.get('connecttimeout', 5)),
+                                         max_cached=int(http.get('maxcachedpages', 1024)))
+
+        return self.__http
+
     def __gen_db_conn(self):
         """Constructs the dictionary containing all of the database settings and then initializes
-        the connection.
+        the connection, unless it is already open.
+
+        :return: Database.
+        """
+        if not self.__db_conn:
+            self.__db_conn = ucrfood.Database.from_config(self.__db_conf)
+            self.__item_index = ucrfood.ItemIndex(self.__db_conn)
+
+        return self.__db_conn
+
+    def __gen_queue(self):
+        """Creates the work queue on its own database connection, so leases can be renewed while
+        the main connection is busy crawling.
+
+        :return: WorkQueue.
         """
-        self.__db_conf.construct_dict(check_params=['DBUsername',
-                                                    'Host',
-                                                    'Port',
-                                                    'DBPassword'])
+        if not self.__queue:
+            self.__queue = ucrfood.WorkQueue(ucrfood.Database.from_config(self.__db_conf),
+                                             lease_seconds=self.queue_lease,
+                                             batch_size=self.queue_batch_size,
+                                             max_attempts=self.queue_max_attempts)
 
-        self.__db_conn = ucrfood.Database(host=self.__db_conf.get('CONNECTION').get('host'),
-                                          port=self.__db_conf.get('CONNECTION').get('port'),
-                                          uname=self.__db_conf.get('DB_INFO').get('dbusername'),
-                                          db_pass=self.__db_conf.get('AUTH').get('dbpassword'))
+        return self.__queue
 
     def __gen_url_block(self):
         """Generates the complete list of URLs for the next 15 days and their corresponding date
         parameter.
 
-        :return: list of urls.
+        :return: list of (url, day) tuples, where day is the number of days from today.
         """
         block_urls = []
 
@@ -74,58 +226,331 @@ class FoodService:
 
                 # Construct the url using the base and the calculated date.
                 current_url = '{base}&dtdate={date}'.format(base=u, date=quote_plus(current_date))
-                block_urls.append(current_url)
+                block_urls.append((current_url, d))
 
         return block_urls
 
-    def run(self):
-        """Creates the final list of dictionaries used in page serialization and then commits them
-        to the database.
+    def plan(self) -> list:
+        """Returns the urls a full run would crawl, without connecting to the database.
+
+        :return: list of (url, day) tuples, where day is the number of days from today.
+        """
+        return self.__gen_url_block()
+
+    def export(self, path: str, fmt: str = 'jsonl', start_date: str = None, end_date: str = None,
+               items: bool = False, state_file: str = None) -> dict:
+        """Streams the stored menus between two dates to a gzip-compressed JSON Lines file or a
+        SQLite snapshot; see MenuExporter.export.
+
+        :param path: path of the output file.
+        :param fmt: 'jsonl' or 'sqlite'.
+        :param start_date: (optional) ISO 8601 date of the first menu.
+        :param end_date: (optional) ISO 8601 date of the last menu.
+        :param items: if true, export flattened item rows.
+        :param state_file: (optional) file keeping the watermark between incremental exports.
+        :return: summary of the export.
+        """
+        return ucrfood.MenuExporter(self.__gen_db_conn()).export(path, fmt, start_date, end_date,
+                                                                 items, state_file)
+
+    def migrate(self):
+        """Creates the database schema (tables and secondary indexes) if it doesn't exist yet.
         """
+        self.__gen_db_conn().migrate()
+
+    def __load_carryover(self) -> list:
+        """Reads the urls left unfinished by the last run, dropping any that are no longer in
+        the url block (i.e. dates in the past).
+
+        :return: list of urls.
+        """
+        urls = self.unfinished_urls
+
+        if self.carryover_file:
+            try:
+                with open(self.carryover_file, 'r') as f:
+                    urls = json.load(f)
+            except (OSError, ValueError):
+                urls = []
+
+        current = {u for u, _ in self.__gen_url_block()}
+        return [u for u in urls if u in current]
+
+    def __save_carryover(self):
+        """Saves the urls left unfinished by this run, so they are crawled first next time even
+        if the service restarts in between.
+        """
+        if not self.carryover_file:
+            return
+
+        if os.path.dirname(self.carryover_file):
+            os.makedirs(os.path.dirname(self.carryover_file), exist_ok=True)
+
+        with open(self.carryover_file + '.tmp', 'w') as f:
+            json.dump(self.unfinished_urls, f)
+
+        os.replace(self.carryover_file + '.tmp', self.carryover_file)
+
+    def run(self, block_urls: list = None, carryover: bool = True) -> set:
+        """Creates the final list of dictionaries used in page serialization and then commits the
+        menus to the database in batches as they are parsed. Once the run deadline passes, the
+        menus parsed so far are still committed and the remaining urls are crawled first by the
+        next run. Every profile_every-th run is profiled.
+
+        :param block_urls: (optional) urls to crawl. If not given, the complete url block for the
+        next 15 days is crawled, along with any stored menus in that range.
+        :param carryover: if true, urls left unfinished by the last run are crawled first.
+        :return: set of urls whose menus were written (i.e. new or changed). Urls that could not
+        be downloaded are left in self.failed_urls and urls that were not done by the deadline in
+        self.unfinished_urls.
+        """
+        self.__runs += 1
+
+        if not self.profile_every or (self.__runs - 1) % self.profile_every:
+            return self.__run(block_urls, carryover)
+
+        profiler = ucrfood.Profiler(top=self.profile_top,
+                                    memory_samples=self.profile_memory_samples)
+
+        return self.__run(block_urls, carryover, profiler)
+
+    def __run(self, block_urls: list, carryover: bool, profiler=None) -> set:
+        """Crawls the urls and writes their menus; see run.
+
+        :param block_urls: urls to crawl, or None for the complete url block.
+        :param carryover: if true, urls left unfinished by the last run are crawled first.
+        :param profiler: (optional) Profiler recording every stage of the run.
+        :return: set of urls whose menus were written.
+        """
+        self.__gen_metrics_server()
+
+        before = metrics.snapshot()
+        started = time.time()
+        deadline = started + self.run_deadline if self.run_deadline else None
 
         # Get list of existing menus for the next two weeks and any other urls to use.
-        curr_menus = self.__db_conn.get_page_info_within_range(day_delta=15)
-        block_urls = self.__gen_url_block()
+        with profiler.stage('read') if profiler else nullcontext():
+            curr_menus = self.__gen_db_conn().get_page_info_within_range(day_delta=15)
 
-        # List to be used in the page parser.
-        final_urls = []
+        # Urls to be used in the page parser, keyed by url. Stored menus keep their page sum so
+        # unchanged pages are skipped.
+        stored_sums = {unquote(m.get('url')): m.get('sum') for m in curr_menus}
+        final_urls = {}
 
-        # Finds any urls that exist in both curr_menus and block_urls and removes from the latter.
-        for m in curr_menus:
-            unquoted_url = unquote(m.get('url'))
+        # Urls left over from the last run go first.
+        if carryover:
+            for u in self.__load_carryover():
+                final_urls[u] = {'sum': stored_sums.get(u), 'url': u}
 
-            # Remove any common urls from block_urls.
-            if unquoted_url in block_urls:
-                block_urls.remove(unquoted_url)
+        if block_urls is None:
+            block_urls = [u for u, _ in self.__gen_url_block()]
 
-            final_urls.append({'sum': m.get('sum'), 'url': unquoted_url})
+            for u, page_sum in stored_sums.items():
+                if u not in final_urls:
+                    final_urls[u] = {'sum': page_sum, 'url': u}
 
-        # Any remaining urls should be the disjoint of the two lists.
-        final_urls.extend([{'url': i} for i in block_urls])
+        # Any urls that have no stored menu yet are added without a sum.
+        for u in block_urls:
+            if u not in final_urls:
+                final_urls[u] = {'sum': stored_sums.get(u), 'url': u}
 
         # Instantiate the page parser and get the menus.
-        menu_gen = ucrfood.FoodSort(final_urls)
-        menu_gen.get_menus()
+        menu_gen = ucrfood.FoodSort(list(final_urls.values()),
+                                    fetch_workers=self.fetch_workers,
+                                    parse_workers=self.parse_workers,
+                                    http_client=self.__gen_http(),
+                                    parser=self.parser,
+                                    parse_cache=self.parse_cache,
+                                    profiler=profiler)
+        # Write menus in batches while the remaining pages are still being crawled.
+        batch = []
+        written = set()
 
-        # Upload the parsed menus to the database.
-        for m in menu_gen.menus:
-            if m.get('time_info').get('update'):
-                self.__db_conn.update_menu_on_date(m.get('time_info').get('menu_date'), m)
-            else:
-                self.__db_conn.add_menu_data(m)
+        for m in menu_gen.iter_menus(deadline):
+            batch.append(m)
+            written.add(unquote(m.get('url')))
+
+            if len(batch) >= self.write_batch_size:
+                self.__write_menus(batch, profiler)
+                batch = []
+
+        if batch:
+            self.__write_menus(batch, profiler)
+
+        self.failed_urls = menu_gen.failed_urls
+        self.unfinished_urls = menu_gen.unfinished_urls
+
+        if carryover:
+            self.__save_carryover()
+
+        self.__record_run(started, len(final_urls), len(written), before, profiler)
+
+        return written
+
+    def __write_menus(self, menus: list, profiler=None):
+        """Writes a batch of menus and updates the item search index for them.
+
+        :param menus: menus to write.
+        :param profiler: (optional) Profiler the write is recorded with.
+        """
+        with profiler.stage('write') if profiler else nullcontext():
+            self.__gen_db_conn().upsert_menus(menus, chunk_size=self.write_batch_size)
+            self.__item_index.update(menus)
+
+    def __record_run(self, started: float, pages: int, written: int, before: dict,
+                     profiler=None):
+        """Updates the run metrics and saves a JSON summary of the run, including how much every
+        metric changed during it. Profiled runs also save their profile report.
+
+        :param started: unix time the run started at.
+        :param pages: number of pages crawled.
+        :param written: number of menus written.
+        :param before: metrics snapshot taken when the run started.
+        :param profiler: (optional) Profiler that recorded the run.
+        """
+        seconds = time.time() - started
+
+        run_seconds.observe(seconds)
+        run_pages_per_second.set(pages / seconds if seconds else 0)
+
+        self.last_summary = {'started': started,
+                             'seconds': seconds,
+                             'pages': pages,
+                             'menus_written': written,
+                             'failed_urls': sorted(self.failed_urls),
+                             'unfinished_urls': self.unfinished_urls,
+                             'metrics': metrics.diff(before, metrics.snapshot())}
+
+        if profiler:
+            self.last_summary['profile'] = profiler.save(self.profile_dir, started)
+
+        if self.__metrics_server:
+            self.__metrics_server.last_summary = self.last_summary
+
+        if self.summary_dir:
+            os.makedirs(self.summary_dir, exist_ok=True)
+            filename = 'run-{0}.json'.format(time.strftime('%Y%m%d-%H%M%S', time.gmtime(started)))
+
+            with open(os.path.join(self.summary_dir, filename), 'w') as f:
+                json.dump(self.last_summary, f, indent=2)
 
     def run_schedule(self, interval: int = 12):
-        """Calls the run method every n hours based on the passed interval value.
+        """Keeps crawling until stop is called. Each page is refreshed on its own schedule: pages
+        for today and tomorrow often, later dates and pages that keep coming back unchanged less
+        often, and no page less often than every n hours. Pages that could not be downloaded are
+        retried less and less often.
 
-        :param interval: interval in hours. Default is 12 hours.
+        :param interval: longest interval in hours between refreshes of a page. Default is 12 hours.
         """
-        self.run()
+        conf = self.__crawl_conf.get('SCHEDULE') or {}
+        scheduler = ucrfood.RefreshScheduler(near_interval=float(conf.get('nearinterval', 3600)),
+                                             far_interval=interval * 3600,
+                                             near_days=int(conf.get('neardays', 1)),
+                                             max_backoff=int(conf.get('maxbackoff', 4)),
+                                             jitter=float(conf.get('jitter', 0.1)),
+                                             retry_interval=float(conf.get('retryinterval', 60)))
 
-        s = sched.scheduler(time.time, time.sleep)
-        s.enter(interval * 3600, 2, self.run)
-        s.run()
+        # Shortest wait between passes, so pages that are due right away (e.g. unfinished ones)
+        # never make the loop spin.
+        min_wait = float(conf.get('minretryseconds', 10))
+
+        self.__gen_metrics_server()
+
+        while not self.__stopping.is_set():
+            entries = self.__gen_url_block()
+            due = scheduler.due(entries)
+
+            if due:
+                written = self.run(block_urls=[u for u, _ in due])
+
+                # Failed pages are backed off on their own. Unfinished pages are not recorded, so
+                # they are crawled first on the next pass.
+                for u, _ in due:
+                    if u in self.failed_urls:
+                        scheduler.record_failure(u)
+                    elif u not in self.unfinished_urls:
+                        scheduler.record(u, changed=u in written)
+
+            # Wake up at least once a minute so new dates enter the url block on time.
+            self.__stopping.wait(min(max(scheduler.seconds_until_next(entries), min_wait), 60))
+
+    def enqueue(self) -> int:
+        """Adds the complete url block for the next 15 days to the shared work queue. Urls that
+        are still queued are not added twice.
+
+        :return: number of urls added.
+        """
+        return self.__gen_queue().enqueue(self.__gen_url_block())
+
+    def work(self):
+        """Crawls urls from the shared work queue until stop is called. Any number of workers can
+        run against the same database; each claims a batch of urls at a time and keeps its lease
+        on them while crawling. If a worker dies, its urls are claimed by another one once the
+        lease runs out. Urls that still fail after queue_max_attempts claims are dropped.
+        """
+        self.__gen_metrics_server()
+        queue = self.__gen_queue()
+
+        while not self.__stopping.is_set():
+            items = queue.claim()
+
+            if not items:
+                self.__stopping.wait(self.queue_poll)
+                continue
+
+            crawled = Event()
+            renewer = Thread(target=self.__renew_leases, args=(queue, items, crawled), daemon=True)
+            renewer.start()
+
+            try:
+                self.run(block_urls=[i.get('url') for i in items], carryover=False)
+            except Exception as e:
+                # Leave the urls leased; another worker picks them up once the lease runs out.
+                print('Crawling claimed urls failed: {0}'.format(e))
+                continue
+            finally:
+                crawled.set()
+                renewer.join()
+
+            # Failed and unfinished urls stay leased and are crawled again once the lease runs out,
+            # unless they keep failing (e.g. pages that are gone).
+            retry = self.failed_urls.union(self.unfinished_urls)
+            exhausted = [i for i in queue.exhausted(items) if i.get('url') in self.failed_urls]
+
+            for item in exhausted:
+                print('Giving up on {0} after {1} attempts.'.format(item.get('url'),
+                                                                   item.get('attempts')))
+
+            queue.release([i for i in items if i.get('url') not in retry] + exhausted)
+
+    @staticmethod
+    def __renew_leases(queue, items: list, crawled: Event):
+        """Renews the lease on claimed urls until they are crawled.
+
+        :param queue: WorkQueue the urls were claimed from.
+        :param items: claimed queue items.
+        :param crawled: set once the urls are crawled.
+        """
+        while not crawled.wait(queue.lease_seconds / 3):
+            try:
+                queue.renew(items)
+            except Exception as e:
+                print('Renewing leases failed: {0}'.format(e))
 
     def stop(self):
-        """Disconnects from the rethinkdb server.
+        """Stops the schedule, disconnects from the database and closes pooled HTTP connections.
+        Only what was actually opened is closed.
         """
-        self.__db_conn.disconnect()
+        self.__stopping.set()
+
+        if self.__metrics_server:
+            self.__metrics_server.stop()
+
+        if self.__http:
+            self.__http.close()
+
+        if self.__db_conn:
+            self.__db_conn.disconnect()
+
+        if self.__queue:
+            self.__queue.database.disconnect()
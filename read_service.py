@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+import ucrfood
+import os
+import json
+from datetime import date, timedelta
+from threading import Event, Lock, Thread
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+class ReadService:
+    def __init__(self, db_conf: str, read_conf: str = None):
+        """Sets up the configuration parser for each ini file, the menu cache and the database
+        connection, migrating the database if needed.
+
+        :param db_conf: path to database configuration file.
+        :param read_conf: (optional) path to read service configuration file. Defaults are used for
+        anything missing from it.
+        """
+        self.__db_conf = ucrfood.Config(db_conf)
+        self.__read_conf = ucrfood.Config(read_conf or 'read.ini')
+        self.__read_conf.construct_dict()
+
+        settings = self.__read_conf.get('READ') or {}
+        self.host = settings.get('host') or '127.0.0.1'
+        self.port = int(settings.get('port') or 8090)
+        self.cache = ucrfood.MenuCache(capacity=int(settings.get('cachesize') or 4096))
+
+        # Longest date range a single request may ask for.
+        self.max_range_days = int(settings.get('maxrangedays') or 366)
+
+        # The connection is shared between request threads, so round trips are serialized. Menus
+        # are read in the current layout (ISO dates, catalog encoding), so the schema and data
+        # migrations are run first, like the crawler does.
+        self.__db_conn = ucrfood.Database.from_config(self.__db_conf)
+        self.__db_conn.migrate()
+        self.__db_lock = Lock()
+        self.__item_index = ucrfood.ItemIndex(self.__db_conn)
+
+        # Menus are only cached while the changefeed is up; otherwise they could go stale.
+        self.__feed_ready = Event()
+        self.__stopping = Event()
+        self.__server = None
+
+    def __watch_changes(self):
+        """Drops changed menus from the cache for as long as the service runs. If the changefeed
+        fails, everything is dropped and the feed is opened again.
+        """
+        while not self.__stopping.is_set():
+            try:
+                feed = self.__db_conn.menu_changes()
+                self.__feed_ready.set()
+
+                for key in feed:
+                    self.cache.invalidate(key)
+
+                    if self.__stopping.is_set():
+                        break
+            except Exception as e:
+                print('Changefeed failed: {0}'.format(e))
+
+            self.__feed_ready.clear()
+            self.cache.clear()
+            self.__stopping.wait(5)
+
+    @staticmethod
+    def __parse_date(value: str) -> date:
+        """Parses an ISO 8601 date given in a request.
+
+        :param value: date string.
+        :return: date.
+        """
+        try:
+            return date.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError('Dates must be formatted as YYYY-MM-DD.')
+
+    def __date_range(self, start_date: str, end_date: str) -> list:
+        """Returns every day between two dates given in a request (both included).
+
+        :param start_date: ISO 8601 date of the first day.
+        :param end_date: ISO 8601 date of the last day.
+        :return: list of ISO 8601 dates; empty if the range ends before it starts.
+        """
+        first = self.__parse_date(start_date)
+        last = self.__parse_date(end_date)
+
+        if (last - first).days >= self.max_range_days:
+            raise ValueError('Date ranges can span at most {0} days.'.format(self.max_range_days))
+
+        return [(first + timedelta(days=d)).isoformat() for d in range((last - first).days + 1)]
+
+    def get_menu(self, location_num: str, menu_date: str) -> dict:
+        """Returns the menu of a location on a given date, from memory if possible.
+
+        :param location_num: location number of the dining hall.
+        :param menu_date: ISO 8601 date of the menu.
+        :return: menu document, or None if there is none.
+        """
+        key = (location_num, menu_date)
+        menu = self.cache.get(key)
+
+        if menu is not None:
+            return None if menu is self.cache.missing else menu
+
+        epoch = self.cache.epoch
+
+        with self.__db_lock:
+            menu = self.__db_conn.get_menu(location_num, menu_date)
+
+        if self.__feed_ready.is_set():
+            self.cache.put(key, menu, epoch)
+
+        return menu
+
+    def get_menus(self, location_num: str, start_date: str, end_date: str) -> list:
+        """Returns the menus of a location between two dates (both included). Dates that are not
+        cached are read from the database with a single range query.
+
+        :param location_num: location number of the dining hall.
+        :param start_date: ISO 8601 date of the first menu.
+        :param end_date: ISO 8601 date of the last menu.
+        :return: list of menu documents in date order.
+        """
+        days = self.__date_range(start_date, end_date)
+
+        cached = {d: self.cache.get((location_num, d)) for d in days}
+        uncached = [d for d in days if cached[d] is None]
+
+        if uncached:
+            epoch = self.cache.epoch
+
+            with self.__db_lock:
+                found = {m.get('time_info').get('menu_date'): m for m in
+                         self.__db_conn.get_menus(location_num, uncached[0], uncached[-1])}
+
+            for d in uncached:
+                cached[d] = found.get(d) or self.cache.missing
+
+                if self.__feed_ready.is_set():
+                    self.cache.put((location_num, d), found.get(d), epoch)
+
+        return [cached[d] for d in days if cached[d] is not self.cache.missing]
+
+    def get_menu_history(self, location_num: str, start_date: str, end_date: str) -> list:
+        """Returns what changed in the menus of a location between two dates (both included).
+        History is appended to on every crawl, so it is not cached.
+
+        :param location_num: location number of the dining hall.
+        :param start_date: ISO 8601 date of the first menu.
+        :param end_date: ISO 8601 date of the last menu.
+        :return: list of history documents by menu date, oldest change first.
+        """
+        # Reject malformed dates and long ranges the same way get_menus does.
+        days = self.__date_range(start_date, end_date)
+
+        if not days:
+            return []
+
+        with self.__db_lock:
+            return self.__db_conn.get_menu_history(location_num, days[0], days[-1])
+
+    def search(self, query: str, prefix: bool = False, start_date: str = None,
+               end_date: str = None) -> list:
+        """Finds menu items matching every term of the query.
+
+        :param query: search terms.
+        :param prefix: if true, the last term also matches tokens it is a prefix of.
+        :param start_date: (optional) ISO 8601 date of the earliest menu to include.
+        :param end_date: (optional) ISO 8601 date of the latest menu to include.
+        :return: list of matching items with their location, date, meal and section.
+        """
+        start_date = start_date and self.__parse_date(start_date).isoformat()
+        end_date = end_date and self.__parse_date(end_date).isoformat()
+
+        with self.__db_lock:
+            return self.__item_index.search(query, prefix, start_date, end_date)
+
+    def serve(self):
+        """Starts the changefeed watcher and serves requests until stop is called.
+        """
+        Thread(target=self.__watch_changes, daemon=True).start()
+
+        self.__server = ReadServer((self.host, self.port), ReadHandler)
+        self.__server.service = self
+        self.__server.serve_forever()
+
+    def stop(self):
+        """Stops serving and disconnects from the database.
+        """
+        self.__stopping.set()
+
+        if self.__server:
+            self.__server.shutdown()
+            self.__server.server_close()
+
+        self.__db_conn.disconnect()
+
+
+class ReadServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ReadHandler(BaseHTTPRequestHandler):
+    """
+    Description: JSON API for menus.
+    - GET /menus/<location num>/<date> : menu of a location on a date.
+    - GET /menus/<location num>?start=<date>&end=<date> : menus of a location in a date range.
+    - GET /history/<location num>?start=<date>&end=<date> : items added to and removed from the
+      menus of a location in a date range.
+    - GET /search?q=<terms>[&prefix=1][&start=<date>][&end=<date>] : items matching the terms.
+    - GET /stats : cache statistics.
+    """
+    def __send_json(self, status: int, body):
+        payload = json.dumps(body).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+
+        try:
+            if parts == ['stats']:
+                self.__send_json(200, {'size': len(service.cache),
+                                       'hits': service.cache.hits,
+                                       'misses': service.cache.misses})
+            elif parts == ['search']:
+                query = parse_qs(url.query)
+                self.__send_json(200, service.search(query.get('q', [''])[0],
+                                                     query.get('prefix', ['0'])[0] == '1',
+                                                     query.get('start', [None])[0],
+                                                     query.get('end', [None])[0]))
+            elif len(parts) == 3 and parts[0] == 'menus':
+                menu = service.get_menu(parts[1], parts[2])
+                self.__send_json(200 if menu else 404, menu or {'error': 'No menu found.'})
+            elif len(parts) == 2 and parts[0] == 'menus':
+                query = parse_qs(url.query)
+                today = date.today().isoformat()
+                self.__send_json(200, service.get_menus(parts[1],
+                                                        query.get('start', [today])[0],
+                                                        query.get('end', [today])[0]))
+            elif len(parts) == 2 and parts[0] == 'history':
+                query = parse_qs(url.query)
+                today = date.today().isoformat()
+                self.__send_json(200, service.get_menu_history(parts[1],
+                                                               query.get('start', [today])[0],
+                                                               query.get('end', [today])[0]))
+            else:
+                self.__send_json(404, {'error': 'Unknown path.'})
+        except ValueError as e:
+            # Malformed dates and date ranges that are too long.
+            self.__send_json(400, {'error': str(e)})
+        except TypeError:
+            self.__send_json(400, {'error': 'Bad request.'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Application entrypoint:
+if __name__ == '__main__':
+    service = ReadService(db_conf=os.path.abspath('./config/db.ini'),
+                          read_conf=os.path.abspath('./config/read.ini'))
+
+    try:
+        service.serve()
+    except KeyboardInterrupt:
+        print("\nStopping...")
+        service.stop()
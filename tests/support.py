@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ucrfood.sqlite_db import SQLiteDatabase
+
+
+def make_menu(location: str = '02', menu_date: str = '2026-10-18', meals: dict = None,
+              page_sum: str = None) -> dict:
+    """Builds a menu the way FoodSort creates them.
+
+    :param location: location number of the dining hall.
+    :param menu_date: ISO 8601 date of the menu.
+    :param meals: {meal: {section: [item, ...]}}, in menu order.
+    :param page_sum: sum of the page; derived from the meals if not given.
+    :return: menu dict.
+    """
+    meals = meals if meals is not None else {'Lunch': {'Entree': ['Pizza']}}
+
+    return {'location': {'name': 'Hall{0}'.format(location), 'num': location},
+            'time_info': {'gen': '2026-10-18 07:00:00', 'update': None, 'menu_date': menu_date},
+            'url': 'menus%3Flocationnum%3D{0}'.format(location),
+            'sum': page_sum or str(hash(repr(sorted(meals.items())))),
+            'menus': [{'type': meal, 'content': content} for meal, content in meals.items()]}
+
+
+class SQLiteTestCase(unittest.TestCase):
+    """
+    Description: test case with a migrated SQLite database in a temporary directory.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = self.open_database()
+        self.db.migrate()
+
+    def tearDown(self):
+        self.db.disconnect()
+        shutil.rmtree(self.directory)
+
+    def open_database(self) -> SQLiteDatabase:
+        """Opens another connection to the test database.
+
+        :return: SQLiteDatabase.
+        """
+        return SQLiteDatabase(os.path.join(self.directory, 'test.sqlite3'), poll_interval=0.01)
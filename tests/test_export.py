@@ -0,0 +1,107 @@
+import os
+import gzip
+import json
+import sqlite3
+import unittest
+from ucrfood.export import MenuExporter
+from tests.support import make_menu, SQLiteTestCase
+
+
+class StreamMenusTest(SQLiteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.menus = [make_menu(location=location, menu_date='2026-10-{0:02d}'.format(day))
+                      for day in range(18, 25) for location in ('02', '03', '01')]
+        self.db.upsert_menus(self.menus)
+
+    def keys(self, menus) -> list:
+        return [(m.get('time_info').get('menu_date'), m.get('location').get('num')) for m in menus]
+
+    def test_streams_every_menu_in_date_order_across_batches(self):
+        streamed = list(self.db.stream_menus(batch_size=4))
+
+        self.assertEqual(self.keys(streamed), sorted(self.keys(self.menus)))
+        self.assertEqual(streamed[0].get('menus'), self.menus[0].get('menus'))
+
+    def test_date_range_includes_both_ends(self):
+        streamed = self.db.stream_menus('2026-10-19', '2026-10-20', batch_size=2)
+
+        self.assertEqual(self.keys(streamed), [('2026-10-19', '01'), ('2026-10-19', '02'),
+                                               ('2026-10-19', '03'), ('2026-10-20', '01'),
+                                               ('2026-10-20', '02'), ('2026-10-20', '03')])
+
+    def test_watermarks(self):
+        watermark = self.db.export_watermark()
+        changed = make_menu(location='03', menu_date='2026-10-20',
+                            meals={'Dinner': {'Grill': ['Ribs']}})
+        self.db.upsert_menus([changed])
+
+        # Only the latest version of a menu is stored, so the changed menu moves past the
+        # watermark.
+        before = self.keys(self.db.stream_menus(until=watermark))
+        self.assertEqual(len(before), len(self.menus) - 1)
+        self.assertNotIn(('2026-10-20', '03'), before)
+        self.assertEqual(self.keys(self.db.stream_menus(since=watermark)),
+                         [('2026-10-20', '03')])
+        self.assertEqual(list(self.db.stream_menus(since=self.db.export_watermark())), [])
+
+
+class MenuExporterTest(SQLiteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.exporter = MenuExporter(self.db, batch_size=2)
+        self.state = os.path.join(self.directory, 'state.json')
+        self.db.upsert_menus([make_menu(menu_date='2026-10-18'),
+                              make_menu(menu_date='2026-10-19',
+                                        meals={'Lunch': {'Entree': ['Pizza', 'Tacos']}})])
+
+    def read_jsonl(self, path: str) -> list:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_incremental_jsonl_export(self):
+        path = os.path.join(self.directory, 'menus.jsonl.gz')
+
+        result = self.exporter.export(path, state_file=self.state)
+        self.assertEqual(result.get('menus'), 2)
+        self.assertEqual([m.get('time_info').get('menu_date') for m in self.read_jsonl(path)],
+                         ['2026-10-18', '2026-10-19'])
+
+        self.db.upsert_menus([make_menu(menu_date='2026-10-20')])
+        self.exporter.export(path, state_file=self.state)
+        self.assertEqual([m.get('time_info').get('menu_date') for m in self.read_jsonl(path)],
+                         ['2026-10-20'])
+
+    def test_item_rows(self):
+        path = os.path.join(self.directory, 'items.jsonl.gz')
+        result = self.exporter.export(path, start_date='2026-10-19', items=True)
+
+        self.assertEqual(result.get('rows'), 2)
+        self.assertEqual([(r.get('menu_id'), r.get('meal'), r.get('section'), r.get('position'),
+                           r.get('item')) for r in self.read_jsonl(path)],
+                         [('02_2026-10-19', 'Lunch', 'Entree', 0, 'Pizza'),
+                          ('02_2026-10-19', 'Lunch', 'Entree', 1, 'Tacos')])
+
+    def test_sqlite_snapshot_merges_later_exports(self):
+        path = os.path.join(self.directory, 'snapshot.sqlite3')
+        self.exporter.export(path, fmt='sqlite', items=True, state_file=self.state)
+
+        self.db.upsert_menus([make_menu(menu_date='2026-10-18',
+                                        meals={'Lunch': {'Entree': ['Curry']}})])
+        self.exporter.export(path, fmt='sqlite', items=True, state_file=self.state)
+
+        conn = sqlite3.connect(path)
+        try:
+            self.assertEqual(conn.execute('SELECT count(*) FROM menus').fetchone()[0], 2)
+            self.assertEqual(conn.execute('SELECT item FROM items ORDER BY menu_date, position')
+                             .fetchall(), [('Curry',), ('Pizza',), ('Tacos',)])
+        finally:
+            conn.close()
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            self.exporter.export(os.path.join(self.directory, 'menus.csv'), fmt='csv')
+
+
+if __name__ == '__main__':
+    unittest.main()
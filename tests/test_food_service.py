@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from urllib.parse import urlparse
+from benchmarks.server import FixtureServer, FixtureHandler
+from food_service import FoodService
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'benchmarks', 'fixtures')
+
+
+class SlowHandler(FixtureHandler):
+    def do_GET(self):
+        # Hang on the slow url for longer than the run may take.
+        query = urlparse(self.path).query
+
+        if query == self.server.slow_query:
+            time.sleep(5)
+
+        if query == self.server.failing_query:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        super().do_GET()
+
+
+class RunDeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FixtureServer(FIXTURE_DIR)
+        self.server.RequestHandlerClass = SlowHandler
+        self.server.slow_query = None
+        self.server.failing_query = None
+        self.server.start()
+
+        self.paths = {name: os.path.join(self.directory, name + '.ini')
+                      for name in ('location', 'db', 'crawl')}
+        self.carryover_file = os.path.join(self.directory, 'unfinished.json')
+
+        with open(self.paths['location'], 'w') as f:
+            f.write('[MAIN]\nBaseURL = {0}\n\n[LOCATION1]\nLocationNum = 02\n'
+                    'LocationName = Hall\n'.format(self.server.base_url))
+
+        with open(self.paths['db'], 'w') as f:
+            f.write('[STORAGE]\nBackend = sqlite\nPath = {0}\n\n[DB_INFO]\nDBUsername = test\n\n'
+                    '[CONNECTION]\nHost = 127.0.0.1\nPort = 0\n\n[AUTH]\nDBPassword =\n'.format(
+                        os.path.join(self.directory, 'test.sqlite3')))
+
+        # The failing url must not cut the concurrency limit, or the other pages would all queue
+        # up behind the slow one.
+        with open(self.paths['crawl'], 'w') as f:
+            f.write('[POOL]\nFetchWorkers = 4\n\n[RUN]\nDeadline = 2\nCarryoverFile = {0}\n\n'
+                    '[HTTP]\nRetries = 0\nMinConcurrency = 4\nInitialConcurrency = 4\n'
+                    'MaxConcurrency = 4\n'.format(self.carryover_file))
+
+        self.service = self.open_service()
+        self.service.migrate()
+
+    def tearDown(self):
+        self.service.stop()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def open_service(self) -> FoodService:
+        return FoodService(db_conf=self.paths['db'], url_conf=self.paths['location'],
+                           crawl_conf=self.paths['crawl'])
+
+    def test_slow_page_is_carried_over_to_the_next_run(self):
+        urls = [u for u, _ in self.service.plan()]
+        self.server.slow_query = urlparse(urls[2]).query
+        self.server.failing_query = urlparse(urls[3]).query
+
+        start = time.time()
+        written = self.service.run()
+
+        self.assertLess(time.time() - start, 3)
+        self.assertNotIn(urls[2], written)
+        self.assertEqual(self.service.unfinished_urls, [urls[2]])
+        self.assertEqual(self.service.failed_urls, {urls[3]})
+
+        with open(self.carryover_file, 'r') as f:
+            self.assertEqual(json.load(f), [urls[2]])
+
+        # A restarted service crawls it first, even if it isn't asked to.
+        self.server.slow_query = None
+        self.service.stop()
+        self.service = self.open_service()
+        written = self.service.run(block_urls=[urls[0]])
+
+        self.assertIn(urls[2], written)
+        self.assertEqual(self.service.unfinished_urls, [])
+
+        with open(self.carryover_file, 'r') as f:
+            self.assertEqual(json.load(f), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
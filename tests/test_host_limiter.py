@@ -0,0 +1,166 @@
+import os
+import time
+import socket
+import unittest
+from threading import Thread
+from urllib.parse import urlparse
+import requests.exceptions as rexcept
+from benchmarks.server import FixtureServer, FixtureHandler
+from ucrfood.host_limiter import HostLimiter
+from ucrfood.http_client import HttpClient
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'benchmarks', 'fixtures')
+
+
+class HostLimiterTest(unittest.TestCase):
+    def test_limit_grows_by_one_per_round_of_fast_responses(self):
+        limiter = HostLimiter(initial=2, max_limit=8, latency_target=1.0)
+
+        for _ in range(3):
+            limiter.acquire('a')
+            limiter.release('a', latency=0.1)
+
+        # 2 -> 2.5 -> 2.9 -> 3.24
+        self.assertEqual(limiter.limit('a'), 3)
+
+    def test_slow_responses_do_not_grow_the_limit(self):
+        limiter = HostLimiter(initial=2, max_limit=8, latency_target=1.0)
+
+        for _ in range(10):
+            limiter.acquire('a')
+            limiter.release('a', latency=2.0)
+
+        self.assertEqual(limiter.limit('a'), 2)
+
+    def test_congestion_halves_the_limit_once_per_round(self):
+        limiter = HostLimiter(initial=8, max_limit=8, latency_target=60)
+
+        for _ in range(3):
+            limiter.acquire('a')
+
+        # Failures from the same round count once.
+        for _ in range(3):
+            limiter.release('a', congested=True)
+
+        self.assertEqual(limiter.limit('a'), 4)
+
+    def test_limits_are_clamped(self):
+        limiter = HostLimiter(initial=4, min_limit=2, max_limit=5, latency_target=0)
+
+        for _ in range(10):
+            limiter.acquire('a')
+            limiter.release('a', congested=True)
+
+        self.assertEqual(limiter.limit('a'), 2)
+
+        limiter.latency_target = 1.0
+
+        for _ in range(50):
+            limiter.acquire('a')
+            limiter.release('a', latency=0.1)
+
+        self.assertEqual(limiter.limit('a'), 5)
+
+    def test_hosts_have_their_own_limit(self):
+        limiter = HostLimiter(initial=4, latency_target=0)
+
+        limiter.acquire('a')
+        limiter.release('a', congested=True)
+
+        self.assertEqual((limiter.limit('a'), limiter.limit('b')), (2, 4))
+
+    def test_acquire_blocks_at_the_limit(self):
+        limiter = HostLimiter(initial=1, max_limit=1)
+        acquired = []
+
+        limiter.acquire('a')
+        waiter = Thread(target=lambda: acquired.append(limiter.acquire('a')), daemon=True)
+        waiter.start()
+        waiter.join(0.2)
+
+        self.assertEqual(acquired, [])
+        self.assertFalse(limiter.acquire('a', deadline=time.time() + 0.05))
+
+        limiter.release('a', latency=0.1)
+        waiter.join(1)
+
+        self.assertEqual(acquired, [True])
+
+    def test_retry_after_holds_back_requests(self):
+        limiter = HostLimiter(initial=4)
+
+        limiter.acquire('a')
+        limiter.release('a', congested=True, retry_after=0.3)
+
+        start = time.time()
+        self.assertFalse(limiter.acquire('a', deadline=start + 0.1))
+        self.assertTrue(limiter.acquire('a'))
+        self.assertGreaterEqual(time.time() - start, 0.25)
+
+
+class StatusHandler(FixtureHandler):
+    def do_GET(self):
+        status = int(urlparse(self.path).query.partition('=')[2])
+
+        if status == 200:
+            return super().do_GET()
+
+        # Answer slower than the client waits for.
+        if status == 0:
+            time.sleep(0.5)
+
+        self.send_response(status or 503)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class HttpClientLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FixtureServer(FIXTURE_DIR)
+        self.server.RequestHandlerClass = StatusHandler
+        self.server.start()
+        self.host = '127.0.0.1:{0}'.format(self.server.server_address[1])
+
+        # No round trip gate, so every failure cuts the limit.
+        self.limiter = HostLimiter(initial=8, max_limit=8, latency_target=0)
+        self.client = HttpClient(limiter=self.limiter, retries=0, timeout=0.2)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def get(self, status: int):
+        return self.client.get('{0}?status={1}'.format(self.server.base_url, status))
+
+    def test_throttled_failed_and_timed_out_requests_halve_the_limit(self):
+        for status, error in ((429, rexcept.HTTPError), (503, rexcept.HTTPError),
+                              (0, rexcept.Timeout)):
+            with self.assertRaises(error):
+                self.get(status)
+
+        self.assertEqual(self.limiter.limit(self.host), 1)
+
+    def test_requests_are_released_on_errors(self):
+        self.limiter.max_limit = self.limiter.min_limit = 1
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            closed_host = '127.0.0.1:{0}'.format(s.getsockname()[1])
+
+        with self.assertRaises(rexcept.ConnectionError):
+            self.client.get('http://{0}/'.format(closed_host))
+
+        for status, error in ((404, rexcept.HTTPError), (503, rexcept.HTTPError),
+                              (0, rexcept.Timeout)):
+            with self.assertRaises(error):
+                self.get(status)
+
+        self.get(200)
+
+        # Nothing is left in flight, so the only slot of each host is free.
+        for host in (closed_host, self.host):
+            self.assertTrue(self.limiter.acquire(host, deadline=time.time() + 0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
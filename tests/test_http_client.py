@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+from hashlib import md5
+from benchmarks.server import FixtureServer
+from ucrfood.http_client import HttpClient
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'benchmarks', 'fixtures')
+
+
+class HttpClientCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FixtureServer(FIXTURE_DIR)
+        self.server.start()
+        self.urls = ['{0}?locationnum={1:02d}'.format(self.server.base_url, i) for i in range(4)]
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def is_cached(self, url: str) -> bool:
+        name = md5(url.encode('utf-8')).hexdigest()
+        return os.path.exists(os.path.join(self.directory, name + '.json'))
+
+    def cached_files(self) -> int:
+        return len([n for n in os.listdir(self.directory) if n.endswith('.json')])
+
+    def test_least_recently_used_pages_are_evicted(self):
+        client = HttpClient(cache_dir=self.directory, max_cached=2)
+
+        client.get(self.urls[0])
+        client.get(self.urls[1])
+        client.get(self.urls[0])
+        client.get(self.urls[2])
+        client.close()
+
+        # The first url was used more recently than the second, so the second is evicted.
+        self.assertEqual(self.cached_files(), 2)
+        self.assertEqual([self.is_cached(u) for u in self.urls[:3]], [True, False, True])
+
+    def test_disk_cache_is_pruned_on_start(self):
+        client = HttpClient(cache_dir=self.directory, max_cached=4)
+
+        for url in self.urls:
+            client.get(url)
+
+        client.close()
+        self.assertEqual(self.cached_files(), 4)
+
+        HttpClient(cache_dir=self.directory, max_cached=1).close()
+        self.assertEqual(self.cached_files(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
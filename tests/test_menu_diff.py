@@ -0,0 +1,103 @@
+import unittest
+from ucrfood.menu_diff import MenuDiff
+from tests.support import make_menu, SQLiteTestCase
+
+
+class MenuDiffTest(unittest.TestCase):
+    def test_changes_lists_removed_before_added_items(self):
+        old = make_menu(meals={'Lunch': {'Entree': ['Pizza', 'Tacos']}})['menus']
+        new = make_menu(meals={'Lunch': {'Entree': ['Tacos', 'Curry']}})['menus']
+
+        self.assertEqual(MenuDiff.changes(old, new),
+                         [['-', 'Lunch', 'Entree', ['Pizza']], ['+', 'Lunch', 'Entree', ['Curry']]])
+
+    def test_changes_of_whole_meals_and_sections(self):
+        old = make_menu(meals={'Lunch': {'Entree': ['Pizza'], 'Soup': ['Chili']}})['menus']
+        new = make_menu(meals={'Lunch': {'Entree': ['Pizza']},
+                               'Dinner': {'Grill': ['Burger']}})['menus']
+
+        self.assertEqual(MenuDiff.changes(old, new),
+                         [['-', 'Lunch', 'Soup', ['Chili']], ['+', 'Dinner', 'Grill', ['Burger']]])
+
+    def test_reordered_items_are_not_a_change(self):
+        old = make_menu(meals={'Lunch': {'Entree': ['Pizza', 'Tacos']}})['menus']
+        new = make_menu(meals={'Lunch': {'Entree': ['Tacos', 'Pizza']}})['menus']
+
+        self.assertEqual(MenuDiff.changes(old, new), [])
+
+    def test_new_menu_is_all_additions(self):
+        new = make_menu(meals={'Lunch': {}})['menus']
+
+        self.assertEqual(MenuDiff.changes(None, new), [['+', 'Lunch', None, []]])
+
+    def test_meal_patches_only_include_changed_meals(self):
+        old = [{'type': 1, 'content': {2: [3]}}, {'type': 4, 'content': {5: [6]}}]
+        new = [{'type': 1, 'content': {2: [3]}}, {'type': 4, 'content': {5: [7]}}]
+
+        self.assertEqual(MenuDiff.meal_patches(old, new), [(1, new[1])])
+        self.assertEqual(MenuDiff.meal_patches(old, old), [])
+
+    def test_meal_patches_rewrite_when_meals_change(self):
+        old = [{'type': 1, 'content': {}}, {'type': 4, 'content': {}}]
+
+        self.assertIsNone(MenuDiff.meal_patches(old, old[::-1]))
+        self.assertIsNone(MenuDiff.meal_patches(old, old[:1]))
+
+
+class MenuHistoryTest(SQLiteTestCase):
+    def history(self) -> list:
+        return [h.get('changes') for h in self.db.get_menu_history('02', '2026-10-18',
+                                                                   '2026-10-18')]
+
+    def test_patched_menu_reads_back_as_crawled(self):
+        self.db.upsert_menus([make_menu(meals={'Lunch': {'Entree': ['Pizza']},
+                                               'Dinner': {'Grill': ['Burger']}})])
+        changed = make_menu(meals={'Lunch': {'Entree': ['Pizza']}, 'Dinner': {'Grill': ['Ribs']}})
+        self.db.upsert_menus([changed])
+
+        stored = self.db.get_menu('02', '2026-10-18')
+        self.assertEqual(stored.get('menus'), changed.get('menus'))
+        self.assertEqual(stored.get('sum'), changed.get('sum'))
+
+    def test_flip_flopping_menu_keeps_every_record(self):
+        a = make_menu(meals={'Lunch': {'Entree': ['Tacos']}})
+        b = make_menu(meals={'Lunch': {'Entree': ['Tacos', 'Pizza']}})
+
+        for menu in (a, b, a, b):
+            self.db.upsert_menus([menu])
+
+        self.assertEqual(self.history(), [[['+', 'Lunch', 'Entree', ['Tacos']]],
+                                          [['+', 'Lunch', 'Entree', ['Pizza']]],
+                                          [['-', 'Lunch', 'Entree', ['Pizza']]],
+                                          [['+', 'Lunch', 'Entree', ['Pizza']]]])
+        self.assertEqual(self.db.get_menu('02', '2026-10-18').get('menus'), b.get('menus'))
+
+    def test_unchanged_items_add_no_record(self):
+        self.db.upsert_menus([make_menu(page_sum='a')])
+        self.db.upsert_menus([make_menu(page_sum='b')])
+
+        self.assertEqual(len(self.history()), 1)
+        self.assertEqual(self.db.get_menu('02', '2026-10-18').get('sum'), 'b')
+
+    def test_stale_update_is_written_whole_and_counted_once(self):
+        other = self.open_database()
+        self.addCleanup(other.disconnect)
+        self.db.upsert_menus([make_menu(page_sum='a'), make_menu(location='03', page_sum='a')])
+
+        deltas = self.db._deltas
+
+        # Another crawler writes the first menu between reading it and patching it.
+        def racing_deltas(menus, stored):
+            result = deltas(menus, stored)
+            other.upsert_menus([make_menu(meals={'Lunch': {'Entree': ['Curry']}})])
+            return result
+
+        self.db._deltas = racing_deltas
+        latest = make_menu(meals={'Lunch': {'Entree': ['Ramen']}})
+
+        self.assertEqual(self.db.upsert_menus([latest, make_menu(location='03', page_sum='b')]), 2)
+        self.assertEqual(self.db.get_menu('02', '2026-10-18').get('menus'), latest.get('menus'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import json
+import unittest
+from ucrfood.search import ItemIndex
+from tests.support import make_menu, SQLiteTestCase
+
+
+class BackfillTest(SQLiteTestCase):
+    def store_plain(self, menu: dict):
+        """Stores a menu the way versions before the catalog and search index did."""
+        menu = dict(menu, id=self.db.menu_key(menu.get('location').get('num'),
+                                              menu.get('time_info').get('menu_date')))
+        self.db.conn.execute('INSERT INTO menus (id, location, menu_date, url, sum, version, doc) '
+                             'VALUES (?, ?, ?, ?, ?, 1, ?)',
+                             (menu.get('id'), menu.get('location').get('num'),
+                              menu.get('time_info').get('menu_date'), menu.get('url'),
+                              menu.get('sum'), json.dumps(menu)))
+
+    def raw(self, menu_id: str) -> dict:
+        return json.loads(self.db.conn.execute('SELECT doc FROM menus WHERE id = ?',
+                                               (menu_id,)).fetchone()[0])
+
+    def test_old_menus_are_encoded_and_indexed_once(self):
+        menu = make_menu(meals={'Lunch': {'Entree': ['Chicken Teriyaki']}})
+        self.store_plain(menu)
+        self.db.conn.execute('DROP TABLE migrations')
+
+        self.db.migrate()
+
+        self.assertEqual(self.raw('02_2026-10-18').get('encoding'), 'catalog')
+        self.assertEqual(self.db.get_menu('02', '2026-10-18').get('menus'), menu.get('menus'))
+        self.assertEqual([r.get('item') for r in ItemIndex(self.db).search('teriyaki')],
+                         ['Chicken Teriyaki'])
+        self.assertEqual(self.db.get_menu_history('02', '2026-10-18', '2026-10-18'), [])
+
+        # The backfill is only run once.
+        self.store_plain(make_menu(menu_date='2026-10-19'))
+        self.db.migrate()
+        self.assertNotIn('encoding', self.raw('02_2026-10-19'))
+
+    def test_encoded_menus_are_not_rewritten(self):
+        self.db.upsert_menus([make_menu()])
+        version = self.db.export_watermark()
+        self.db.conn.execute('DROP TABLE migrations')
+
+        self.db.migrate()
+
+        self.assertEqual(self.db.export_watermark(), version)
+
+
+if __name__ == '__main__':
+    unittest.main()
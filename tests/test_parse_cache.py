@@ -0,0 +1,82 @@
+import unittest
+from ucrfood.food_sort import FoodSort
+from ucrfood.menu_record import MenuRecord
+from ucrfood.parse_cache import ParseCache
+from ucrfood.parsers import MenuParser
+from tests.test_parsers import fixture_pages
+
+
+def record(item: str) -> MenuRecord:
+    return MenuRecord.from_menus([{'type': 'Lunch', 'content': {'Entree': [item]}}])
+
+
+class PageClient:
+    """
+    Description: stands in for HttpClient, serving the given pages by url.
+    """
+    def __init__(self, pages: dict):
+        self.pages = pages
+
+    def get(self, url: str, deadline: float = None) -> bytes:
+        return self.pages[url]
+
+
+class ParseCacheTest(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = ParseCache()
+        cache.put('a', record('Pizza'))
+        cache.put('empty', None)
+
+        self.assertEqual(cache.get('a'), record('Pizza'))
+        self.assertIsNone(cache.get('empty'))
+        self.assertIs(cache.get('b'), ParseCache.missing)
+
+    def test_least_recently_used_menus_are_evicted(self):
+        size = ParseCache.entry_overhead + record('Pizza').nbytes
+        cache = ParseCache(max_bytes=size * 2)
+
+        cache.put('a', record('Pizza'))
+        cache.put('b', record('Tacos'))
+        cache.get('a')
+        cache.put('c', record('Curry'))
+
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get('b'), ParseCache.missing)
+        self.assertEqual(cache.get('a'), record('Pizza'))
+        self.assertLessEqual(cache.size, cache.max_bytes)
+
+    def test_menus_larger_than_the_cache_are_not_kept(self):
+        cache = ParseCache(max_bytes=ParseCache.entry_overhead)
+        cache.put('a', record('Pizza'))
+
+        self.assertIs(cache.get('a'), ParseCache.missing)
+
+    def test_key_includes_parser_and_encoding(self):
+        page = fixture_pages()[0]
+        other_charset = page.replace(b'charset=iso-8859-1', b'charset=utf-8')
+        keys = {ParseCache.key('sum', parser, MenuParser.page_encoding(p))
+                for parser in ('lxml', 'soup') for p in (page, other_charset)}
+
+        self.assertEqual(len(keys), 4)
+        self.assertEqual(ParseCache.key('sum', 'lxml', MenuParser.page_encoding(page)),
+                         'lxml:iso-8859-1:sum')
+
+    def test_page_with_another_charset_is_parsed_again(self):
+        page = fixture_pages()[0]
+        pages = {'a': page,
+                 'b': page,
+                 'c': page.replace(b'charset=iso-8859-1', b'charset=utf-8')}
+        cache = ParseCache()
+
+        sort = FoodSort(list(pages), fetch_workers=1, http_client=PageClient(pages),
+                        parse_cache=cache)
+        sort.get_menus()
+
+        # The first two pages share a parse; the third has the same menu tables but a different
+        # encoding.
+        self.assertEqual(len(sort.menus), 3)
+        self.assertEqual(len(cache), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import re
+import unittest
+from ucrfood.parsers import SoupParser, LxmlParser, get_parser
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'benchmarks', 'fixtures')
+
+
+def fixture_pages() -> list:
+    """Returns the raw bytes of every recorded menu page.
+
+    :return: list of pages.
+    """
+    return [open(os.path.join(FIXTURE_DIR, f), 'rb').read()
+            for f in sorted(os.listdir(FIXTURE_DIR)) if f.endswith('.html')]
+
+
+def without_charset(page: bytes, meal: str, encoding: str) -> bytes:
+    """Removes the charset declaration of a fixture page, renames its first meal and encodes it
+    with the given encoding.
+
+    :param page: raw bytes of a fixture page.
+    :param meal: new name of the first meal.
+    :param encoding: encoding of the returned page.
+    :return: page.
+    """
+    text = re.sub(r'<meta[^>]*charset[^>]*>', '', page.decode('iso-8859-1'), flags=re.IGNORECASE)
+    text = text.replace('Breakfast', meal, 1)
+
+    return text.encode(encoding)
+
+
+class ParserParityTest(unittest.TestCase):
+    def assert_parity(self, page: bytes) -> list:
+        expected = SoupParser().parse(page)
+        self.assertEqual(LxmlParser().parse(page), expected)
+
+        return expected
+
+    def test_fixtures(self):
+        for page in fixture_pages():
+            self.assertTrue(self.assert_parity(page))
+
+    def test_utf8_page_without_charset(self):
+        menus = self.assert_parity(without_charset(fixture_pages()[0], 'Café Hot Breakfast',
+                                                   'utf-8'))
+        self.assertEqual(menus[0].get('type'), 'Café Hot Breakfast')
+
+    def test_windows_1252_page_without_charset(self):
+        menus = self.assert_parity(without_charset(fixture_pages()[0], 'Café – Breakfast',
+                                                   'windows-1252'))
+        self.assertEqual(menus[0].get('type'), 'Café – Breakfast')
+
+    def test_page_without_menus(self):
+        for parser in (SoupParser(), LxmlParser()):
+            self.assertIsNone(parser.parse(b'<html><body><p>Closed</p></body></html>'))
+
+    def test_parse_record_round_trips(self):
+        parser = get_parser('lxml')
+
+        for page in fixture_pages():
+            self.assertEqual(parser.parse_record(page).to_menus(), parser.parse(page))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            get_parser('regex')
+
+
+if __name__ == '__main__':
+    unittest.main()
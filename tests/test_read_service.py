@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import unittest
+from threading import Thread
+from urllib.error import HTTPError
+from urllib.request import urlopen
+from read_service import ReadService
+from tests.support import make_menu, SQLiteTestCase
+
+
+class ReadServiceTest(SQLiteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db_conf = db_conf = os.path.join(self.directory, 'db.ini')
+        self.read_conf = read_conf = os.path.join(self.directory, 'read.ini')
+
+        with open(db_conf, 'w') as f:
+            f.write('[STORAGE]\nBackend = sqlite\nPath = {0}\n\n[DB_INFO]\nDBUsername = test\n\n'
+                    '[CONNECTION]\nHost = 127.0.0.1\nPort = 0\n\n[AUTH]\nDBPassword =\n'.format(
+                        self.db.path))
+
+        with open(read_conf, 'w') as f:
+            f.write('[READ]\nHost = 127.0.0.1\nPort = 0\nMaxRangeDays = 31\n')
+
+        self.db.upsert_menus([make_menu(menu_date='2026-10-18'),
+                              make_menu(menu_date='2026-10-19')])
+
+        self.service = ReadService(db_conf=db_conf, read_conf=read_conf)
+        self.thread = Thread(target=self.service.serve, daemon=True)
+        self.thread.start()
+
+        # Menus are cached once the change feed is up.
+        self.wait_for(lambda: self.service.get_menu('02', '2026-10-18') and len(self.service.cache))
+        self.wait_for(lambda: self.service._ReadService__server)
+
+    def tearDown(self):
+        self.service.stop()
+        self.thread.join(5)
+        super().tearDown()
+
+    @staticmethod
+    def wait_for(condition, timeout: float = 5):
+        deadline = time.time() + timeout
+
+        while not condition():
+            if time.time() > deadline:
+                raise AssertionError('Timed out.')
+
+            time.sleep(0.01)
+
+    def get(self, path: str) -> tuple:
+        host, port = self.service._ReadService__server.server_address
+
+        try:
+            with urlopen('http://{0}:{1}{2}'.format(host, port, path), timeout=5) as response:
+                return response.status, json.loads(response.read().decode('utf-8'))
+        except HTTPError as e:
+            return e.code, json.loads(e.read().decode('utf-8'))
+
+    def test_database_is_migrated_at_startup(self):
+        self.db.conn.execute('DROP TABLE migrations')
+
+        service = ReadService(db_conf=self.db_conf, read_conf=self.read_conf)
+        service.stop()
+
+        self.assertTrue(self.db.conn.execute('SELECT COUNT(*) FROM migrations').fetchone()[0])
+
+    def test_changed_menu_is_dropped_from_cache(self):
+        changed = make_menu(menu_date='2026-10-18', meals={'Lunch': {'Entree': ['Curry']}})
+        self.db.upsert_menus([changed])
+
+        self.wait_for(lambda: self.service.get_menu('02', '2026-10-18').get('menus') ==
+                      changed.get('menus'))
+
+    def test_new_menu_replaces_cached_missing_menu(self):
+        self.assertEqual(len(self.service.get_menus('02', '2026-10-18', '2026-10-20')), 2)
+
+        self.db.upsert_menus([make_menu(menu_date='2026-10-20')])
+
+        self.wait_for(lambda: len(self.service.get_menus('02', '2026-10-18', '2026-10-20')) == 3)
+
+    def test_menus_endpoint(self):
+        status, menus = self.get('/menus/02?start=2026-10-18&end=2026-10-19')
+
+        self.assertEqual(status, 200)
+        self.assertEqual([m.get('time_info').get('menu_date') for m in menus],
+                         ['2026-10-18', '2026-10-19'])
+        self.assertEqual(self.get('/menus/02/2026-10-21')[0], 404)
+
+    def test_malformed_dates_are_rejected(self):
+        for path in ('/menus/02?start=2026-10&end=2026-10-19', '/menus/02?start=x',
+                     '/history/02?end=2026-13-01', '/search?q=pizza&start=2026-10'):
+            status, body = self.get(path)
+            self.assertEqual(status, 400, path)
+            self.assertEqual(body, {'error': 'Dates must be formatted as YYYY-MM-DD.'})
+
+    def test_long_date_ranges_are_rejected(self):
+        status, body = self.get('/menus/02?start=2026-01-01&end=2026-12-31')
+
+        self.assertEqual(status, 400)
+        self.assertEqual(body, {'error': 'Date ranges can span at most 31 days.'})
+        self.assertEqual(self.get('/menus/02?start=2026-10-01&end=2026-10-31')[0], 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
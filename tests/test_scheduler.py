@@ -0,0 +1,97 @@
+import unittest
+from ucrfood.scheduler import RefreshScheduler
+
+
+class RefreshSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        # No jitter, so refresh times are exact.
+        self.scheduler = RefreshScheduler(near_interval=3600, far_interval=86400, near_days=1,
+                                          max_backoff=4, jitter=0, retry_interval=60)
+        self.now = 1000000.0
+
+    def test_pages_without_state_are_due(self):
+        entries = [('a', 0), ('b', 5)]
+
+        self.assertEqual(self.scheduler.due(entries, now=self.now), entries)
+        self.assertEqual(self.scheduler.seconds_until_next(entries, now=self.now), 0)
+
+    def test_recorded_page_is_due_after_its_interval(self):
+        entries = [('a', 0)]
+        self.scheduler.record('a', changed=True, now=self.now)
+
+        self.assertEqual(self.scheduler.due(entries, now=self.now + 3599), [])
+        self.assertEqual(self.scheduler.due(entries, now=self.now + 3600), entries)
+
+    def test_unchanged_pages_are_backed_off(self):
+        entries = [('a', 0)]
+        waits = []
+
+        for changed in (True, False, False, False, True):
+            self.scheduler.record('a', changed=changed, now=self.now)
+            waits.append(self.scheduler.seconds_until_next(entries, now=self.now))
+
+        # Doubled for every unchanged fetch up to max_backoff, and reset by a change.
+        self.assertEqual(waits, [3600, 7200, 14400, 14400, 3600])
+
+    def test_later_dates_are_refreshed_less_often(self):
+        for url in ('tomorrow', 'in 3 days', 'in 10 days'):
+            self.scheduler.record(url, changed=True, now=self.now)
+
+        self.assertEqual(self.scheduler.seconds_until_next([('tomorrow', 1)], now=self.now), 3600)
+        self.assertEqual(self.scheduler.seconds_until_next([('in 3 days', 3)], now=self.now),
+                         14400)
+        self.assertEqual(self.scheduler.seconds_until_next([('in 10 days', 10)], now=self.now),
+                         86400)
+
+    def test_seconds_until_next_is_the_earliest_page(self):
+        self.scheduler.record('a', changed=True, now=self.now)
+        self.scheduler.record('b', changed=True, now=self.now - 600)
+
+        self.assertEqual(self.scheduler.seconds_until_next([('a', 0), ('b', 0)], now=self.now),
+                         3000)
+        self.assertEqual(self.scheduler.seconds_until_next([], now=self.now), 86400)
+
+    def test_pages_leaving_the_block_are_forgotten(self):
+        self.scheduler.record('a', changed=True, now=self.now)
+        self.scheduler.due([('b', 0)], now=self.now)
+
+        self.assertEqual(self.scheduler.due([('a', 0)], now=self.now), [('a', 0)])
+
+    def test_jitter_stays_within_bounds(self):
+        scheduler = RefreshScheduler(near_interval=3600, jitter=0.1)
+
+        for _ in range(50):
+            scheduler.record('a', changed=True, now=self.now)
+            self.assertTrue(3240 <= scheduler.seconds_until_next([('a', 0)], now=self.now) <= 3960)
+
+    def test_failing_url_is_backed_off(self):
+        entries = [('gone', 0)]
+        waits = []
+
+        for _ in range(12):
+            self.assertEqual(self.scheduler.due(entries, now=self.now), entries)
+            self.scheduler.record_failure('gone', now=self.now)
+
+            waits.append(self.scheduler.seconds_until_next(entries, now=self.now))
+            self.assertEqual(self.scheduler.due(entries, now=self.now), [])
+            self.now += waits[-1]
+
+        # Doubled after every failure, up to the longest interval.
+        self.assertEqual(waits[:4], [60, 120, 240, 480])
+        self.assertEqual(waits[-1], 86400)
+
+    def test_success_after_failures_resets_backoff(self):
+        entries = [('flaky', 0)]
+
+        for _ in range(3):
+            self.scheduler.record_failure('flaky', now=self.now)
+
+        self.scheduler.record('flaky', changed=True, now=self.now)
+        self.assertEqual(self.scheduler.seconds_until_next(entries, now=self.now), 3600)
+
+        self.scheduler.record_failure('flaky', now=self.now)
+        self.assertEqual(self.scheduler.seconds_until_next(entries, now=self.now), 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
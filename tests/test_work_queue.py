@@ -0,0 +1,73 @@
+import time
+import unittest
+from ucrfood.work_queue import WorkQueue
+from tests.support import SQLiteTestCase
+
+
+class WorkQueueTest(SQLiteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other_db = self.open_database()
+        self.first = WorkQueue(self.db, worker_id='first', lease_seconds=60, batch_size=2,
+                               max_attempts=2)
+        self.second = WorkQueue(self.other_db, worker_id='second', lease_seconds=60, batch_size=2,
+                                max_attempts=2)
+
+    def tearDown(self):
+        self.other_db.disconnect()
+        super().tearDown()
+
+    def test_enqueue_skips_queued_urls(self):
+        self.assertEqual(self.first.enqueue([('a', 0), ('b', 1)]), 2)
+        self.assertEqual(self.first.enqueue([('a', 0), ('c', 2)]), 1)
+        self.assertEqual(self.first.remaining(), 3)
+
+    def test_leased_urls_are_not_claimed_twice(self):
+        self.first.enqueue([('a', 0), ('b', 0), ('c', 0)])
+
+        claimed = self.first.claim()
+        others = self.second.claim()
+
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual([i.get('url') for i in others],
+                         [u for u in 'abc' if u not in {i.get('url') for i in claimed}])
+        self.assertEqual(self.second.claim(), [])
+
+    def test_expired_lease_is_claimed_again(self):
+        self.first.lease_seconds = 0
+        self.first.enqueue([('a', 0)])
+        item, = self.first.claim()
+
+        time.sleep(0.01)
+        again, = self.second.claim()
+        self.assertEqual(again.get('attempts'), 2)
+
+        # The first worker no longer holds the lease, so it can neither renew nor release it.
+        self.first.renew([item])
+        self.first.release([item])
+        self.assertEqual(self.second.claim(), [])
+        self.assertEqual(self.first.remaining(), 1)
+
+        self.second.release([again])
+        self.assertEqual(self.first.remaining(), 0)
+
+    def test_exhausted_urls(self):
+        self.first.lease_seconds = 0
+        self.first.enqueue([('a', 0)])
+
+        self.assertEqual(self.first.exhausted(self.first.claim()), [])
+        time.sleep(0.01)
+        self.assertEqual([i.get('url') for i in self.first.exhausted(self.first.claim())], ['a'])
+
+    def test_migrate_adds_attempts_to_old_queue(self):
+        self.db.conn.execute('DROP TABLE work_queue')
+        self.db.conn.execute('CREATE TABLE work_queue (id TEXT PRIMARY KEY, url TEXT NOT NULL, '
+                             'day INTEGER, owner TEXT, lease_until REAL NOT NULL)')
+        self.db.conn.execute("INSERT INTO work_queue VALUES ('x', 'a', 0, NULL, 0)")
+        self.db.migrate()
+
+        self.assertEqual(self.first.claim()[0].get('attempts'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,48 @@
-from ucrfood.config import Config
-from ucrfood.db import Database
-from ucrfood.food_sort import FoodSort
+from importlib import import_module
+
+# Public classes and the modules they live in. Modules are imported the first time one of their
+# classes is used, so short commands don't pay for parser, HTTP and database libraries they never
+# touch.
+_exports = {
+    'Config': 'ucrfood.config',
+    'Database': 'ucrfood.storage',
+    'RethinkDatabase': 'ucrfood.db',
+    'SQLiteDatabase': 'ucrfood.sqlite_db',
+    'FoodSort': 'ucrfood.food_sort',
+    'HostLimiter': 'ucrfood.host_limiter',
+    'HttpClient': 'ucrfood.http_client',
+    'ParseCache': 'ucrfood.parse_cache',
+    'MenuRecord': 'ucrfood.menu_record',
+    'Profiler': 'ucrfood.profiler',
+    'MenuExporter': 'ucrfood.export',
+    'RefreshScheduler': 'ucrfood.scheduler',
+    'WorkQueue': 'ucrfood.work_queue',
+    'Metrics': 'ucrfood.metrics',
+    'MetricsServer': 'ucrfood.metrics',
+    'MenuCache': 'ucrfood.menu_cache',
+    'ItemIndex': 'ucrfood.search',
+    'ItemCatalog': 'ucrfood.catalog'
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name: str):
+    """Imports the module of a public class when the class is first used.
+
+    :param name: name of the class.
+    :return: the class.
+    """
+    if name not in _exports:
+        raise AttributeError("module 'ucrfood' has no attribute '{0}'".format(name))
+
+    value = getattr(import_module(_exports[name]), name)
+
+    # Later lookups find the class directly.
+    globals()[name] = value
+
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
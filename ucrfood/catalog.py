@@ -0,0 +1,125 @@
+from threading import Lock
+
+
+class ItemCatalog:
+    """
+    Description: dictionary encoding of menus. The same few hundred dish, section and meal names
+    recur across every date and location, so menus are stored with small integer IDs in place of
+    their text, and the text is stored once in the 'catalog' table. IDs are handed out by the
+    database and never change once given, so they can be cached for as long as the process runs.
+    Methods:
+    - missing_texts : returns the texts of menus that have no known ID yet.
+    - unknown_ids : returns the IDs of encoded menus that have no known text yet.
+    - learn : adds catalog entries that are stored in the database.
+    - encode : replaces the text in a list of menus with IDs.
+    - decode : replaces the IDs in a list of encoded menus with text.
+    """
+    # Value of the 'encoding' field of encoded menu documents.
+    name = 'catalog'
+
+    def __init__(self):
+        # Every entry seen so far, in both directions; shared between threads.
+        self.__ids = {}
+        self.__texts = {}
+        self.__lock = Lock()
+
+    @staticmethod
+    def __menu_texts(menus: list) -> set:
+        """Returns every meal, section and item name of a list of menus.
+
+        :param menus: list of {'type': meal, 'content': {section: [item, ...]}} dicts.
+        :return: set of names.
+        """
+        texts = set()
+
+        for meal in menus or []:
+            texts.add(meal.get('type'))
+
+            for section, items in meal.get('content').items():
+                texts.add(section)
+                texts.update(items)
+
+        return texts
+
+    @staticmethod
+    def __menu_ids(encoded_menus: list) -> set:
+        """Returns every ID used by a list of encoded menus.
+
+        :param encoded_menus: menus as returned by encode.
+        :return: set of IDs.
+        """
+        ids = set()
+
+        for meal in encoded_menus or []:
+            ids.add(meal.get('type'))
+
+            for section_id, item_ids in meal.get('content'):
+                ids.add(section_id)
+                ids.update(item_ids)
+
+        return ids
+
+    def missing_texts(self, menus: list) -> set:
+        """Returns the texts of a list of menus that have to be looked up or given an ID before
+        the menus can be encoded.
+
+        :param menus: list of {'type': meal, 'content': {section: [item, ...]}} dicts.
+        :return: set of texts.
+        """
+        texts = self.__menu_texts(menus)
+
+        with self.__lock:
+            return {t for t in texts if t not in self.__ids}
+
+    def unknown_ids(self, encoded_menus: list) -> set:
+        """Returns the IDs of a list of encoded menus that have to be looked up before the menus
+        can be decoded.
+
+        :param encoded_menus: menus as returned by encode.
+        :return: set of IDs.
+        """
+        ids = self.__menu_ids(encoded_menus)
+
+        with self.__lock:
+            return {i for i in ids if i not in self.__texts}
+
+    def learn(self, entries):
+        """Adds catalog entries that are stored in the database.
+
+        :param entries: iterable of {'id', 'text'} dicts.
+        """
+        with self.__lock:
+            for entry in entries:
+                self.__ids.setdefault(entry.get('text'), entry.get('id'))
+                self.__texts[entry.get('id')] = entry.get('text')
+
+    def encode(self, menus: list) -> list:
+        """Replaces the text in a list of menus (as created by FoodSort) with IDs. Every text
+        must be known; see missing_texts. Sections become [section ID, item IDs] pairs, so their
+        order is kept.
+
+        :param menus: list of {'type': meal, 'content': {section: [item, ...]}} dicts.
+        :return: list of {'type': meal ID, 'content': [[section ID, [item ID, ...]], ...]} dicts.
+        """
+        with self.__lock:
+            ids = self.__ids
+
+            return [{'type': ids[meal.get('type')],
+                     'content': [[ids[section], [ids[i] for i in items]]
+                                 for section, items in meal.get('content').items()]}
+                    for meal in menus or []]
+
+    def decode(self, encoded_menus: list) -> list:
+        """Replaces the IDs of encoded menus with their text. Every ID must be known; see
+        unknown_ids.
+
+        :param encoded_menus: menus as returned by encode.
+        :return: menus as created by FoodSort.
+        """
+        with self.__lock:
+            texts = self.__texts
+
+            return [{'type': texts[meal.get('type')],
+                     'content': {texts[section_id]: [texts[i] for i in item_ids]
+                                 for section_id, item_ids in meal.get('content')}}
+                    for meal in encoded_menus or []]
@@ -1,5 +1,7 @@
 import configparser
+import os
 import os.path as path
+from threading import Lock
 from collections import OrderedDict
 
 
@@ -10,19 +12,60 @@ class Config:
     - _check_against_config : reads configuration file and performs various tests on file.
     - construct_url : creates the urls needed for other classes based on constructs in configuration
     file.
+    - clear_cache : forgets every parsed configuration file.
     """
+    # Parsed configuration files shared by every instance: {path: ((mtime, size), ConfigParser)}.
+    # A file is parsed again once it changes on disk.
+    __cache = {}
+    __cache_lock = Lock()
+
     def __init__(self, filename: str, config_dir: str = './config'):
         # Initialize class variables:
         self.config_file_path = path.abspath(path.join(config_dir, filename))
         self.config_file = filename
-        self.config = configparser.ConfigParser()
 
         # Read configuration file:
-        self.config.read(self.config_file_path)
+        self.config = self.__read(self.config_file_path)
 
         # Config dict:
         self.__config_dict = None
 
+    @classmethod
+    def __read(cls, file_path: str) -> configparser.ConfigParser:
+        """Returns the parsed configuration file, parsing it only if it wasn't parsed before or
+        changed since. Missing files give an empty parser, like ConfigParser.read does.
+
+        :param file_path: absolute path of the configuration file.
+        :return: ConfigParser.
+        """
+        try:
+            stat = os.stat(file_path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamp = None
+
+        with cls.__cache_lock:
+            cached = cls.__cache.get(file_path)
+
+            if cached and stamp and cached[0] == stamp:
+                return cached[1]
+
+        config = configparser.ConfigParser()
+        config.read(file_path)
+
+        if stamp:
+            with cls.__cache_lock:
+                cls.__cache[file_path] = (stamp, config)
+
+        return config
+
+    @classmethod
+    def clear_cache(cls):
+        """Forgets every parsed configuration file, so the next instance reads its file again.
+        """
+        with cls.__cache_lock:
+            cls.__cache.clear()
+
     def __check_against_config(self, params: list):
         """
         :param params: list of parameters to check exist in configuration file.
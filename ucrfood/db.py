@@ -1,8 +1,62 @@
 import rethinkdb as r
-from datetime import datetime, timedelta
+from time import perf_counter
+from hashlib import sha1
+from datetime import date, datetime, timedelta
+from itertools import islice
+from ucrfood.storage import Database, rows_written_total
 
 
-class Database:
+class RethinkDatabase(Database):
+    """
+    Description: storage on a RethinkDB server. Every call is a round trip over the network, and
+    changed menus are pushed through a changefeed. Stored menus are updated in place with only the
+    fields and meals that changed, so less is sent over the network and written to the feed.
+    """
+    name = 'rethinkdb'
+
+    # Tables and their secondary indexes, created once by migrate().
+    schema = {
+        'menus': {
+            'menu_date': lambda m: m['time_info']['menu_date'],
+            'location_date': lambda m: [m['location']['num'], m['time_info']['menu_date']]
+        },
+        # What changed in every menu, appended whenever its items change (see ucrfood.menu_diff).
+        'menu_history': {
+            'location_date': lambda h: [h['location'], h['menu_date'], h['changed_at']]
+        },
+        # Postings of the menu item search index (see ucrfood.search).
+        'items': {
+            'token': lambda p: p['token'],
+            'token_date': lambda p: [p['token'], p['menu_date']],
+            'menu_id': lambda p: p['menu_id']
+        },
+        # Text of the meal, section and item IDs of encoded menus (see ucrfood.catalog).
+        'catalog': {},
+        # ID of every catalog text, keyed by a digest of the text. Primary keys are unique, so two
+        # writers adding the same text end up with the same ID.
+        'catalog_text': {},
+        # Counters handing out IDs, e.g. the next free catalog ID.
+        'counters': {},
+        # Urls waiting to be crawled by distributed workers (see ucrfood.work_queue).
+        'work_queue': {
+            'lease_until': lambda w: w['lease_until']
+        },
+        # One-time data migrations that have been run (see Database._migrate_data).
+        'migrations': {}
+    }
+
+    # Secondary indexes created by earlier versions that nothing queries any more; migrate()
+    # drops them so writes don't keep paying for them.
+    dropped_indexes = {
+        'menus': ['written_at'],
+        'catalog': ['text']
+    }
+
+    # Menus are stamped with the server time their write started at, so a write still in flight
+    # when an export starts can carry an earlier stamp than the export's watermark. Watermarks are
+    # kept this many seconds behind the server time, which is far longer than any write takes.
+    write_grace_seconds = 60
+
     def __init__(self, port: int, uname: str, db_pass: str = None, host: str = None):
         """Initializes class variables and generates the connection to the database.
 
@@ -21,63 +75,262 @@ class Database:
         self.db_password = db_pass
         self.database = 'ucrfood'
 
-        # List of unique indices that were created:
-        self.indices = set()
+        super().__init__()
 
         # Connections:
         self.conn = None
         self.__connect()
 
     def __connect(self):
-        """Connects to RethinkDB server. If no database password is provided, then connect without
-        authentication.
+        """Connects to RethinkDB server.
+        """
+        self.conn = self.__new_connection()
+
+    def __new_connection(self):
+        """Opens a new connection to the RethinkDB server. If no database password is provided,
+        then connect without authentication.
+
+        :return: connection.
         """
 
         if not self.db_password:
-            self.conn = r.connect(self.host,
-                                  self.port,
-                                  self.database,
-                                  self.db_username)
+            return r.connect(self.host,
+                             self.port,
+                             self.database,
+                             self.db_username)
         else:
-            self.conn = r.connect(self.host,
-                                  self.port,
-                                  self.database,
-                                  self.db_username,
-                                  self.db_password)
+            return r.connect(self.host,
+                             self.port,
+                             self.database,
+                             self.db_username,
+                             self.db_password)
+
+    def __run(self, query, operation: str):
+        """Runs a query and records how long the round trip took.
+
+        :param query: ReQL query to run.
+        :param operation: name of the operation, used as metric label.
+        :return: result of the query.
+        """
+        start = perf_counter()
+
+        try:
+            return query.run(self.conn)
+        finally:
+            self._timed(operation, start)
+
+    def migrate(self):
+        """Creates the database, every table and every secondary index in the schema if they don't
+        exist yet, then waits for the indexes to be ready. Menus with the old date format are
+        moved first, then the data migrations that haven't been run are run.
+        """
+        if self.database not in r.db_list().run(self.conn):
+            r.db_create(self.database).run(self.conn)
+
+        db = r.db(self.database)
+        tables = db.table_list().run(self.conn)
 
-    def __generate_index(self, index_name: str) -> bool:
-        """Creates an index with a given index to represent the menu_date nested index.
+        for table, indexes in self.schema.items():
+            if table not in tables:
+                db.table_create(table).run(self.conn)
 
-        todo: make this work for creating any index.
+                if table == 'catalog_text':
+                    self.__migrate_catalog_text()
 
-        :param index_name: name for the secondary index to generate.
-        :return: whether or not the operation completed successfully.
+            existing = db.table(table).index_list().run(self.conn)
+
+            for index_name, index_func in indexes.items():
+                if index_name not in existing:
+                    db.table(table).index_create(index_name, index_func).run(self.conn)
+
+            for index_name in self.dropped_indexes.get(table, []):
+                if index_name in existing:
+                    db.table(table).index_drop(index_name).run(self.conn)
+
+            db.table(table).index_wait().run(self.conn)
+
+        self.__migrate_menu_dates()
+        self._migrate_data()
+
+    def _finished_migrations(self) -> set:
+        """Returns the names of the data migrations that have been run.
+
+        :return: set of names.
         """
+        return set(self.__run(r.table('migrations')['id'].coerce_to('array'), 'migrations'))
+
+    def _finish_migration(self, name: str):
+        """Records that a data migration has been run.
+
+        :param name: name of the migration.
+        """
+        self.__run(r.table('migrations').insert({'id': name, 'finished_at': r.now()},
+                                                conflict='replace'), 'migrations')
+
+    def __migrate_menu_dates(self, chunk_size: int = 200):
+        """Converts menus stored with the old mm-dd-yyyy menu_date to ISO 8601 dates and gives
+        them their deterministic primary key. Old dates start with a month ('0' or '1') while ISO
+        dates start with the year, so the old menus are found with the menu_date index instead of
+        scanning the table. Menus whose date can't be read are logged and left as they are, so
+        they don't stop every command from starting.
+
+        :param chunk_size: maximum number of menus moved in a single round trip.
+        """
+        # Moved menus leave the scanned range, so a single pass over it finds every old menu.
+        cursor = r.table('menus').between(r.minval, '2', index='menu_date').run(self.conn)
+
         try:
-            # If the index doesn't exist, create it.
-            if index_name not in r.table('menus').index_list().run(self.conn):
-                r.table('menus')\
-                    .index_create(index_name, r.row['time_info']['menu_date'])\
-                    .run(self.conn)
+            while True:
+                legacy = list(islice(cursor, chunk_size))
+
+                if not legacy:
+                    break
+
+                migrated, old_keys = [], []
 
-            # Check to see if the index is ready. If it is, add to indices set and return true.
-            if r.table('menus').index_wait(index_name).run(self.conn)[0].get('ready'):
-                self.indices.add(index_name)
-                return True
-            else:
-                return False
-        except r.errors.ReqlOpFailedError as e:
-            # If some sort of operation failed, print the error to the console and return false.
-            print(e)
-            return False
+                for menu in legacy:
+                    old_date = (menu.get('time_info') or {}).get('menu_date')
 
-    def add_menu_data(self, menu: dict):
-        """Method for inserting menu into 'menus' table.
+                    try:
+                        month, day, year = old_date.split('-')
+                        menu_date = date(int(year), int(month), int(day)).isoformat()
+                    except (AttributeError, TypeError, ValueError):
+                        print('Skipping menu {0} with unreadable date {1!r}.'.format(
+                            menu.get('id'), old_date))
+                        continue
 
-        :param menu: menu to insert into the table.
+                    old_keys.append(menu.get('id'))
+                    menu['time_info']['menu_date'] = menu_date
+                    migrated.append(self._with_key(menu))
+
+                if not migrated:
+                    continue
+
+                # Keep whichever copy already exists under the new key.
+                r.table('menus').insert(migrated,
+                                        conflict=lambda key, old, new: old).run(self.conn)
+                r.table('menus').get_all(*old_keys).delete().run(self.conn)
+        finally:
+            cursor.close()
+
+    def __migrate_catalog_text(self, chunk_size: int = 1000):
+        """Fills the 'catalog_text' table from catalog entries written before it existed. If a
+        text was given more than one ID, the lowest one is kept for new menus; menus already
+        encoded with the others still decode.
+
+        :param chunk_size: maximum number of entries written in a single round trip.
+        """
+        entries = list(r.table('catalog').run(self.conn))
+
+        for i in range(0, len(entries), chunk_size):
+            r.table('catalog_text').insert(
+                [{'id': self.__text_key(e.get('text')), 'text': e.get('text'), 'num': e.get('id')}
+                 for e in entries[i:i + chunk_size]],
+                conflict=lambda key, old, new: r.branch(old['num'] < new['num'], old, new)
+            ).run(self.conn)
+
+    @staticmethod
+    def __text_key(text: str) -> str:
+        """Returns the primary key of a text in the 'catalog_text' table. Primary keys are
+        limited to 127 bytes, so a digest of the text is used.
+
+        :param text: meal, section or item name.
+        :return: hex digest.
+        """
+        return sha1(text.encode('utf-8')).hexdigest()
+
+    def _catalog_ids(self, texts: set) -> list:
+        """Looks up the catalog IDs of the given texts and gives the texts that are not in the
+        catalog yet a new ID. IDs are reserved in blocks with a single atomic update of the
+        'catalog' counter, so concurrent writers never hand out the same ID twice. The text of
+        the new IDs is written before they are claimed in 'catalog_text'; if another writer
+        claimed a text first, its ID is used instead and the reserved one is left unused.
+
+        :param texts: meal, section and item names.
+        :return: list of {'id', 'text'} dicts.
+        """
+        keys = {self.__text_key(t): t for t in texts}
+        found = [{'id': e.get('num'), 'text': e.get('text')} for e in
+                 self.__run(r.table('catalog_text').get_all(*keys), 'get_catalog')]
+        new = sorted(texts.difference(e.get('text') for e in found))
+
+        if not new:
+            return found
+
+        result = self.__run(r.table('counters').get('catalog').replace(
+            lambda c: {'id': 'catalog', 'next': r.branch(c.eq(None), 1, c['next']) + len(new)},
+            return_changes=True), 'reserve_catalog')
+        first = result.get('changes')[0].get('new_val').get('next') - len(new)
+
+        entries = [{'id': first + i, 'text': text} for i, text in enumerate(new)]
+        self.__run(r.table('catalog').insert(entries), 'insert_catalog')
+
+        # Claim the texts, keeping whichever ID was claimed first.
+        result = self.__run(r.table('catalog_text').insert(
+            [{'id': self.__text_key(e.get('text')), 'text': e.get('text'), 'num': e.get('id')}
+             for e in entries],
+            conflict=lambda key, old, new: old, return_changes='always'), 'claim_catalog')
+
+        return found + [{'id': c.get('new_val').get('num'), 'text': c.get('new_val').get('text')}
+                        for c in result.get('changes')]
+
+    def _catalog_texts(self, ids: set) -> list:
+        """Returns the catalog entries with the given IDs.
+
+        :param ids: catalog IDs.
+        :return: list of {'id', 'text'} dicts.
         """
+        return list(self.__run(r.table('catalog').get_all(*ids), 'get_catalog'))
+
+    def upsert_menus(self, menus: list, chunk_size: int = 200) -> int:
+        """Inserts new menus and updates stored ones with what changed, recording the changes in
+        the menu history. Every chunk takes one round trip to read the stored menus, and one each
+        for the inserts, the updates and the history. Changed meals are replaced in place with
+        change_at, so unchanged meals are never sent. Every url is crawled by one worker at a
+        time, so stored menus don't change between being read and being updated.
+
+        :param menus: menus to write to the 'menus' table.
+        :param chunk_size: maximum number of menus sent in a single query.
+        :return: number of menus written.
+        """
+        written = 0
+
+        for i in range(0, len(menus), chunk_size):
+            chunk = menus[i:i + chunk_size]
+            keys = [self._with_key(m).get('id') for m in chunk]
+            stored = {m.get('id'): m for m in self.__run(r.table('menus').get_all(*keys),
+                                                          'get_stored')}
+            inserts, updates, history = self._deltas(chunk, stored)
 
-        r.table('menus').insert(menu).run(self.conn)
+            # Server time of the write, used as export watermark.
+            inserts = [dict(m, written_at=r.now()) for m in inserts]
+
+            if inserts:
+                result = self.__run(r.table('menus').insert(inserts, conflict='replace'), 'insert')
+                written += result.get('inserted', 0) + result.get('replaced', 0)
+
+            # Menus that didn't change at all keep their write time.
+            deltas = [{'id': doc.get('id'),
+                       'fields': dict(fields, written_at=r.now()),
+                       'patches': patches} for doc, fields, patches in updates if fields or patches]
+            written += len(updates) - len(deltas)
+
+            if deltas:
+                # Patch the stored list of meals, then merge in the changed fields (which replace
+                # the whole list if its meals changed).
+                result = self.__run(r.expr(deltas).for_each(
+                    lambda d: r.table('menus').get(d['id']).update(
+                        lambda m: r.expr({'menus': d['patches'].fold(
+                            m['menus'], lambda meals, p: meals.change_at(p[0], p[1]))})
+                        .merge(d['fields']))), 'update')
+                written += result.get('replaced', 0) + result.get('unchanged', 0)
+
+            if history:
+                self.__run(r.table('menu_history').insert(history), 'insert_history')
+
+        rows_written_total.inc(written)
+
+        return written
 
     def update_menu_on_date(self, date: str, menu: dict):
         """Replace menu for specific date in 'menus' table.
@@ -85,10 +338,135 @@ class Database:
         :param date: date to replace menu entry on.
         :param menu: menu to replace with.
         """
-        if not self.__generate_index('time_date'):
-            pass
+        key = self.menu_key(menu.get('location').get('num'), date)
+        menu = self._encode([menu])[0]
+
+        self.__run(r.table('menus').get(key).replace(dict(menu, id=key, written_at=r.now())),
+                   'replace')
+        rows_written_total.inc()
 
-        r.table('menus').filter({'time_date': date}).replace(menu).run(self.conn)
+    def get_menu_history(self, location_num: str, start_date: str, end_date: str) -> list:
+        """Returns the changes to the menus of a location between two dates (both included).
+
+        :param location_num: location number of the dining hall.
+        :param start_date: ISO 8601 date of the first menu.
+        :param end_date: ISO 8601 date of the last menu.
+        :return: list of history documents, by menu date and then in the order they were made.
+        """
+        return list(self.__run(r.table('menu_history')
+                               .between([location_num, start_date, r.minval],
+                                        [location_num, end_date, r.maxval],
+                                        index='location_date')
+                               .order_by(index='location_date'), 'history'))
+
+    def replace_item_postings(self, menu_ids: list, postings: list, chunk_size: int = 1000):
+        """Replaces every search index posting of the given menus.
+
+        :param menu_ids: primary keys of the menus whose postings are replaced.
+        :param postings: new postings for those menus.
+        :param chunk_size: maximum number of postings sent in a single insert.
+        """
+        if menu_ids:
+            self.__run(r.table('items').get_all(*menu_ids, index='menu_id').delete(),
+                       'delete_postings')
+
+        for i in range(0, len(postings), chunk_size):
+            self.__run(r.table('items').insert(postings[i:i + chunk_size], conflict='replace'),
+                       'insert_postings')
+
+    def find_item_postings(self, token: str, prefix: bool = False, start_date: str = None,
+                           end_date: str = None) -> list:
+        """Returns the search index postings of a token.
+
+        :param token: normalized token to look up.
+        :param prefix: if true, return postings of every token starting with the given one.
+        :param start_date: (optional) ISO 8601 date of the earliest menu to include.
+        :param end_date: (optional) ISO 8601 date of the latest menu to include.
+        :return: list of postings.
+        """
+        if not prefix:
+            query = r.table('items').between([token, start_date or r.minval],
+                                             [token, end_date or r.maxval],
+                                             index='token_date',
+                                             right_bound='closed')
+        else:
+            query = r.table('items').between(token, token + '\uffff', index='token')
+
+            if start_date:
+                query = query.filter(r.row['menu_date'] >= start_date)
+            if end_date:
+                query = query.filter(r.row['menu_date'] <= end_date)
+
+        return list(self.__run(query, 'find_postings'))
+
+    def enqueue_work(self, items: list) -> int:
+        """Adds items to the work queue, ready to be claimed. Items that are already queued are
+        left as they are.
+
+        :param items: queue items with 'id' and 'url' fields.
+        :return: number of items added.
+        """
+        items = [dict(i, owner=None, lease_until=r.epoch_time(0), attempts=0) for i in items]
+        result = self.__run(r.table('work_queue').insert(items,
+                                                          conflict=lambda key, old, new: old),
+                            'enqueue_work')
+
+        return result.get('inserted', 0)
+
+    def claim_work(self, owner: str, lease_seconds: int, limit: int) -> list:
+        """Leases up to limit queue items whose lease has run out (or that were never leased).
+        Each item is claimed with an atomic update that checks the lease again, so two workers
+        racing for the same item never both get it.
+
+        :param owner: id of the claiming worker.
+        :param lease_seconds: length of the lease.
+        :param limit: maximum number of items to claim.
+        :return: list of claimed items.
+        """
+        result = self.__run(r.table('work_queue')
+                            .between(r.minval, r.now(), index='lease_until')
+                            .order_by(index='lease_until')
+                            .limit(limit)
+                            .update(lambda w: r.branch(w['lease_until'] <= r.now(),
+                                                       {'owner': owner,
+                                                        'lease_until': r.now() + lease_seconds,
+                                                        'attempts': w['attempts'].default(0) + 1},
+                                                       {}),
+                                    return_changes=True), 'claim_work')
+
+        return [c.get('new_val') for c in result.get('changes', [])]
+
+    def renew_work(self, owner: str, ids: list, lease_seconds: int):
+        """Extends the lease of queue items, unless another worker has claimed them since.
+
+        :param owner: id of the worker holding the lease.
+        :param ids: ids of the leased items.
+        :param lease_seconds: length of the new lease, from now.
+        """
+        if ids:
+            self.__run(r.table('work_queue').get_all(*ids)
+                       .update(lambda w: r.branch(w['owner'].eq(owner),
+                                                  {'lease_until': r.now() + lease_seconds},
+                                                  {})), 'renew_work')
+
+    def release_work(self, owner: str, ids: list):
+        """Removes finished items from the work queue, unless another worker has claimed them
+        since.
+
+        :param owner: id of the worker holding the lease.
+        :param ids: ids of the leased items.
+        """
+        if ids:
+            self.__run(r.table('work_queue').get_all(*ids)
+                       .filter(r.row['owner'].eq(owner))
+                       .delete(), 'release_work')
+
+    def count_work(self) -> int:
+        """Returns the number of items in the work queue.
+
+        :return: number of items.
+        """
+        return self.__run(r.table('work_queue').count(), 'count_work')
 
     def get_page_info_within_range(self, day_delta: int) -> list:
         """Returns all table entries from the current date to n days from now.
@@ -98,24 +476,128 @@ class Database:
         """
 
         # Create the start and end dates based on the current date and given timedelta.
-        start_date = datetime.now().date().strftime('%m-%d-%Y')
-        end_date = (datetime.now().date() + timedelta(days=day_delta)).strftime('%m-%d-%Y')
-
-        # If the index was not successfully generated, return an empty list.
-        if not self.__generate_index('time_date'):
-            return list()
+        start_date = datetime.now().date().isoformat()
+        end_date = (datetime.now().date() + timedelta(days=day_delta)).isoformat()
 
         # Return list containing dicts with urls and page md5sums.
-        return list(r.table('menus')
-                    .between(start_date, end_date, index='time_date')
-                    .pluck(['sum', 'url']).run(self.conn)
-                    )
+        return list(self.__run(r.table('menus')
+                               .between(start_date, end_date, index='menu_date')
+                               .pluck(['sum', 'url']), 'page_info'))
 
-    def disconnect(self):
-        """Drops all indices that were created and closes the connection to the database.
+    def get_menu(self, location_num: str, menu_date: str) -> dict:
+        """Returns the menu of a location on a given date.
+
+        :param location_num: location number of the dining hall.
+        :param menu_date: ISO 8601 date of the menu.
+        :return: menu document, or None if there is none.
+        """
+        menu = self.__run(r.table('menus').get(self.menu_key(location_num, menu_date)), 'get')
+        return self._decode([menu])[0]
+
+    def get_menus(self, location_num: str, start_date: str, end_date: str) -> list:
+        """Returns the menus of a location between two dates (both included), in date order.
+
+        :param location_num: location number of the dining hall.
+        :param start_date: ISO 8601 date of the first menu.
+        :param end_date: ISO 8601 date of the last menu.
+        :return: list of menu documents.
+        """
+        return self._decode(list(self.__run(r.table('menus')
+                                             .between([location_num, start_date],
+                                                      [location_num, end_date],
+                                                      index='location_date',
+                                                      right_bound='closed')
+                                             .order_by(index='location_date'), 'range')))
+
+    def export_watermark(self) -> float:
+        """Returns the server time write_grace_seconds ago. Menus are stamped with the server time
+        their write started at, so every menu stamped before the watermark is committed by the
+        time an export reads it, and menus written after this call have a later stamp.
+
+        :return: watermark as unix time.
         """
-        # Drop all indices before disconnecting.
-        for i in list(self.indices):
-            r.table('menus').index_drop(i).run(self.conn)
+        return self.__run((r.now() - self.write_grace_seconds).to_epoch_time(), 'watermark')
+
+    def stream_menus(self, start_date: str = None, end_date: str = None, since: float = None,
+                     until: float = None, batch_size: int = 500):
+        """Streams the menus between two dates (both included) in menu_date index order. The
+        server sends the cursor a batch at a time, and each batch is decoded with one catalog
+        lookup. Menus written before they were stamped count as written at the epoch. A menu
+        rewritten while the export runs may be read in its new version, which is then left out
+        here but has a stamp after until, so the next export picks it up.
+
+        :param start_date: (optional) ISO 8601 date of the first menu.
+        :param end_date: (optional) ISO 8601 date of the last menu.
+        :param since: (optional) watermark; only menus written after it are returned.
+        :param until: (optional) watermark; menus written after it are left out.
+        :param batch_size: number of menus sent by the server at once.
+        :return: generator of menu documents.
+        """
+        written_at = r.row['written_at'].default(r.epoch_time(0)).to_epoch_time()
+        query = (r.table('menus')
+                 .between(start_date or r.minval, end_date or r.maxval, index='menu_date',
+                          right_bound='closed')
+                 .order_by(index='menu_date'))
+
+        if since is not None:
+            query = query.filter(written_at > since)
+        if until is not None:
+            query = query.filter(written_at <= until)
+
+        start = perf_counter()
+        cursor = query.without('written_at').run(self.conn, max_batch_rows=batch_size)
+        self._timed('stream', start)
+
+        try:
+            batch = []
 
+            for menu in cursor:
+                batch.append(menu)
+
+                if len(batch) >= batch_size:
+                    yield from self._decode(batch)
+                    batch = []
+
+            yield from self._decode(batch)
+        finally:
+            cursor.close()
+
+    def menu_changes(self):
+        """Subscribes to changes of the 'menus' table on a separate connection. The subscription
+        is in place once this method returns.
+
+        :return: generator of (location number, menu date) tuples for every changed menu.
+        """
+        conn = self.__new_connection()
+
+        # Only the keys are needed, so the menus themselves are not sent over the feed. Changes
+        # that leave the plucked fields as they were are dropped from the feed, so the sum and
+        # write time (which change on every write) are plucked along with the keys.
+        feed = (r.table('menus')
+                .pluck({'location': ['num'], 'time_info': ['menu_date']}, 'sum', 'written_at')
+                .changes()
+                .run(conn))
+
+        return self.__changed_keys(feed, conn)
+
+    @staticmethod
+    def __changed_keys(feed, conn):
+        """Turns a changefeed into the keys of the menus that changed.
+
+        :param feed: changefeed cursor on the 'menus' table.
+        :param conn: connection the changefeed runs on; closed when the generator is.
+        :return: generator of (location number, menu date) tuples.
+        """
+        try:
+            for change in feed:
+                for menu in (change.get('old_val'), change.get('new_val')):
+                    if menu:
+                        yield (menu.get('location').get('num'),
+                               menu.get('time_info').get('menu_date'))
+        finally:
+            conn.close()
+
+    def disconnect(self):
+        """Closes the connection to the database.
+        """
         self.conn.close()
\ No newline at end of file
@@ -0,0 +1,217 @@
+import os
+import json
+import gzip
+import sqlite3
+from itertools import islice
+
+
+class MenuExporter:
+    """
+    Description: bulk export of stored menus for analytics. Menus are streamed out of the database
+    in date order and written as they arrive, so memory use doesn't depend on the size of the
+    export. Output is either gzip-compressed JSON Lines (one menu, or one item row, per line) or a
+    SQLite snapshot that later exports are merged into. Incremental exports only include the menus
+    written since the watermark saved by the export before.
+    Methods:
+    - rows : flattens a menu into one row per item.
+    - export : writes the menus in a date range to a file.
+    """
+    formats = ('jsonl', 'sqlite')
+
+    # Tables of SQLite snapshots. Menus keep their JSON document; items are flattened.
+    snapshot_schema = [
+        'CREATE TABLE IF NOT EXISTS menus (id TEXT PRIMARY KEY, location TEXT NOT NULL, '
+        'menu_date TEXT NOT NULL, doc TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS menus_location_date ON menus (location, menu_date)',
+        'CREATE TABLE IF NOT EXISTS items (menu_id TEXT NOT NULL, location TEXT NOT NULL, '
+        'location_name TEXT, menu_date TEXT NOT NULL, meal TEXT, section TEXT, '
+        'position INTEGER NOT NULL, item TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS items_menu_id ON items (menu_id)',
+        'CREATE INDEX IF NOT EXISTS items_menu_date ON items (menu_date)'
+    ]
+
+    def __init__(self, database, batch_size: int = 500):
+        """
+        :param database: connected Database to export from.
+        :param batch_size: number of menus read and written at once.
+        """
+        self.database = database
+        self.batch_size = batch_size
+
+    def rows(self, menu: dict) -> list:
+        """Flattens a menu into one row per item, in menu order.
+
+        :param menu: menu document.
+        :return: list of {'menu_id', 'location', 'location_name', 'menu_date', 'meal', 'section',
+        'position', 'item'} dicts.
+        """
+        location = menu.get('location')
+        menu_date = menu.get('time_info').get('menu_date')
+        menu_id = menu.get('id') or self.database.menu_key(location.get('num'), menu_date)
+        rows = []
+
+        for meal in menu.get('menus') or []:
+            for section, items in meal.get('content').items():
+                for item in items:
+                    rows.append({'menu_id': menu_id,
+                                 'location': location.get('num'),
+                                 'location_name': location.get('name'),
+                                 'menu_date': menu_date,
+                                 'meal': meal.get('type'),
+                                 'section': section,
+                                 'position': len(rows),
+                                 'item': item})
+
+        return rows
+
+    def __batches(self, menus):
+        """Splits a stream of menus into lists of at most batch_size menus.
+
+        :param menus: iterable of menus.
+        :return: generator of lists of menus.
+        """
+        menus = iter(menus)
+
+        while True:
+            batch = list(islice(menus, self.batch_size))
+
+            if not batch:
+                return
+
+            yield batch
+
+    def __write_jsonl(self, path: str, menus, items: bool) -> tuple:
+        """Writes menus (or their item rows) as gzip-compressed JSON Lines. The file is written
+        under a temporary name and moved into place once complete.
+
+        :param path: path of the output file.
+        :param menus: iterable of menus.
+        :param items: if true, write one line per item instead of one per menu.
+        :return: (menus written, lines written).
+        """
+        written = lines = 0
+
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+            for menu in menus:
+                records = self.rows(menu) if items else [menu]
+
+                for record in records:
+                    f.write(json.dumps(record, separators=(',', ':')))
+                    f.write('\n')
+
+                written += 1
+                lines += len(records)
+
+        os.replace(path + '.tmp', path)
+
+        return written, lines
+
+    def __write_sqlite(self, path: str, menus, items: bool) -> tuple:
+        """Merges menus (and, optionally, their item rows) into a SQLite snapshot, replacing any
+        earlier copy of the same menus. Every batch is committed on its own.
+
+        :param path: path of the snapshot file.
+        :param menus: iterable of menus.
+        :param items: if true, also write one row per item.
+        :return: (menus written, item rows written).
+        """
+        conn = sqlite3.connect(path)
+        written = lines = 0
+
+        try:
+            for statement in self.snapshot_schema:
+                conn.execute(statement)
+
+            for batch in self.__batches(menus):
+                rows = [self.rows(m) for m in batch]
+                ids = [r[0].get('menu_id') if r else m.get('id') for m, r in zip(batch, rows)]
+
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO menus (id, location, menu_date, doc) '
+                                     'VALUES (?, ?, ?, ?)',
+                                     [(i, m.get('location').get('num'),
+                                       m.get('time_info').get('menu_date'), json.dumps(m))
+                                      for i, m in zip(ids, batch)])
+
+                    if items:
+                        conn.executemany('DELETE FROM items WHERE menu_id = ?', [(i,) for i in ids])
+                        conn.executemany('INSERT INTO items (menu_id, location, location_name, '
+                                         'menu_date, meal, section, position, item) '
+                                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                         [(r.get('menu_id'), r.get('location'),
+                                           r.get('location_name'), r.get('menu_date'),
+                                           r.get('meal'), r.get('section'), r.get('position'),
+                                           r.get('item')) for menu_rows in rows for r in menu_rows])
+                        lines += sum(len(r) for r in rows)
+
+                written += len(batch)
+        finally:
+            conn.close()
+
+        return written, lines
+
+    @staticmethod
+    def __load_watermark(state_file: str):
+        """Reads the watermark saved by the last export.
+
+        :param state_file: path of the state file.
+        :return: watermark, or None if there was no earlier export.
+        """
+        try:
+            with open(state_file, 'r') as f:
+                return json.load(f).get('watermark')
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def __save_watermark(state_file: str, watermark):
+        """Saves the watermark of a finished export.
+
+        :param state_file: path of the state file.
+        :param watermark: watermark the export went up to.
+        """
+        if os.path.dirname(state_file):
+            os.makedirs(os.path.dirname(state_file), exist_ok=True)
+
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump({'watermark': watermark}, f)
+
+        os.replace(state_file + '.tmp', state_file)
+
+    def export(self, path: str, fmt: str = 'jsonl', start_date: str = None, end_date: str = None,
+               items: bool = False, state_file: str = None) -> dict:
+        """Exports the menus between two dates (both included). With a state file, only menus
+        written since the last export with the same state file are included, and the new
+        watermark is saved once the export is complete.
+
+        :param path: path of the output file.
+        :param fmt: 'jsonl' for gzip-compressed JSON Lines or 'sqlite' for a SQLite snapshot.
+        :param start_date: (optional) ISO 8601 date of the first menu.
+        :param end_date: (optional) ISO 8601 date of the last menu.
+        :param items: if true, export flattened item rows (JSON Lines) or add them to the snapshot.
+        :param state_file: (optional) file keeping the watermark between incremental exports.
+        :return: {'path', 'menus', 'rows', 'since', 'watermark'}.
+        """
+        if fmt not in self.formats:
+            raise ValueError('Unknown export format: {0}.'.format(fmt))
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        since = self.__load_watermark(state_file) if state_file else None
+
+        # Menus written while the export runs are left for the next one.
+        watermark = self.database.export_watermark()
+        menus = self.database.stream_menus(start_date, end_date, since, watermark,
+                                           self.batch_size)
+
+        if fmt == 'jsonl':
+            written, rows = self.__write_jsonl(path, menus, items)
+        else:
+            written, rows = self.__write_sqlite(path, menus, items)
+
+        if state_file:
+            self.__save_watermark(state_file, watermark)
+
+        return {'path': path, 'menus': written, 'rows': rows, 'since': since,
+                'watermark': watermark}
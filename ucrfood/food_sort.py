@@ -1,20 +1,89 @@
 import requests.exceptions as rexcept
-from requests import get
+from ucrfood.http_client import HttpClient, DeadlinePassed
+from ucrfood.parse_cache import ParseCache
 from urllib.parse import urlparse, parse_qs, quote
-from bs4 import BeautifulSoup
+from ucrfood.parsers import get_parser
+from ucrfood.menu_record import MenuRecord
+from ucrfood.profiler import Profiler
+from ucrfood.metrics import metrics
 from typing import TypeVar, Generic
 from datetime import datetime
 from hashlib import md5
-from re import sub, compile
-from multiprocessing import Process, Manager
+from time import perf_counter, time
+import multiprocessing
+from re import compile, IGNORECASE
+from itertools import islice
+from threading import Event, Lock
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# Per location crawl metrics. Pages are counted by result: 'unchanged' pages matched their stored
+# checksum and were not parsed, 'changed' pages were parsed, 'empty' pages had no menus, 'failed'
+# pages could not be downloaded and 'unfinished' pages were not done when the deadline passed.
+fetch_seconds = metrics.histogram('ucrfood_fetch_seconds', 'Time spent downloading a menu page.')
+parse_seconds = metrics.histogram('ucrfood_parse_seconds', 'Time spent parsing a menu page.')
+pages_total = metrics.counter('ucrfood_pages_total', 'Menu pages processed, by result.')
 
 
 class FoodSort:
     url_types = TypeVar('url_types', str, dict, list)
 
-    def __init__(self, urls: Generic[url_types]):
-        # Special list that is accessible between threads.
-        self.__serialized_menus = Manager().list()
+    # Byte patterns marking the start of the first menu table and the end of the last one.
+    menu_start_pattern = compile(rb'<td[^>]*\swidth\s*=\s*["\']?(?:50|30)%', IGNORECASE)
+    menu_end_marker = b'</table>'
+
+    # Client errors that may go away when the page is requested again.
+    retryable_statuses = (408, 429)
+
+    # Returned for pages whose download was cut off by the deadline.
+    cut_off = object()
+
+    def __init__(self, urls: Generic[url_types], fetch_workers: int = 8, parse_workers: int = 0,
+                 http_client: HttpClient = None, parser: str = 'lxml',
+                 parse_cache: ParseCache = None, profiler: Profiler = None):
+        """Sets up the url list and the limits for the worker pools.
+
+        :param urls: url, url dict or list of either to process.
+        :param fetch_workers: maximum number of threads downloading pages at once.
+        :param parse_workers: number of processes used for parsing. If 0, pages are parsed in the
+        fetching threads.
+        :param http_client: (optional) shared client used to download pages. A new one without a
+        disk cache is created if not given.
+        :param parser: name of the parser backend (i.e. 'lxml' or 'soup').
+        :param parse_cache: (optional) cache of parsed menus by page sum and encoding. Pass the
+        same cache to every FoodSort to reuse menus between runs.
+        :param profiler: (optional) profiler the fetch and parse stages are recorded with,
+        including in the parsing processes.
+        """
+        # List of finished menus, filled by get_menus, urls that could not be downloaded and urls
+        # left when the deadline passed.
+        self.__serialized_menus = []
+        self.__failed_urls = set()
+        self.__failed_lock = Lock()
+        self.__unfinished_urls = []
+
+        # Set once the deadline passed; pages still being fetched are then dropped. Requests are
+        # given the deadline of the run too.
+        self.__expired = Event()
+        self.__deadline = None
+
+        # Worker pool limits.
+        self.__fetch_workers = max(1, fetch_workers)
+        self.__parse_workers = max(0, parse_workers)
+        self.__parse_pool = None
+
+        # Parser backend used by the fetching threads or, by name, the parsing processes.
+        self.__parser_name = parser
+        self.__parser = get_parser(parser)
+
+        # Pooled HTTP client shared by the fetching threads.
+        self.__http = http_client or HttpClient(pool_size=self.__fetch_workers)
+
+        # Menus of pages parsed before, so duplicate pages are not parsed again.
+        self.__parse_cache = parse_cache if parse_cache is not None else ParseCache()
+
+        # Only set while profiling.
+        self.__profiler = profiler
 
         if isinstance(urls, str):
             self.__urls = [{'url': urls, 'sum': None, 'content': None}]
@@ -28,35 +97,51 @@ class FoodSort:
         else:
             raise TypeError('Url is not an instance or list or str.')
 
-    @staticmethod
-    def __pull_page(url: str) -> list:
-        """Gets the page from the given url and returns the page content required for parsing.
+    def __pull_page(self, url: str) -> bytes:
+        """Gets the page from the given url and returns the raw page content. Transient errors
+        are already retried by the HTTP client, so urls that still fail are remembered as failed
+        rather than mistaken for pages without menus. Client errors (e.g. 404) won't go away by
+        retrying, so those pages are taken as pages without menus.
 
         :param url: url to get page content from.
-        :return: list of lists of selected elements to parse.
+        :return: raw bytes of the page, empty if there is no page, or None if it could not be
+        downloaded.
         """
         try:
             # Download the contents of the page.
-            page_content = get(url).content
+            return self.__http.get(url, deadline=self.__deadline)
+        except rexcept.RequestException as e:
+            print('{0}: {1}'.format(url, e))
+
+            status = e.response.status_code if e.response is not None else 0
+
+            if 400 <= status < 500 and status not in self.retryable_statuses:
+                return b''
 
-            # Parse the page for the specific sections that need to be parsed.
-            html_tree = BeautifulSoup(page_content, 'lxml')
-            return html_tree.find_all('td', attrs={'width': ['50%', '30%']})
-        except rexcept.ConnectionError:
-            return list()
+            with self.__failed_lock:
+                self.__failed_urls.add(url)
+
+            return None
 
     @staticmethod
-    def __get_page_sum(page_content: str) -> str:
-        """Given a string containing the relevant page content, return the md5sum of said page.
-        This is helpful for not parsing the page again when a copy exists in the database.
+    def __get_page_sum(page_content: bytes) -> str:
+        """Given the raw page, return the md5sum of the slice holding the menu tables. This is
+        computed before the page is parsed, so unchanged pages never have a tree built for them.
+        Anything outside of the menu tables (headers, timestamps, etc.) is left out of the sum.
 
-        :param page_content: string representing the page content.
-        :return: md5sum of page_content.
+        :param page_content: raw bytes of the page.
+        :return: md5sum of the menu tables, or of the whole page if they can't be found.
         """
-        m = md5()
+        start = FoodSort.menu_start_pattern.search(page_content)
+
+        if start:
+            end = page_content.rfind(FoodSort.menu_end_marker, start.start())
+            end = len(page_content) if end < 0 else end + len(FoodSort.menu_end_marker)
+            page_content = page_content[start.start():end]
 
         # Update the md5 parser with the content of the page and return the hex digest.
-        m.update(page_content.encode('utf-8'))
+        m = md5()
+        m.update(page_content)
         return m.hexdigest()
 
     @staticmethod
@@ -69,19 +154,24 @@ class FoodSort:
         :return: parameter set value.
         """
         try:
-            return parse_qs(urlparse(url).query).get(parameter)[index]
+            return parse_qs(urlparse(url).query).get(parameter, [])[index]
         except IndexError:
             return str()
 
     @staticmethod
-    def __strip_characters(input_str: str) -> str:
-        """Strips non alphanumeric characters and any duplicate whitespace.
+    def __get_menu_date(url: str) -> str:
+        """Gets the menu date from the url and converts it to an ISO 8601 date, which sorts in
+        chronological order.
 
-        :param input_str: string to clean.
-        :return: cleaned string.
+        :param url: url to parse.
+        :return: date of the menu as YYYY-MM-DD.
         """
-        filter_step = sub('[^a-zA-Z0-9-() *.]', '', input_str)
-        return sub(' +', ' ', filter_step)
+        menu_date = FoodSort.__get_parameters(url, 'dtdate', 0)
+
+        try:
+            return datetime.strptime(menu_date, '%m/%d/%Y').date().isoformat()
+        except ValueError:
+            return menu_date.replace('/', '-')
 
     @property
     def menus(self):
@@ -90,13 +180,31 @@ class FoodSort:
         :return: list of dictionaries.
         """
 
-        # Cast the Manager list to native Python list.
+        # Copy the list so callers never see it change under them.
         return list(self.__serialized_menus)
 
-    def __create_single_menu_serial(self, url_entry: dict) -> dict:
+    @property
+    def failed_urls(self) -> set:
+        """Returns the urls that could not be downloaded, even after retrying.
+
+        :return: set of urls.
+        """
+        with self.__failed_lock:
+            return set(self.__failed_urls)
+
+    @property
+    def unfinished_urls(self) -> list:
+        """Returns the urls that were not done when the deadline passed, in crawl order.
+
+        :return: list of urls.
+        """
+        return list(self.__unfinished_urls)
+
+    def __create_single_menu_serial(self, url_entry: dict, page_sum: str) -> dict:
         """Creates base dictionary with menus, location date, time data, url, and page sum.
 
-        :param url_entry: dict containing page url and content.
+        :param url_entry: dict containing page url.
+        :param page_sum: md5sum of the page content.
         :return: dictionary with data shown below.
         """
         # Declare dictionary.
@@ -114,101 +222,273 @@ class FoodSort:
         serial['time_info'] = {}
         serial['time_info']['gen'] = str(datetime.now())
         serial['time_info']['update'] = None
-        serial['time_info']['menu_date'] = self.__get_parameters(url_entry.get('url'),
-                                                                 'dtdate',
-                                                                 0).replace('/', '-')
+        serial['time_info']['menu_date'] = self.__get_menu_date(url_entry.get('url'))
 
         # Source url and page sum.
         serial['url'] = quote(url_entry.get('url'), safe='')
-        serial['sum'] = self.__get_page_sum(''.join(
-            ''.join(str(i)) for i in url_entry.get('content')))
+        serial['sum'] = page_sum
 
         return serial
 
-    def __serialize_menu(self, url_entry: dict) -> list:
-        """Parses the the menu web page for menu items and returns them in list form.
+    def __stage(self, name: str):
+        """Returns a context manager profiling one call of a stage, if profiling.
 
-        :param url_entry: dict containing the page content.
-        :return: list of menu items for each dining time (i.e. breakfast, lunch, & dinner).
+        :param name: name of the stage.
+        :return: context manager.
         """
+        return self.__profiler.stage(name) if self.__profiler else nullcontext()
 
-        # Breakfast, lunch, and dinner menus.
-        menus = []
-
-        for entry in url_entry.get('content'):
-            # Subsections from each menu time with menu entries and the working section.
-            menu_sections = dict()
-            current_section = None
+    def __parse(self, page_content: bytes) -> MenuRecord:
+        """Parses a page either in the process pool or right here in the fetching thread. When
+        profiling, the parsing process sends its profile back along with the menus.
 
-            # Get text only from all elements within the page tree.
-            sec_items = [el.get_text() for el in entry.find_all(compile('a[name="Recipe_Desc"]'))]
+        :param page_content: raw bytes of the page.
+        :return: MenuRecord, or None if the page has no menus.
+        """
+        if not self.__parse_pool:
+            with self.__stage('parse'):
+                return self.__parser.parse_record(page_content)
 
-            for item in sec_items:
-                if item[:2] == '--':
-                    # If the item starts with '--' in the name, this is the working section.
-                    section_name = item[3:-3]
+        settings = None
 
-                    # Set working section and update menu_sections dictionary.
-                    current_section = section_name
-                    menu_sections.update({section_name: []})
-                else:
-                    # Remove extraneous characters from menu item.
-                    menu_item = self.__strip_characters(item)
+        if self.__profiler:
+            settings = (self.__profiler.top, self.__profiler.memory_samples)
 
-                    # Append to list if not an empty string.
-                    if menu_item:
-                        menu_sections.get(current_section).append(menu_item)
+        result = self.__parse_pool.submit(_parse_page,
+                                          page_content,
+                                          self.__parser_name,
+                                          settings).result()
 
-            # Append all the menu sections to the menu.
-            menus.append({'type': entry.find('div', class_='shortmenumeals').get_text(),
-                          'content': menu_sections})
+        if self.__profiler:
+            menus, profile = result
+            self.__profiler.merge(profile)
+            return menus
 
-        return menus
+        return result
 
     def __get_menu(self, url_entry: dict):
         """Checks if the supplied md5sum is the same as the one for the page being processed. If it
         is, skip parsing.
 
-        :param url_entry: dict containing url, page content, and page sum.
-        :return: list containing menu items from each dining section.
+        :param url_entry: dict containing url and page sum.
+        :return: menu dictionary, or None if the page has no menus or has not changed.
         """
 
-        # Sets the content of the page in the url_entry dict.
-        url_entry['content'] = self.__pull_page(url_entry.get('url'))
+        location = self.__get_parameters(url_entry.get('url'), 'locationnum', 0)
+
+        # Download the page in the calling (fetching) thread.
+        start = perf_counter()
+
+        with self.__stage('fetch'):
+            page_content = self.__pull_page(url_entry.get('url'))
+
+        fetch_seconds.observe(perf_counter() - start, location=location)
+
+        # The run gave up on this page already; it is retried with the unfinished urls.
+        if self.__expired.is_set():
+            return None
+
+        if page_content is None:
+            pages_total.inc(location=location, result='failed')
+            return None
 
         # If there is no page content just return.
-        if not url_entry.get('content'):
-            return
+        if not page_content:
+            pages_total.inc(location=location, result='empty')
+            return None
+
+        # If the page's md5sum is the same, skip parsing altogether.
+        page_sum = self.__get_page_sum(page_content)
+
+        if page_sum == url_entry.get('sum'):
+            pages_total.inc(location=location, result='unchanged')
+            return None
+
+        # The sum only covers the menu tables, which is everything the parser reads, so pages with
+        # the same sum (e.g. the same menu on another day or location) parse to the same menus,
+        # as long as they are decoded the same way.
+        key = ParseCache.key(page_sum, self.__parser_name,
+                             self.__parser.page_encoding(page_content))
+        menus = self.__parse_cache.get(key)
+
+        if menus is ParseCache.missing:
+            start = perf_counter()
+            menus = self.__parse(page_content)
+            parse_seconds.observe(perf_counter() - start, location=location)
+            self.__parse_cache.put(key, menus)
+
+        # Skip pages without menus.
+        if menus is None:
+            pages_total.inc(location=location, result='empty')
+            return None
 
-        # Create the dictionary using the __create_single_menu_serial method.
-        menu_dict = self.__create_single_menu_serial(url_entry)
+        pages_total.inc(location=location, result='changed')
 
-        # If the entry's md5sum is not the same then serialize the page.
-        if menu_dict['sum'] != url_entry.get('sum') or url_entry.get('sum') is None:
-            menu_dict['menus'] = self.__serialize_menu(url_entry)
+        # Create the dictionary using the __create_single_menu_serial method. Menus stay compact
+        # until here, as only the pages that are written need them as dicts.
+        menu_dict = self.__create_single_menu_serial(url_entry, page_sum)
+        menu_dict['menus'] = menus.to_menus()
 
-            # If the url entry already has a checksum, it means that the menu has been updated.
-            if url_entry.get('sum'):
-                menu_dict['time_info']['update'] = str(datetime.now())
+        # If the url entry already has a checksum, it means that the menu has been updated.
+        if url_entry.get('sum'):
+            menu_dict['time_info']['update'] = str(datetime.now())
 
-            # Append to the manager list.
-            self.__serialized_menus.append(menu_dict)
+        return menu_dict
 
-    def get_menus(self):
-        """Processes list of urls using as many threads as possible.
+    def __get_menu_safe(self, url_entry: dict):
+        """Wraps __get_menu so that a single failing page does not stop the rest of the crawl.
 
+        :param url_entry: dict containing url and page sum.
+        :return: menu dictionary, or None.
+        """
+        try:
+            return self.__get_menu(url_entry)
+        except DeadlinePassed:
+            # Left for the next run, along with the other unfinished urls.
+            return self.cut_off
+        except Exception as e:
+            print('{0}: {1}'.format(url_entry.get('url'), e))
+            return None
+
+    @staticmethod
+    def __parse_context():
+        """Returns the multiprocessing context the parsing processes are started with. They start
+        on the first page to parse, from a fetching thread, while other threads may hold locks
+        (connection pools, the host limiter, stdout). A plain fork would copy those locks held, so
+        the processes are forked from a single threaded server process (or spawned where there is
+        none) instead.
+
+        :return: multiprocessing context.
+        """
+        methods = multiprocessing.get_all_start_methods()
+        return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+    def iter_menus(self, deadline: float = None):
+        """Processes list of urls using a bounded pool of fetching threads and, optionally, a
+        bounded pool of parsing processes, yielding each menu as soon as it is ready.
+
+        Only a small window of urls is in flight at once. If the caller is slow to consume menus
+        (e.g. while writing to the database), the window fills up and no new pages are fetched
+        until it catches up, so memory stays bounded by the window instead of the url count.
+
+        If the deadline passes, no more pages are started and the generator ends without waiting
+        for the pages in flight; their urls and the ones never started are kept in
+        unfinished_urls. Requests in flight are given the same deadline, so they stop waiting,
+        retrying or reading by then too and no thread outlives the deadline for long.
+
+        :param deadline: (optional) unix time by which the generator must end.
+        :return: generator of menu dictionaries.
+        """
+        window = self.__fetch_workers * 2
+        urls = iter(self.__urls)
+        expired = False
+        cut_off = []
+
+        self.__expired.clear()
+        self.__deadline = deadline
+        self.__unfinished_urls = []
+
+        if self.__parse_workers:
+            self.__parse_pool = ProcessPoolExecutor(max_workers=self.__parse_workers,
+                                                    mp_context=self.__parse_context())
+
+        # The fetching threads block on network I/O, so they only hold the GIL while parsing.
+        fetch_pool = ThreadPoolExecutor(max_workers=self.__fetch_workers)
+
+        try:
+            # Url entries of the pages in flight, by future.
+            pending = {fetch_pool.submit(self.__get_menu_safe, u): u for u in islice(urls, window)}
+
+            while pending:
+                timeout = None if deadline is None else deadline - time()
+
+                if timeout is not None and timeout <= 0:
+                    expired = True
+                    break
+
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                finished = [(pending.pop(f), f.result()) for f in done]
+
+                # Refill the window before handing menus to the caller.
+                for u in islice(urls, len(done)):
+                    pending[fetch_pool.submit(self.__get_menu_safe, u)] = u
+
+                for u, menu_dict in finished:
+                    if menu_dict is self.cut_off:
+                        cut_off.append(u.get('url'))
+                    elif menu_dict:
+                        yield menu_dict
+
+            if expired:
+                self.__expired.set()
+
+                # Pages that finished in the meantime are not thrown away.
+                for f in [f for f in pending if f.done()]:
+                    u, menu_dict = pending.pop(f), f.result()
+
+                    if menu_dict is self.cut_off:
+                        cut_off.append(u.get('url'))
+                    elif menu_dict:
+                        yield menu_dict
+
+                # Pages not started yet are dropped from the pool's queue.
+                for f in pending:
+                    f.cancel()
+
+            self.__unfinished_urls = cut_off + [u.get('url') for u in pending.values()]
+            self.__unfinished_urls.extend(u.get('url') for u in urls)
+
+            for u in self.__unfinished_urls:
+                pages_total.inc(location=self.__get_parameters(u, 'locationnum', 0),
+                                result='unfinished')
+        finally:
+            # Past the deadline nothing is waited for; threads still fetching give up by the
+            # deadline too, as it is passed on to every request.
+            fetch_pool.shutdown(wait=not expired)
+
+            if self.__parse_pool:
+                self.__parse_pool.shutdown(wait=not expired)
+                self.__parse_pool = None
+
+    def get_menus(self, deadline: float = None):
+        """Processes every url and keeps the resulting menus, accessible through the menus
+        property.
+
+        :param deadline: (optional) unix time after which no more pages are waited for.
         :return: N/A
         """
-        # List of processes to run.
-        processes = []
+        self.__serialized_menus.extend(self.iter_menus(deadline))
+
+
+# Parser instances created within a parsing process, and its profiler once one is needed.
+_process_parsers = {}
+_process_profiler = None
+
+
+def _parse_page(page_content: bytes, parser: str, profile: tuple = None):
+    """Entry point for the parsing processes. Bound methods of FoodSort hold locks and pools, so
+    they can't be pickled and sent to another process. Only the compact record is sent back.
+
+    :param page_content: raw bytes of the page.
+    :param parser: name of the parser backend.
+    :param profile: (optional) (top, memory_samples) of the profiler of the run. If given, the
+    parse is profiled with the same settings and the profile is sent back with the menus.
+    :return: MenuRecord, or None if the page has no menus. When profiling, a tuple of the menus
+    and the exported profile.
+    """
+    global _process_profiler
+
+    if parser not in _process_parsers:
+        _process_parsers[parser] = get_parser(parser)
+
+    if not profile:
+        return _process_parsers[parser].parse_record(page_content)
+
+    # The profiler lives as long as the process, which ends with the run.
+    if _process_profiler is None:
+        _process_profiler = Profiler(*profile)
 
-        # Append processes to process list.
-        for u in self.__urls:
-            p = Process(target=self.__get_menu, args=(u, ))
-            processes.append(p)
+    with _process_profiler.stage('parse'):
+        menus = _process_parsers[parser].parse_record(page_content)
 
-        # Start and then kill the processes.
-        for p in processes:
-            p.start()
-        for p in processes:
-            p.join()
+    return menus, _process_profiler.export()
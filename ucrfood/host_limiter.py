@@ -0,0 +1,133 @@
+import time
+from threading import Condition
+from ucrfood.metrics import metrics
+
+# Current concurrency limit and requests in flight, by host.
+concurrency_limit = metrics.gauge('ucrfood_http_concurrency_limit', 'Requests allowed at once.')
+in_flight_requests = metrics.gauge('ucrfood_http_in_flight', 'Requests in flight.')
+
+
+class HostLimiter:
+    """
+    Description: adaptive limit on the number of requests in flight to each host (AIMD). Every
+    request that succeeds quickly raises the limit by 1/limit, so it grows by about one per round
+    of requests. A throttled, failed or timed out request halves it, at most once per round trip so
+    a burst of failures from the same round counts once. A Retry-After from the host holds back
+    every request to it until the given time.
+    Methods:
+    - acquire : waits until a request to the host may be sent (or a deadline passes).
+    - release : records the outcome of a request and lets the next one through.
+    - limit : returns the current limit of a host.
+    """
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 8,
+                 latency_target: float = 2.0, decrease: float = 0.5):
+        """
+        :param initial: requests allowed at once to a host that was not contacted before.
+        :param min_limit: the limit is never cut below this.
+        :param max_limit: the limit never grows above this.
+        :param latency_target: responses slower than this many seconds don't raise the limit.
+        :param decrease: factor the limit is multiplied by on failures.
+        """
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease = decrease
+
+        # State for every host: {host: {'limit', 'in_flight', 'blocked_until', 'decreased', 'rtt'}},
+        # where rtt is a moving average of the response time.
+        self.__hosts = {}
+        self.__condition = Condition()
+
+    def __state(self, host: str) -> dict:
+        """Returns the state of a host, creating it if needed. Must be called with the condition
+        held.
+
+        :param host: host name (and port).
+        :return: state dict.
+        """
+        if host not in self.__hosts:
+            initial = max(self.min_limit, min(self.initial, self.max_limit))
+            self.__hosts[host] = {'limit': float(initial),
+                                  'in_flight': 0,
+                                  'blocked_until': 0,
+                                  'decreased': 0,
+                                  'rtt': None}
+
+        return self.__hosts[host]
+
+    def limit(self, host: str) -> int:
+        """Returns the number of requests currently allowed at once to a host.
+
+        :param host: host name (and port).
+        :return: concurrency limit.
+        """
+        with self.__condition:
+            return int(self.__state(host).get('limit'))
+
+    def acquire(self, host: str, deadline: float = None) -> bool:
+        """Waits until the host is not held back by a Retry-After and fewer requests than its
+        limit are in flight, then counts one more request in flight.
+
+        :param host: host name (and port).
+        :param deadline: (optional) unix time after which to stop waiting.
+        :return: true if the request may be sent; false if the deadline passed first.
+        """
+        with self.__condition:
+            state = self.__state(host)
+
+            while True:
+                now = time.time()
+                remaining = None if deadline is None else deadline - now
+
+                if remaining is not None and remaining <= 0:
+                    return False
+
+                blocked = state.get('blocked_until') - now
+
+                if blocked > 0:
+                    self.__condition.wait(blocked if remaining is None else min(blocked, remaining))
+                elif state.get('in_flight') >= int(state.get('limit')):
+                    self.__condition.wait(remaining)
+                else:
+                    break
+
+            state['in_flight'] += 1
+            in_flight_requests.set(state.get('in_flight'), host=host)
+
+        return True
+
+    def release(self, host: str, latency: float = None, congested: bool = False,
+                retry_after: float = None):
+        """Records the outcome of a request to the host and lets waiting requests through.
+
+        :param host: host name (and port).
+        :param latency: seconds the response took; only used for successful requests.
+        :param congested: true if the host throttled the request, failed or timed out.
+        :param retry_after: (optional) seconds the host asked to wait before the next request.
+        """
+        with self.__condition:
+            state = self.__state(host)
+            now = time.time()
+
+            state['in_flight'] -= 1
+
+            if congested:
+                # Cut once per round; the other requests of the round saw the same congestion.
+                if now - state.get('decreased') >= (state.get('rtt') or self.latency_target):
+                    state['limit'] = max(self.min_limit, state.get('limit') * self.decrease)
+                    state['decreased'] = now
+
+                if retry_after:
+                    state['blocked_until'] = max(state.get('blocked_until'), now + retry_after)
+            elif latency is not None:
+                rtt = state.get('rtt')
+                state['rtt'] = latency if rtt is None else 0.8 * rtt + 0.2 * latency
+
+                if latency <= self.latency_target:
+                    state['limit'] = min(self.max_limit,
+                                         state.get('limit') + 1 / state.get('limit'))
+
+            concurrency_limit.set(state.get('limit'), host=host)
+            in_flight_requests.set(state.get('in_flight'), host=host)
+            self.__condition.notify_all()
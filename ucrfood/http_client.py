@@ -0,0 +1,351 @@
+import os
+import json
+import time
+from random import uniform
+from hashlib import md5
+from threading import Lock
+from collections import OrderedDict
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+import requests.exceptions as rexcept
+from requests import Session
+from requests.adapters import HTTPAdapter
+from ucrfood.host_limiter import HostLimiter
+from ucrfood.metrics import metrics
+
+# Responses by HTTP status, and pages served from the cache by how they were served ('fresh' when
+# no request was made, 'revalidated' on a 304).
+responses_total = metrics.counter('ucrfood_http_responses_total', 'HTTP responses, by status.')
+cache_hits_total = metrics.counter('ucrfood_http_cache_hits_total', 'Pages served from cache.')
+retries_total = metrics.counter('ucrfood_http_retries_total', 'Requests retried, by reason.')
+
+
+class DeadlinePassed(Exception):
+    """
+    Description: raised by HttpClient.get when the caller's deadline passes before the page is
+    downloaded.
+    """
+
+
+class HttpClient:
+    """
+    Description: shared HTTP layer for downloading menu pages. Keeps a pooled keep-alive session,
+    remembers ETag/Last-Modified validators for every url and optionally keeps a copy of each
+    response on disk so unchanged pages come back as 304s or cache hits. Only the most recently
+    used pages are kept, in memory and on disk. Requests to each host go through an adaptive
+    concurrency limit, and throttled (429), failed (5xx) and timed out requests are retried with
+    exponential backoff.
+    Methods:
+    - get : returns the body of the page at the given url.
+    """
+    def __init__(self, cache_dir: str = None, pool_size: int = 8, timeout: float = 30.0,
+                 limiter: HostLimiter = None, retries: int = 3, backoff: float = 0.5,
+                 max_backoff: float = 60.0, connect_timeout: float = 5.0,
+                 max_cached: int = 1024):
+        """Creates the session and the connection pool.
+
+        :param cache_dir: (optional) directory for the on-disk response cache. If not given, the
+        cache only lives as long as this object.
+        :param pool_size: maximum number of connections kept open per host.
+        :param timeout: seconds to wait for the server to send data before giving up on a request.
+        :param limiter: (optional) concurrency limit for each host. Defaults to one starting at
+        half the pool size and growing up to all of it.
+        :param retries: number of times a throttled, failed or timed out request is retried.
+        :param backoff: seconds to wait before the first retry; doubled for every next one.
+        :param max_backoff: longest wait before a retry, even if the server asks for more.
+        :param connect_timeout: seconds to wait for a connection to the server.
+        :param max_cached: maximum number of pages kept in the cache. The url block moves forward
+        every day, so pages that are no longer crawled are evicted, least recently used first.
+        """
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_cached = max(1, max_cached)
+        self.limiter = limiter or HostLimiter(initial=max(1, pool_size // 2), max_limit=pool_size)
+
+        # One session for every request so connections are reused between pages.
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # In memory copy of the cache, least recently used first:
+        # {url: {'etag', 'last_modified', 'expires', 'body'}}.
+        self.__entries = OrderedDict()
+        self.__entries_lock = Lock()
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.__prune_disk()
+
+    @staticmethod
+    def __cache_key(url: str) -> str:
+        """Returns the file name used to cache the given url.
+
+        :param url: url of the page.
+        :return: md5sum of the url.
+        """
+        return md5(url.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def __get_expiry(headers) -> float:
+        """Works out until when a response may be reused without asking the server again.
+
+        :param headers: response headers.
+        :return: unix time the response expires at; 0 if it must always be revalidated.
+        """
+        cache_control = headers.get('Cache-Control', '').lower()
+
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return 0
+
+        for directive in cache_control.split(','):
+            name, _, value = directive.strip().partition('=')
+            if name == 'max-age' and value.isdigit():
+                return time.time() + int(value)
+
+        if headers.get('Expires'):
+            try:
+                return parsedate_to_datetime(headers.get('Expires')).timestamp()
+            except (TypeError, ValueError):
+                return 0
+
+        return 0
+
+    @staticmethod
+    def __get_retry_after(headers) -> float:
+        """Reads how long the server asked to wait before the next request.
+
+        :param headers: response headers.
+        :return: seconds to wait, or None if the server did not say.
+        """
+        value = headers.get('Retry-After')
+
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def __request(self, url: str, headers: dict, deadline: float = None):
+        """Sends a GET request through the host's concurrency limit, retrying with exponential
+        backoff (or as long as a Retry-After asks) while the server throttles, fails or times out.
+        With a deadline, no request is sent, waited for or retried past it.
+
+        :param url: url of the page.
+        :param headers: request headers.
+        :param deadline: (optional) unix time by which to give up.
+        :return: response; still a 429 or 5xx one if every retry failed.
+        """
+        host = urlparse(url).netloc
+
+        for attempt in range(self.retries + 1):
+            if not self.limiter.acquire(host, deadline):
+                raise DeadlinePassed(url)
+
+            timeout = (self.connect_timeout, self.timeout)
+
+            if deadline is not None:
+                remaining = max(0.001, deadline - time.time())
+                timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+
+            start = time.perf_counter()
+
+            try:
+                response = self.session.get(url, headers=headers, timeout=timeout)
+            except (rexcept.ConnectionError, rexcept.Timeout) as e:
+                # Cut short by the deadline rather than by the host; the limit stays as it is.
+                if deadline is not None and time.time() >= deadline:
+                    self.limiter.release(host)
+                    raise DeadlinePassed(url)
+
+                self.limiter.release(host, congested=True)
+
+                if attempt == self.retries:
+                    raise
+
+                reason = 'timeout' if isinstance(e, rexcept.Timeout) else 'connection'
+                retry_after = None
+            else:
+                status = response.status_code
+                responses_total.inc(status=status)
+
+                if status != 429 and status < 500:
+                    self.limiter.release(host, latency=time.perf_counter() - start)
+                    return response
+
+                retry_after = self.__get_retry_after(response.headers)
+                self.limiter.release(host, congested=True, retry_after=retry_after)
+
+                if attempt == self.retries:
+                    return response
+
+                reason = str(status)
+                response.close()
+
+            retries_total.inc(reason=reason)
+
+            # Full jitter keeps workers that failed together from retrying together.
+            if not retry_after:
+                retry_after = uniform(0, self.backoff * 2 ** attempt)
+
+            delay = min(retry_after, self.max_backoff)
+
+            if deadline is not None and time.time() + delay >= deadline:
+                raise DeadlinePassed(url)
+
+            time.sleep(delay)
+
+    def __prune_disk(self):
+        """Deletes the least recently written pages from the disk cache, so it holds at most
+        max_cached pages when the client starts.
+        """
+        names = [n[:-len('.json')] for n in os.listdir(self.cache_dir) if n.endswith('.json')]
+        names.sort(key=lambda n: os.path.getmtime(os.path.join(self.cache_dir, n + '.json')))
+
+        for name in names[:max(0, len(names) - self.max_cached)]:
+            self.__remove_files(os.path.join(self.cache_dir, name))
+
+    @staticmethod
+    def __remove_files(base: str):
+        """Deletes the files of a disk cache entry.
+
+        :param base: path of the entry without extension.
+        """
+        for path in (base + '.json', base + '.body'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def __remember(self, url: str, entry: dict):
+        """Keeps the cache entry for the given url in memory as the most recently used one,
+        evicting the least recently used entries (and their files) if the cache is full.
+
+        :param url: url of the page.
+        :param entry: cache entry.
+        """
+        with self.__entries_lock:
+            self.__entries[url] = entry
+            self.__entries.move_to_end(url)
+
+            evicted = []
+
+            while len(self.__entries) > self.max_cached:
+                evicted.append(self.__entries.popitem(last=False)[0])
+
+        if self.cache_dir:
+            for u in evicted:
+                self.__remove_files(os.path.join(self.cache_dir, self.__cache_key(u)))
+
+    def __load(self, url: str) -> dict:
+        """Returns the cache entry for the given url from memory or from disk.
+
+        :param url: url of the page.
+        :return: cache entry or None if the url was never cached.
+        """
+        with self.__entries_lock:
+            entry = self.__entries.get(url)
+
+            if entry:
+                self.__entries.move_to_end(url)
+
+        if entry or not self.cache_dir:
+            return entry
+
+        base = os.path.join(self.cache_dir, self.__cache_key(url))
+
+        try:
+            with open(base + '.json', 'r') as f:
+                entry = json.load(f)
+            with open(base + '.body', 'rb') as f:
+                entry['body'] = f.read()
+        except (OSError, ValueError):
+            return None
+
+        self.__remember(url, entry)
+
+        return entry
+
+    def __store(self, url: str, entry: dict):
+        """Saves the cache entry for the given url in memory and, if enabled, on disk.
+
+        :param url: url of the page.
+        :param entry: cache entry to save.
+        """
+        self.__remember(url, entry)
+
+        if not self.cache_dir:
+            return
+
+        base = os.path.join(self.cache_dir, self.__cache_key(url))
+        meta = {k: v for k, v in entry.items() if k != 'body'}
+
+        # Write to temporary files first so a crash never leaves half written entries behind.
+        with open(base + '.body.tmp', 'wb') as f:
+            f.write(entry.get('body'))
+        with open(base + '.json.tmp', 'w') as f:
+            json.dump(meta, f)
+
+        os.replace(base + '.body.tmp', base + '.body')
+        os.replace(base + '.json.tmp', base + '.json')
+
+    def get(self, url: str, deadline: float = None) -> bytes:
+        """Downloads the page at the given url. Cached responses that are still fresh are returned
+        without contacting the server; stale ones are revalidated with a conditional GET.
+
+        :param url: url of the page.
+        :param deadline: (optional) unix time by which to give up. Waiting for the host's limit,
+        the request itself and backoff between retries all stop there, raising DeadlinePassed.
+        :return: body of the page.
+        """
+        entry = self.__load(url)
+        headers = {}
+
+        if entry:
+            # Still fresh, no need to ask the server.
+            if entry.get('expires', 0) > time.time():
+                cache_hits_total.inc(result='fresh')
+                return entry.get('body')
+
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry.get('etag')
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry.get('last_modified')
+
+        response = self.__request(url, headers, deadline)
+
+        if response.status_code == 304 and entry:
+            # Page has not changed; refresh the expiry time and reuse the cached body.
+            entry['expires'] = self.__get_expiry(response.headers)
+            self.__store(url, entry)
+            cache_hits_total.inc(result='revalidated')
+            return entry.get('body')
+
+        response.raise_for_status()
+
+        # Only keep responses that can be revalidated or reused later.
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        expires = self.__get_expiry(response.headers)
+
+        if etag or last_modified or expires:
+            self.__store(url, {'url': url,
+                               'etag': etag,
+                               'last_modified': last_modified,
+                               'expires': expires,
+                               'body': response.content})
+
+        return response.content
+
+    def close(self):
+        """Closes every pooled connection.
+        """
+        self.session.close()
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class MenuCache:
+    """
+    Description: thread-safe LRU cache of menu documents keyed by (location number, menu date).
+    Missing menus are cached too, so repeated lookups of days without a menu stay in memory.
+    Every invalidation bumps an epoch; results read from the database before an invalidation are
+    not cached, so a change that lands while a read is in flight is never hidden by it.
+    Methods:
+    - get : returns a cached menu.
+    - put : caches a menu read from the database.
+    - invalidate : drops a menu from the cache.
+    - clear : drops everything.
+    """
+    # Marks menus known not to exist; None means "not cached".
+    missing = object()
+
+    def __init__(self, capacity: int = 4096):
+        """
+        :param capacity: maximum number of menus kept in memory.
+        """
+        self.capacity = capacity
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, key: tuple):
+        """Returns a cached menu and marks it as recently used.
+
+        :param key: (location number, menu date).
+        :return: menu document, MenuCache.missing for known missing menus, or None if not cached.
+        """
+        with self.__lock:
+            value = self.__entries.get(key)
+
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: tuple, menu: dict, epoch: int):
+        """Caches a menu read from the database, evicting the least recently used menus if the
+        cache is full.
+
+        :param key: (location number, menu date).
+        :param menu: menu document, or None if there is no menu for the key.
+        :param epoch: value of self.epoch before the menu was read from the database.
+        """
+        with self.__lock:
+            # Something changed while the menu was being read; it may be stale already.
+            if epoch != self.epoch:
+                return
+
+            self.__entries[key] = self.missing if menu is None else menu
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.capacity:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, key: tuple):
+        """Drops a menu from the cache.
+
+        :param key: (location number, menu date).
+        """
+        with self.__lock:
+            self.epoch += 1
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        """Drops every menu from the cache.
+        """
+        with self.__lock:
+            self.epoch += 1
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
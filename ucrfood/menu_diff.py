@@ -0,0 +1,105 @@
+class MenuDiff:
+    """
+    Description: compares the stored and the newly crawled version of a menu. Changes are
+    described at the meal, section and item level for the change history, and as the list of meals
+    that have to be rewritten for delta updates of the stored document.
+    Change records are compact lists of [op, meal, section, items], where op is '+' for items that
+    were added and '-' for items that were removed. Every item of a section (or meal) that appeared
+    or disappeared as a whole is listed; a meal without sections gives a record with section None.
+    Methods:
+    - changes : returns the change records between two versions of a menu.
+    - meal_patches : returns the meals that changed between two versions of an encoded menu.
+    """
+    @staticmethod
+    def __by_meal(menus: list) -> dict:
+        """Indexes the meals of a menu by name.
+
+        :param menus: list of {'type': meal, 'content': {section: [item, ...]}} dicts.
+        :return: {meal: {section: [item, ...]}}, in menu order.
+        """
+        meals = {}
+
+        for meal in menus or []:
+            meals.setdefault(meal.get('type'), meal.get('content') or {})
+
+        return meals
+
+    @staticmethod
+    def __meal_records(op: str, meal: str, sections: dict) -> list:
+        """Returns the records of a meal that appeared or disappeared as a whole.
+
+        :param op: '+' or '-'.
+        :param meal: name of the meal.
+        :param sections: {section: [item, ...]} of the meal.
+        :return: list of change records.
+        """
+        if not sections:
+            return [[op, meal, None, []]]
+
+        return [[op, meal, section, list(items)] for section, items in sections.items()]
+
+    @staticmethod
+    def changes(old_menus: list, new_menus: list) -> list:
+        """Compares two versions of a menu. Only which items are served counts; a different order
+        of the same items is not a change.
+
+        :param old_menus: stored menus, as created by FoodSort.
+        :param new_menus: crawled menus, as created by FoodSort.
+        :return: list of [op, meal, section, items] records, removals before additions.
+        """
+        old = MenuDiff.__by_meal(old_menus)
+        new = MenuDiff.__by_meal(new_menus)
+        removed = []
+        added = []
+
+        for meal, sections in old.items():
+            if meal not in new:
+                removed.extend(MenuDiff.__meal_records('-', meal, sections))
+
+        for meal, sections in new.items():
+            if meal not in old:
+                added.extend(MenuDiff.__meal_records('+', meal, sections))
+                continue
+
+            old_sections = old.get(meal)
+
+            for section, items in old_sections.items():
+                if section not in sections:
+                    removed.append(['-', meal, section, list(items)])
+
+            for section, items in sections.items():
+                old_items = old_sections.get(section)
+
+                if old_items is None:
+                    added.append(['+', meal, section, list(items)])
+                    continue
+
+                # Items keep their menu order; duplicates are listed once.
+                kept, had = set(items), set(old_items)
+                gone = [i for i in dict.fromkeys(old_items) if i not in kept]
+                new_items = [i for i in dict.fromkeys(items) if i not in had]
+
+                if gone:
+                    removed.append(['-', meal, section, gone])
+                if new_items:
+                    added.append(['+', meal, section, new_items])
+
+        return removed + added
+
+    @staticmethod
+    def meal_patches(old_menus: list, new_menus: list) -> list:
+        """Finds the meals of an encoded menu that have to be rewritten. Meals are patched in
+        place, so this only works if both versions have the same meals in the same order.
+
+        :param old_menus: stored menus, as returned by ItemCatalog.encode.
+        :param new_menus: crawled menus, as returned by ItemCatalog.encode.
+        :return: list of (index, new meal) tuples, or None if the meals themselves changed and the
+        whole list has to be rewritten.
+        """
+        old_menus = old_menus or []
+        new_menus = new_menus or []
+
+        if [m.get('type') for m in old_menus] != [m.get('type') for m in new_menus]:
+            return None
+
+        return [(i, new) for i, (old, new) in enumerate(zip(old_menus, new_menus)) if old != new]
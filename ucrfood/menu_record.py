@@ -0,0 +1,77 @@
+from sys import intern
+
+
+class MenuRecord:
+    """
+    Description: compact, immutable form of the menus parsed from a page. Meals, sections and items
+    are kept as nested tuples of interned strings, so the names repeated on every page (meal and
+    section names, common items) are stored once per process and pickled once per record when
+    sent back from a parsing process. Records are what parsers hand to the crawler and what the
+    parse cache keeps; they are only turned into menu dicts when a menu is written.
+    Methods:
+    - from_menus : builds a record from a list of menus as returned by MenuParser.parse.
+    - to_menus : returns the menus as a new list of dicts.
+    - nbytes : approximate memory held by the record.
+    """
+    __slots__ = ('meals',)
+
+    def __init__(self, meals):
+        """
+        :param meals: iterable of (meal name, iterable of (section name, iterable of items)).
+        """
+        self.meals = tuple((intern(meal),
+                            tuple((intern(section), tuple(intern(i) for i in items))
+                                  for section, items in sections))
+                           for meal, sections in meals)
+
+    @classmethod
+    def from_menus(cls, menus: list) -> 'MenuRecord':
+        """Builds a record from parsed menus.
+
+        :param menus: [{'type': meal_name, 'content': {section_name: [item, ...], ...}}, ...]
+        :return: MenuRecord, or None if menus is None (page without menus).
+        """
+        if menus is None:
+            return None
+
+        return cls((m.get('type'), m.get('content').items()) for m in menus)
+
+    def to_menus(self) -> list:
+        """Returns the menus in the form stored in the database. The lists are new on every call,
+        so callers may change them.
+
+        :return: [{'type': meal_name, 'content': {section_name: [item, ...], ...}}, ...]
+        """
+        return [{'type': meal, 'content': {section: list(items) for section, items in sections}}
+                for meal, sections in self.meals]
+
+    @property
+    def nbytes(self) -> int:
+        """Returns the approximate memory held by the record: the text of every string plus a
+        pointer for every tuple slot. Interned strings shared with other records are counted in
+        each of them, so this errs on the high side.
+
+        :return: size in bytes.
+        """
+        size = 0
+
+        for meal, sections in self.meals:
+            size += len(meal) + 8 * (2 + len(sections))
+
+            for section, items in sections:
+                size += len(section) + 8 * (2 + len(items)) + sum(len(i) for i in items)
+
+        return size
+
+    def __reduce__(self):
+        # Unpickled records intern their strings again in the receiving process.
+        return MenuRecord, (self.meals,)
+
+    def __eq__(self, other):
+        return isinstance(other, MenuRecord) and self.meals == other.meals
+
+    def __hash__(self):
+        return hash(self.meals)
+
+    def __repr__(self):
+        return 'MenuRecord({0} meals)'.format(len(self.meals))
@@ -0,0 +1,310 @@
+import json
+from bisect import bisect_left
+from threading import Lock, Thread
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+class Metric:
+    """
+    Description: base class for metrics. Keeps one value per distinct set of labels.
+    Methods:
+    - render : returns the metric in the Prometheus text format.
+    - snapshot : returns a copy of every value keyed by label set.
+    """
+    kind = None
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(labels: dict) -> tuple:
+        """Turns a dict of labels into a hashable key.
+
+        :param labels: label names and values.
+        :return: sorted tuple of (name, value) pairs.
+        """
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    @staticmethod
+    def _format_labels(key: tuple, extra: tuple = ()) -> str:
+        """Formats a label key for the Prometheus text format.
+
+        :param key: label key created by _key.
+        :param extra: additional (name, value) pairs to add.
+        :return: string such as '{location="02"}', or an empty string without labels.
+        """
+        pairs = key + extra
+
+        if not pairs:
+            return ''
+
+        return '{' + ','.join('{0}="{1}"'.format(k, v.replace('"', '\\"')) for k, v in pairs) + '}'
+
+    def render(self) -> list:
+        """Returns the metric in the Prometheus text format.
+
+        :return: list of lines.
+        """
+        lines = ['# HELP {0} {1}'.format(self.name, self.description),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append('{0}{1} {2}'.format(self.name, self._format_labels(key), value))
+
+        return lines
+
+    def snapshot(self) -> dict:
+        """Returns a copy of every value keyed by label set.
+
+        :return: {label key: value}.
+        """
+        with self._lock:
+            return {key: value for key, value in self._values.items()}
+
+
+class Counter(Metric):
+    """
+    Description: value that only ever goes up (e.g. pages fetched).
+    """
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        """Increases the counter for the given labels.
+
+        :param amount: amount to add.
+        :param labels: label names and values.
+        """
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Description: value that is set to the latest measurement (e.g. pages per second of a run).
+    """
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        """Sets the gauge for the given labels.
+
+        :param value: latest measurement.
+        :param labels: label names and values.
+        """
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Description: distribution of observed values (e.g. latencies) over fixed buckets.
+    """
+    kind = 'histogram'
+
+    # Bucket upper bounds in seconds, suitable for network and parse latencies.
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, description: str, buckets: tuple = None):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets or self.default_buckets)
+
+    def observe(self, value: float, **labels):
+        """Adds a measurement to the histogram for the given labels.
+
+        :param value: measurement, i.e. seconds.
+        :param labels: label names and values.
+        """
+        key = self._key(labels)
+
+        with self._lock:
+            # Per label set: [count per bucket (last one is +Inf), sum].
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self) -> list:
+        lines = ['# HELP {0} {1}'.format(self.name, self.description),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        self.name, self._format_labels(key, (('le', str(bound)),)), cumulative))
+
+                lines.append('{0}_sum{1} {2}'.format(self.name, self._format_labels(key), total))
+                lines.append('{0}_count{1} {2}'.format(self.name, self._format_labels(key),
+                                                       cumulative))
+
+        return lines
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {key: {'count': sum(counts), 'sum': total}
+                    for key, (counts, total) in self._values.items()}
+
+
+class Metrics:
+    """
+    Description: registry holding every metric of the application.
+    Methods:
+    - counter, gauge, histogram : return the metric with the given name, creating it if needed.
+    - render : returns every metric in the Prometheus text format.
+    - snapshot : returns the current value of every metric.
+    - diff : returns what changed between two snapshots, for per-run summaries.
+    """
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = Lock()
+
+    def __get_or_create(self, cls, name: str, description: str, **kwargs) -> Metric:
+        with self.__lock:
+            if name not in self.__metrics:
+                self.__metrics[name] = cls(name, description, **kwargs)
+
+            return self.__metrics[name]
+
+    def counter(self, name: str, description: str) -> Counter:
+        """Returns the counter with the given name, creating it if needed.
+
+        :param name: metric name, ending in _total.
+        :param description: help text.
+        :return: counter.
+        """
+        return self.__get_or_create(Counter, name, description)
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        """Returns the gauge with the given name, creating it if needed.
+
+        :param name: metric name.
+        :param description: help text.
+        :return: gauge.
+        """
+        return self.__get_or_create(Gauge, name, description)
+
+    def histogram(self, name: str, description: str, buckets: tuple = None) -> Histogram:
+        """Returns the histogram with the given name, creating it if needed.
+
+        :param name: metric name.
+        :param description: help text.
+        :param buckets: (optional) bucket upper bounds.
+        :return: histogram.
+        """
+        return self.__get_or_create(Histogram, name, description, buckets=buckets)
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format.
+
+        :return: text to serve on /metrics.
+        """
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+
+        lines = []
+        for m in sorted(metrics, key=lambda m: m.name):
+            lines.extend(m.render())
+
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        """Returns the current value of every metric.
+
+        :return: {metric name: {label key: value}}.
+        """
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+
+        return {m.name: m.snapshot() for m in metrics}
+
+    @staticmethod
+    def diff(before: dict, after: dict) -> dict:
+        """Returns what changed between two snapshots. Labels are flattened into strings such as
+        'location=02,result=changed' so the result can be dumped as JSON.
+
+        :param before: snapshot taken at the start of a run.
+        :param after: snapshot taken at the end of a run.
+        :return: {metric name: {labels: value}} with only the values that changed.
+        """
+        result = {}
+
+        for name, values in after.items():
+            changes = {}
+
+            for key, value in values.items():
+                old = before.get(name, {}).get(key)
+                label = ','.join('{0}={1}'.format(k, v) for k, v in key) or 'total'
+
+                if isinstance(value, dict):
+                    old = old or {'count': 0, 'sum': 0}
+                    if value['count'] != old['count']:
+                        changes[label] = {'count': value['count'] - old['count'],
+                                          'sum': value['sum'] - old['sum']}
+                elif value != old:
+                    changes[label] = value - (old or 0) if name.endswith('_total') else value
+
+            if changes:
+                result[name] = changes
+
+        return result
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """
+    Description: small local HTTP server exposing the registry on /metrics (Prometheus text
+    format) and the summary of the last run on /summary (JSON).
+    Methods:
+    - start : serves requests from a background thread.
+    - stop : shuts the server down.
+    """
+    daemon_threads = True
+
+    def __init__(self, registry: Metrics, port: int, host: str = '127.0.0.1'):
+        self.registry = registry
+        self.last_summary = {}
+        super().__init__((host, port), MetricsHandler)
+
+    def start(self):
+        """Serves requests from a background thread.
+        """
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """Shuts the server down.
+        """
+        self.shutdown()
+        self.server_close()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = self.server.registry.render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/summary':
+            body = json.dumps(self.server.last_summary, indent=2).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Registry shared by the whole application.
+metrics = Metrics()
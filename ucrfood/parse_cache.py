@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from threading import Lock
+from ucrfood.metrics import metrics
+
+# Lookups by result, and memory held by the cached menus.
+parse_cache_total = metrics.counter('ucrfood_parse_cache_total', 'Parse cache lookups.')
+parse_cache_bytes = metrics.gauge('ucrfood_parse_cache_bytes',
+                                  'Approximate size of the cached menus.')
+
+
+class ParseCache:
+    """
+    Description: thread-safe, content addressed cache of parsed menus. Menus repeat across days
+    and locations sharing a kitchen, so pages are looked up by the fingerprint of their menu tables
+    (along with the parser and the page encoding, see key) and identical pages are parsed only
+    once. Menus are kept as MenuRecords, which are immutable and so are shared by every caller,
+    and the cache is bounded by their approximate size. The least recently used menus are evicted
+    first.
+    Methods:
+    - key : builds the key a page is cached under.
+    - get : returns the menus parsed from a page with the given key.
+    - put : caches the menus parsed from a page.
+    """
+    # Returned by get when nothing is cached; None is a valid result (page without menus).
+    missing = object()
+
+    # Bytes counted for every entry on top of its menus (key, bookkeeping).
+    entry_overhead = 64
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        """
+        :param max_bytes: maximum approximate size of the menus kept in memory.
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    @staticmethod
+    def key(page_sum: str, parser: str, encoding: str) -> str:
+        """Builds the key a page is cached under. The page sum only covers the menu tables, while
+        the encoding the page is decoded with is declared outside of them, so it is part of the
+        key too.
+
+        :param page_sum: fingerprint of the menu tables, as used for the page's 'sum'.
+        :param parser: name of the parser backend.
+        :param encoding: encoding the page is decoded with.
+        :return: cache key.
+        """
+        return '{0}:{1}:{2}'.format(parser, encoding, page_sum)
+
+    def get(self, key: str):
+        """Returns the menus cached under the given key and marks them as recently used.
+
+        :param key: key of the page (see key).
+        :return: MenuRecord, None for pages without menus, or ParseCache.missing.
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+
+            if entry is None:
+                parse_cache_total.inc(result='miss')
+                return self.missing
+
+            self.__entries.move_to_end(key)
+
+        parse_cache_total.inc(result='hit')
+        return entry[0]
+
+    def put(self, key: str, menus: list):
+        """Caches the menus parsed from a page, evicting the least recently used ones if the cache
+        is full.
+
+        :param key: key of the page (see key).
+        :param menus: MenuRecord, or None if the page has no menus.
+        """
+        size = self.entry_overhead + (menus.nbytes if menus is not None else 0)
+
+        # Never worth evicting everything else for a single page.
+        if size > self.max_bytes:
+            return
+
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            self.size -= old[1] if old else 0
+
+            # Entries are (menus, size) tuples.
+            self.__entries[key] = (menus, size)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, evicted = self.__entries.popitem(last=False)
+                self.size -= evicted[1]
+
+            parse_cache_bytes.set(self.size)
+
+    def __len__(self):
+        return len(self.__entries)
@@ -0,0 +1,264 @@
+from bs4 import BeautifulSoup
+from lxml import etree
+from re import sub, compile, IGNORECASE
+from threading import local
+from ucrfood.menu_record import MenuRecord
+
+
+class MenuParser:
+    """
+    Description: base class for menu page parsers. Every backend turns the raw bytes of a menu page
+    into the same list of menus:
+    [{'type': meal_name, 'content': {section_name: [item, ...], ...}}, ...]
+    Methods:
+    - parse : returns the list of menus found in a page, or None if the page has no menus.
+    - parse_record : same as parse, but returns the menus as a compact MenuRecord.
+    - page_encoding : returns the encoding a page is decoded with.
+    - build_sections : groups the text of menu entries into sections.
+    """
+    name = None
+
+    # Encoding declared by a page, in a meta tag or an XML declaration.
+    declared_encoding = compile(rb'<meta[^>]+charset(?:\s*=\s*["\']?([\w.:-]+))?|'
+                                rb'<\?xml[^>]+encoding(?:\s*=\s*["\']?([\w.:-]+))?', IGNORECASE)
+
+    def parse(self, page_content: bytes) -> list:
+        """Parses the menu web page for menu items and returns them in list form.
+
+        :param page_content: raw bytes of the page.
+        :return: list of menu items for each dining time (i.e. breakfast, lunch, & dinner), or None
+        if the page has no menus.
+        """
+        raise NotImplementedError
+
+    def parse_record(self, page_content: bytes) -> MenuRecord:
+        """Parses the menu web page and returns its menus in compact form. The parse tree and the
+        intermediate dicts are dropped before this returns.
+
+        :param page_content: raw bytes of the page.
+        :return: MenuRecord, or None if the page has no menus.
+        """
+        return MenuRecord.from_menus(self.parse(page_content))
+
+    @classmethod
+    def page_encoding(cls, page_content: bytes) -> str:
+        """Returns the encoding a page is decoded with: the one it declares or, without a
+        declaration, UTF-8 if it is valid UTF-8 and Windows-1252 otherwise. The declaration sits
+        outside the menu tables, so it is not covered by the page sum.
+
+        :param page_content: raw bytes of the page.
+        :return: lower case name of the encoding.
+        """
+        declared = cls.declared_encoding.search(page_content)
+
+        if declared:
+            name = declared.group(1) or declared.group(2) or b'declared'
+            return name.decode('ascii').lower()
+
+        try:
+            page_content.decode('utf-8')
+            return 'utf-8'
+        except UnicodeDecodeError:
+            return 'windows-1252'
+
+    @staticmethod
+    def build_sections(sec_items: list, strip_characters) -> dict:
+        """Groups the text of the menu entries of a single dining time into sections.
+
+        :param sec_items: text of every menu entry in page order.
+        :param strip_characters: function used to clean up menu items.
+        :return: dict mapping each section name to the list of its menu items.
+        """
+        # Subsections from each menu time with menu entries and the working section.
+        menu_sections = dict()
+        current_section = None
+
+        for item in sec_items:
+            if item[:2] == '--':
+                # If the item starts with '--' in the name, this is the working section.
+                section_name = item[3:-3]
+
+                # Set working section and update menu_sections dictionary.
+                current_section = section_name
+                menu_sections.update({section_name: []})
+            else:
+                # Remove extraneous characters from menu item.
+                menu_item = strip_characters(item)
+
+                # Append to list if not an empty string.
+                if menu_item:
+                    menu_sections.get(current_section).append(menu_item)
+
+        return menu_sections
+
+
+class SoupParser(MenuParser):
+    """
+    Description: reference parser built on BeautifulSoup. Slow, but the behaviour every other
+    backend has to match.
+    """
+    name = 'soup'
+
+    @staticmethod
+    def __strip_characters(input_str: str) -> str:
+        """Strips non alphanumeric characters and any duplicate whitespace.
+
+        :param input_str: string to clean.
+        :return: cleaned string.
+        """
+        filter_step = sub('[^a-zA-Z0-9-() *.]', '', input_str)
+        return sub(' +', ' ', filter_step)
+
+    def parse(self, page_content: bytes) -> list:
+        # Parse the page for the specific sections that need to be parsed.
+        html_tree = BeautifulSoup(page_content, 'lxml')
+        content = html_tree.find_all('td', attrs={'width': ['50%', '30%']})
+
+        if not content:
+            return None
+
+        # Breakfast, lunch, and dinner menus.
+        menus = []
+
+        for entry in content:
+            # Get text only from all elements within the page tree.
+            sec_items = [el.get_text() for el in entry.find_all(compile('a[name="Recipe_Desc"]'))]
+
+            # Append all the menu sections to the menu.
+            menus.append({'type': entry.find('div', class_='shortmenumeals').get_text(),
+                          'content': self.build_sections(sec_items, self.__strip_characters)})
+
+        return menus
+
+
+class LxmlParser(MenuParser):
+    """
+    Description: fast parser using lxml directly with precompiled XPath expressions and byte
+    translation tables. Produces the same menus as SoupParser.
+    """
+    name = 'lxml'
+
+    # Precompiled queries for the menu tables, the dining time name and element text.
+    menu_tables = etree.XPath('//td[@width="50%" or @width="30%"]')
+    meal_name = etree.XPath('.//div[contains(concat(" ", normalize-space(@class), " "), '
+                            '" shortmenumeals ")]')
+    text = etree.XPath('string()', smart_strings=False)
+
+    # SoupParser matches tag names against this pattern; results are memoized per tag name.
+    item_tag = compile('a[name="Recipe_Desc"]')
+    item_tag_matches = {}
+
+    # Every ASCII byte that __strip_characters drops. Non ASCII characters are dropped by encoding.
+    kept_bytes = b' ()*-.0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+    dropped_bytes = bytes(sorted(set(range(128)).difference(kept_bytes)))
+    duplicate_spaces = compile(' +')
+
+    def __init__(self):
+        # lxml parser objects must not be shared between threads.
+        self.__local = local()
+
+    def html_parser(self, encoding: str = None):
+        """Returns the lxml HTML parser belonging to the calling thread.
+
+        :param encoding: (optional) encoding the parser decodes pages with. If not given, the
+        parser uses the encoding the page declares.
+        :return: lxml HTMLParser.
+        """
+        if not hasattr(self.__local, 'parsers'):
+            self.__local.parsers = {}
+
+        if encoding not in self.__local.parsers:
+            self.__local.parsers[encoding] = etree.HTMLParser(encoding=encoding)
+
+        return self.__local.parsers[encoding]
+
+    @staticmethod
+    def __page_encoding(page_content: bytes) -> str:
+        """Works out the encoding of a page that has to be given to lxml. Pages declaring their
+        encoding are decoded with it. Others are decoded like SoupParser does (see page_encoding),
+        not as lxml's Latin-1.
+
+        :param page_content: raw bytes of the page.
+        :return: name of the encoding, or None if lxml can rely on the page's declaration.
+        """
+        if LxmlParser.declared_encoding.search(page_content):
+            return None
+
+        return LxmlParser.page_encoding(page_content)
+
+    @staticmethod
+    def __strip_characters(input_str: str) -> str:
+        """Strips non alphanumeric characters and any duplicate whitespace.
+
+        :param input_str: string to clean.
+        :return: cleaned string.
+        """
+        filter_step = input_str.encode('ascii', 'ignore')\
+            .translate(None, LxmlParser.dropped_bytes)\
+            .decode('ascii')
+
+        if '  ' in filter_step:
+            return LxmlParser.duplicate_spaces.sub(' ', filter_step)
+
+        return filter_step
+
+    @staticmethod
+    def __is_item_tag(tag) -> bool:
+        """Checks if an element holds a menu entry, based on its tag name.
+
+        :param tag: tag of the element.
+        :return: whether the element holds a menu entry.
+        """
+        matches = LxmlParser.item_tag_matches.get(tag)
+
+        if matches is None:
+            # Comments and processing instructions don't have string tags.
+            matches = isinstance(tag, str) and bool(LxmlParser.item_tag.search(tag))
+            LxmlParser.item_tag_matches[tag] = matches
+
+        return matches
+
+    def parse(self, page_content: bytes) -> list:
+        html_tree = etree.fromstring(page_content,
+                                     self.html_parser(self.__page_encoding(page_content)))
+
+        if html_tree is None:
+            return None
+
+        content = self.menu_tables(html_tree)
+
+        if not content:
+            return None
+
+        # Breakfast, lunch, and dinner menus.
+        menus = []
+
+        for entry in content:
+            # Get text only from all elements within the page tree.
+            sec_items = [self.text(el) for el in entry.iterdescendants()
+                         if self.__is_item_tag(el.tag)]
+
+            # Append all the menu sections to the menu.
+            menus.append({'type': self.text(self.meal_name(entry)[0]),
+                          'content': self.build_sections(sec_items, self.__strip_characters)})
+
+        return menus
+
+
+# Parser backends by name.
+parsers = {
+    SoupParser.name: SoupParser,
+    LxmlParser.name: LxmlParser
+}
+
+
+def get_parser(name: str) -> MenuParser:
+    """Creates the parser backend with the given name.
+
+    :param name: name of the backend (i.e. 'soup' or 'lxml').
+    :return: parser instance.
+    """
+    try:
+        return parsers[name]()
+    except KeyError:
+        raise ValueError('Unknown parser backend: {0}.'.format(name))
@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import tracemalloc
+from threading import Lock
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+
+class _ExportedStats:
+    """
+    Description: holder for a raw stats dict, in the form pstats.Stats loads profiles from.
+    """
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    """
+    Description: CPU and memory profile of a crawl, broken down by pipeline stage (read, fetch,
+    parse, write). Every call of a stage is profiled with cProfile in the calling thread, and the
+    first few calls of each stage can also record which lines allocated memory (tracemalloc).
+    Parsing processes profile themselves and send their results back with each page, so one report
+    covers the whole run.
+
+    cProfile only follows the thread that enabled it, so a stage's functions are those called by
+    its own calls (in the main thread, the fetch threads and the parsing processes); other threads,
+    such as those of the HTTP connection pool, are not profiled. From Python 3.12 on, profiling is
+    process-wide instead: only one call per process is profiled at a time (others are only timed),
+    and its stats also include whatever other threads run meanwhile.
+    Tracing memory slows everything down, so it is only switched on while a sampled call runs, and
+    only one call is sampled at a time. tracemalloc counts allocations of the whole process, so
+    allocations made by other threads while a stage is sampled are included in it.
+    Methods:
+    - stage : context manager profiling one call of a stage.
+    - export : returns (and clears) the results in a picklable form.
+    - merge : adds results exported by another process.
+    - report : returns the results as a JSON serializable dict.
+    - save : writes the report and a pstats file for every stage.
+    """
+    def __init__(self, top: int = 25, memory_samples: int = 0):
+        """
+        :param top: number of functions and allocation sites listed for every stage.
+        :param memory_samples: number of calls of each stage (per process) that record memory
+        allocations. Tracing memory is slow, so none do by default.
+        """
+        self.top = top
+        self.memory_samples = memory_samples
+
+        # Results for every stage: {stage: {'calls', 'seconds', 'stats', 'memory', 'sampled'}},
+        # where stats is a pstats.Stats and memory a Counter of bytes by allocation site.
+        self.__stages = {}
+        self.__lock = Lock()
+
+        # Set while a call is sampled, so samples of different threads don't overlap.
+        self.__sampling = False
+
+    def __stage(self, name: str) -> dict:
+        """Returns the results of a stage, creating them if needed. Must be called with the lock
+        held.
+
+        :param name: name of the stage.
+        :return: results dict.
+        """
+        if name not in self.__stages:
+            self.__stages[name] = {'calls': 0,
+                                   'seconds': 0.0,
+                                   'stats': pstats.Stats(),
+                                   'memory': Counter(),
+                                   'sampled': 0}
+
+        return self.__stages[name]
+
+    def __take_memory_sample(self, name: str) -> bool:
+        """Decides whether this call of a stage records memory allocations.
+
+        :param name: name of the stage.
+        :return: true if it does.
+        """
+        with self.__lock:
+            stage = self.__stage(name)
+
+            if self.__sampling or stage.get('sampled') >= self.memory_samples:
+                return False
+
+            stage['sampled'] += 1
+            self.__sampling = True
+            return True
+
+    @staticmethod
+    def __snapshot():
+        """Takes a tracemalloc snapshot without the allocations of profiling itself.
+
+        :return: tracemalloc Snapshot.
+        """
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, __file__)
+        ])
+
+    @contextmanager
+    def __memory_sample(self, memory: Counter):
+        """Traces the memory allocated within the context, adding the bytes still allocated at its
+        end to memory by allocation site. Tracing is started for the context and stopped after,
+        unless something else was tracing already; then the difference of two snapshots is used.
+
+        :param memory: Counter the allocations are added to.
+        """
+        owned = not tracemalloc.is_tracing()
+
+        try:
+            if owned:
+                tracemalloc.start()
+                before = None
+            else:
+                before = self.__snapshot()
+
+            yield
+
+            after = self.__snapshot()
+            stats = after.compare_to(before, 'lineno') if before else after.statistics('lineno')
+
+            for stat in stats:
+                size = stat.size_diff if before else stat.size
+
+                if size > 0:
+                    frame = stat.traceback[0]
+                    memory['{0}:{1}'.format(frame.filename, frame.lineno)] += size
+        finally:
+            if owned:
+                tracemalloc.stop()
+
+            with self.__lock:
+                self.__sampling = False
+
+    @contextmanager
+    def stage(self, name: str):
+        """Profiles the code run within the context as one call of a stage.
+
+        :param name: name of the stage.
+        """
+        profile = cProfile.Profile()
+        memory = Counter()
+        sample = self.__memory_sample(memory) if self.__take_memory_sample(name) else nullcontext()
+        start = perf_counter()
+
+        try:
+            with sample:
+                try:
+                    profile.enable()
+                except ValueError:
+                    # Only one profiler can be active at a time from Python 3.12 on.
+                    profile = None
+
+                try:
+                    yield
+                finally:
+                    if profile:
+                        profile.disable()
+        finally:
+            seconds = perf_counter() - start
+
+            with self.__lock:
+                stage = self.__stage(name)
+                stage['calls'] += 1
+                stage['seconds'] += seconds
+                stage['memory'].update(memory)
+
+                if profile:
+                    profile.create_stats()
+
+                    if profile.stats:
+                        stage.get('stats').add(profile)
+
+    def export(self) -> dict:
+        """Returns the results collected so far in a form that can be sent to another process, and
+        starts over.
+
+        :return: {stage: {'calls', 'seconds', 'stats', 'memory'}} with plain dicts.
+        """
+        with self.__lock:
+            exported = {name: {'calls': s.get('calls'),
+                               'seconds': s.get('seconds'),
+                               'stats': s.get('stats').stats,
+                               'memory': dict(s.get('memory'))}
+                        for name, s in self.__stages.items()}
+
+            # The sample count is kept, so a process only ever samples memory_samples calls.
+            for s in self.__stages.values():
+                s.update(calls=0, seconds=0.0, stats=pstats.Stats(), memory=Counter())
+
+        return exported
+
+    def merge(self, exported: dict):
+        """Adds results exported by another process.
+
+        :param exported: return value of export.
+        """
+        with self.__lock:
+            for name, results in exported.items():
+                stage = self.__stage(name)
+                stage['calls'] += results.get('calls')
+                stage['seconds'] += results.get('seconds')
+                stage['memory'].update(results.get('memory'))
+
+                if results.get('stats'):
+                    stage.get('stats').add(_ExportedStats(results.get('stats')))
+
+    def report(self) -> dict:
+        """Returns the top functions by cumulative time and the top allocation sites of every
+        stage.
+
+        :return: {stage: {'calls', 'seconds', 'functions', 'allocations'}}.
+        """
+        report = {}
+
+        with self.__lock:
+            for name, stage in sorted(self.__stages.items()):
+                stats = stage.get('stats')
+                functions = []
+
+                if stats.stats:
+                    stats.sort_stats('cumulative')
+
+                    for key in stats.fcn_list[:self.top]:
+                        _, calls, own, cumulative, _ = stats.stats[key]
+                        functions.append({'function': pstats.func_std_string(key),
+                                          'calls': calls,
+                                          'own_seconds': own,
+                                          'cumulative_seconds': cumulative})
+
+                report[name] = {'calls': stage.get('calls'),
+                                'seconds': stage.get('seconds'),
+                                'functions': functions,
+                                'allocations': [{'site': site, 'bytes': size} for site, size
+                                                in stage.get('memory').most_common(self.top)]}
+
+        return report
+
+    def save(self, directory: str, started: float) -> str:
+        """Writes the report as JSON, along with the merged cProfile stats of every stage (which
+        can be opened with pstats or snakeviz).
+
+        :param directory: directory to write to.
+        :param started: unix time the run started at, used in the file names.
+        :return: path of the JSON report.
+        """
+        os.makedirs(directory, exist_ok=True)
+        prefix = os.path.join(directory, 'profile-{0}'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.gmtime(started))))
+
+        report = self.report()
+
+        with self.__lock:
+            for name, stage in self.__stages.items():
+                if stage.get('stats').stats:
+                    stage.get('stats').dump_stats('{0}-{1}.pstats'.format(prefix, name))
+
+        with open(prefix + '.json', 'w') as f:
+            json.dump(report, f, indent=2)
+
+        return prefix + '.json'
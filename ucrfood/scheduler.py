@@ -0,0 +1,134 @@
+import time
+from random import uniform
+
+
+class RefreshScheduler:
+    """
+    Description: decides when each (location, date) menu page should be fetched again. Pages for
+    today and tomorrow are refreshed often, pages further in the future less and less often, and
+    pages whose content keeps coming back unchanged are backed off further. Pages that could not
+    be downloaded are retried after retry_interval, doubled for every failure in a row. Every
+    interval gets some jitter so pages don't all come due at the same moment.
+    Methods:
+    - due : returns the pages that should be fetched now.
+    - record : stores the outcome of fetching a page.
+    - record_failure : stores that a page could not be downloaded.
+    - seconds_until_next : returns how long until the next page comes due.
+    """
+    def __init__(self, near_interval: float = 3600, far_interval: float = 86400, near_days: int = 1,
+                 max_backoff: int = 4, jitter: float = 0.1, retry_interval: float = 60):
+        """Sets up the refresh policy.
+
+        :param near_interval: seconds between refreshes of pages up to near_days in the future.
+        :param far_interval: longest time in seconds any page goes without a refresh.
+        :param near_days: pages for dates up to this many days from today are polled most often.
+        :param max_backoff: largest factor an interval is multiplied by for unchanged pages.
+        :param jitter: fraction of the interval the refresh time is randomly moved by.
+        :param retry_interval: seconds before a page that could not be downloaded is tried again.
+        """
+        self.near_interval = near_interval
+        self.far_interval = far_interval
+        self.near_days = near_days
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_interval = retry_interval
+
+        # Refresh state for every page: {url: {'checked', 'unchanged', 'failed', 'jitter'}}.
+        self.__state = {}
+
+    def __interval(self, day: int, unchanged: int) -> float:
+        """Works out the refresh interval for a page.
+
+        :param day: number of days between today and the menu date.
+        :param unchanged: number of times in a row the page was fetched without changes.
+        :return: interval in seconds.
+        """
+        # Double the interval for every day past near_days, then back off unchanged pages.
+        interval = self.near_interval * 2 ** max(0, day - self.near_days)
+        interval *= min(2 ** unchanged, self.max_backoff)
+
+        return min(interval, self.far_interval)
+
+    def __next_refresh(self, url: str, day: int) -> float:
+        """Returns the time the given page should be fetched again.
+
+        :param url: url of the page.
+        :param day: number of days between today and the menu date.
+        :return: unix time; 0 for pages that were never fetched.
+        """
+        state = self.__state.get(url)
+
+        if not state:
+            return 0
+
+        if state.get('failed'):
+            interval = min(self.retry_interval * 2 ** (state.get('failed') - 1), self.far_interval)
+        else:
+            # The interval is worked out from the current day offset, so pages are refreshed
+            # more often as their date comes closer.
+            interval = self.__interval(day, state.get('unchanged'))
+
+        return state.get('checked') + interval * state.get('jitter')
+
+    def due(self, entries: list, now: float = None) -> list:
+        """Returns the pages that should be fetched now. State for pages that are no longer in
+        entries (i.e. dates in the past) is dropped.
+
+        :param entries: list of (url, day) tuples for every page that may be fetched.
+        :param now: (optional) current unix time.
+        :return: list of (url, day) tuples to fetch.
+        """
+        now = now or time.time()
+
+        # Forget about pages that dropped out of the url block.
+        urls = {u for u, _ in entries}
+        for url in [u for u in self.__state if u not in urls]:
+            del self.__state[url]
+
+        return [(u, d) for u, d in entries if self.__next_refresh(u, d) <= now]
+
+    def record(self, url: str, changed: bool, now: float = None):
+        """Stores the outcome of fetching a page.
+
+        :param url: url of the page.
+        :param changed: whether the page content changed since it was last fetched.
+        :param now: (optional) current unix time.
+        """
+        state = self.__state.get(url) or {'unchanged': 0}
+
+        state['checked'] = now or time.time()
+        state['unchanged'] = 0 if changed else state.get('unchanged') + 1
+        state['failed'] = 0
+        state['jitter'] = uniform(1 - self.jitter, 1 + self.jitter)
+
+        self.__state[url] = state
+
+    def record_failure(self, url: str, now: float = None):
+        """Stores that a page could not be downloaded, even after retrying. It is tried again
+        after retry_interval, twice as long for every failure in a row (up to far_interval), so
+        pages that keep failing don't keep the crawler busy.
+
+        :param url: url of the page.
+        :param now: (optional) current unix time.
+        """
+        state = self.__state.get(url) or {'unchanged': 0}
+
+        state['checked'] = now or time.time()
+        state['failed'] = state.get('failed', 0) + 1
+        state['jitter'] = uniform(1 - self.jitter, 1 + self.jitter)
+
+        self.__state[url] = state
+
+    def seconds_until_next(self, entries: list, now: float = None) -> float:
+        """Returns how long until the next page comes due.
+
+        :param entries: list of (url, day) tuples for every page that may be fetched.
+        :param now: (optional) current unix time.
+        :return: seconds until the next refresh; 0 if a page is already due.
+        """
+        now = now or time.time()
+
+        if not entries:
+            return self.far_interval
+
+        return max(0, min(self.__next_refresh(u, d) for u, d in entries) - now)
@@ -0,0 +1,112 @@
+from re import compile
+from hashlib import md5
+
+
+class ItemIndex:
+    """
+    Description: inverted index from normalized menu item tokens to the places the items were
+    served, i.e. (location, date, meal, section). It is kept up to date incrementally: every time
+    menus are written, their old postings are replaced with new ones. Lookups go through the
+    token index of the postings table, so they don't scan menu documents.
+    Methods:
+    - tokenize : splits text into normalized tokens.
+    - update : replaces the postings of the given menus.
+    - search : finds items matching every term of a query.
+    """
+    token_pattern = compile('[a-z0-9]+')
+
+    def __init__(self, database):
+        """
+        :param database: connected Database holding the 'menus' and 'items' tables.
+        """
+        self.database = database
+
+    @staticmethod
+    def tokenize(text: str) -> list:
+        """Splits text into lowercase alphanumeric tokens, without duplicates.
+
+        :param text: text to split, e.g. a menu item.
+        :return: list of tokens in order of first appearance.
+        """
+        tokens = ItemIndex.token_pattern.findall(text.lower())
+        return list(dict.fromkeys(tokens))
+
+    def postings(self, menu: dict) -> list:
+        """Creates a posting for every token of every item of a menu.
+
+        :param menu: menu as created by FoodSort.
+        :return: list of posting documents.
+        """
+        location = menu.get('location')
+        menu_date = menu.get('time_info').get('menu_date')
+        menu_id = self.database.menu_key(location.get('num'), menu_date)
+
+        postings = []
+
+        for meal in menu.get('menus') or []:
+            for section, items in meal.get('content').items():
+                for item in items:
+                    for token in self.tokenize(item):
+                        key = '|'.join((menu_id, meal.get('type'), section, item, token))
+                        postings.append({'id': md5(key.encode('utf-8')).hexdigest(),
+                                         'token': token,
+                                         'menu_id': menu_id,
+                                         'location': location,
+                                         'menu_date': menu_date,
+                                         'meal': meal.get('type'),
+                                         'section': section,
+                                         'item': item})
+
+        return postings
+
+    def update(self, menus: list):
+        """Replaces the postings of the given menus with ones for their current items.
+
+        :param menus: menus that were just written.
+        """
+        menu_ids = [self.database.menu_key(m.get('location').get('num'),
+                                           m.get('time_info').get('menu_date')) for m in menus]
+        postings = [p for m in menus for p in self.postings(m)]
+
+        self.database.replace_item_postings(menu_ids, postings)
+
+    def search(self, query: str, prefix: bool = False, start_date: str = None,
+               end_date: str = None) -> list:
+        """Finds menu items matching every term of the query.
+
+        :param query: search terms, e.g. 'chicken teriyaki'.
+        :param prefix: if true, the last term also matches tokens it is a prefix of (for
+        type-ahead).
+        :param start_date: (optional) ISO 8601 date of the earliest menu to include.
+        :param end_date: (optional) ISO 8601 date of the latest menu to include.
+        :return: list of dicts with location, menu_date, meal, section and item, ordered by date.
+        """
+        terms = self.tokenize(query)
+
+        if not terms:
+            return []
+
+        matches = None
+
+        for i, term in enumerate(terms):
+            is_prefix = prefix and i == len(terms) - 1
+            found = {}
+
+            for p in self.database.find_item_postings(term, is_prefix, start_date, end_date):
+                found[(p.get('menu_id'), p.get('meal'), p.get('section'), p.get('item'))] = p
+
+            # Keep only the items that matched every term so far.
+            matches = found if matches is None else {k: v for k, v in matches.items()
+                                                     if k in found}
+
+            if not matches:
+                return []
+
+        results = [{'location': p.get('location'),
+                    'menu_date': p.get('menu_date'),
+                    'meal': p.get('meal'),
+                    'section': p.get('section'),
+                    'item': p.get('item')} for p in matches.values()]
+
+        return sorted(results, key=lambda r: (r['menu_date'], r['location'].get('num'),
+                                              r['meal'], r['section'], r['item']))
@@ -0,0 +1,603 @@
+import os
+import json
+import sqlite3
+import time
+from time import perf_counter
+from threading import Lock
+from datetime import datetime, timedelta
+from ucrfood.storage import Database, rows_written_total
+
+
+class SQLiteDatabase(Database):
+    """
+    Description: storage in an embedded SQLite file, for single node deployments and for running
+    the whole pipeline without any outside service. The file is used in WAL mode, so the read
+    service and other processes keep reading while the crawler writes. Menus are stored as JSON
+    next to indexed location and date columns, and every batch is written in one transaction.
+    Stored menus are updated in place with json_set, so only the fields and meals that changed are
+    sent to SQLite.
+    Changed menus are found by polling PRAGMA data_version, which changes whenever another
+    connection commits.
+    """
+    name = 'sqlite'
+
+    # Tables and their indexes, created once by migrate(). Every write to 'menus' stamps the rows
+    # it writes with the next version, so readers can ask for everything written since.
+    schema = [
+        'CREATE TABLE IF NOT EXISTS menus (id TEXT PRIMARY KEY, location TEXT NOT NULL, '
+        'menu_date TEXT NOT NULL, url TEXT, sum TEXT, version INTEGER NOT NULL, doc TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS menus_location_date ON menus (location, menu_date)',
+        'CREATE INDEX IF NOT EXISTS menus_menu_date ON menus (menu_date)',
+        'CREATE INDEX IF NOT EXISTS menus_version ON menus (version)',
+        'CREATE INDEX IF NOT EXISTS menus_date_id ON menus (menu_date, id)',
+        # What changed in every menu, appended whenever its items change (see ucrfood.menu_diff).
+        'CREATE TABLE IF NOT EXISTS menu_history (id TEXT PRIMARY KEY, location TEXT NOT NULL, '
+        'menu_date TEXT NOT NULL, changed_at REAL NOT NULL, doc TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS menu_history_location_date ON menu_history '
+        '(location, menu_date, changed_at)',
+        # Postings of the menu item search index (see ucrfood.search).
+        'CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, token TEXT NOT NULL, '
+        'menu_id TEXT NOT NULL, menu_date TEXT NOT NULL, doc TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS items_token_date ON items (token, menu_date)',
+        'CREATE INDEX IF NOT EXISTS items_menu_id ON items (menu_id)',
+        # Text of the meal, section and item IDs of encoded menus (see ucrfood.catalog).
+        'CREATE TABLE IF NOT EXISTS catalog (id INTEGER PRIMARY KEY, text TEXT NOT NULL UNIQUE)',
+        # Urls waiting to be crawled by distributed workers (see ucrfood.work_queue).
+        'CREATE TABLE IF NOT EXISTS work_queue (id TEXT PRIMARY KEY, url TEXT NOT NULL, '
+        'day INTEGER, owner TEXT, lease_until REAL NOT NULL, '
+        'attempts INTEGER NOT NULL DEFAULT 0)',
+        'CREATE INDEX IF NOT EXISTS work_queue_lease_until ON work_queue (lease_until)',
+        # One-time data migrations that have been run (see Database._migrate_data).
+        'CREATE TABLE IF NOT EXISTS migrations (id TEXT PRIMARY KEY, finished_at REAL NOT NULL)'
+    ]
+
+    # Maximum number of values bound in a single IN (...) list.
+    max_variables = 500
+
+    def __init__(self, path: str, poll_interval: float = 0.5):
+        """Opens the database file, creating it if needed.
+
+        :param path: path of the database file.
+        :param poll_interval: seconds between checks for changed menus in menu_changes.
+        """
+        self.path = path
+        self.poll_interval = poll_interval
+
+        super().__init__()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # The connection may be shared between threads, so statements are serialized.
+        self.conn = self.__new_connection()
+        self.__lock = Lock()
+
+    def __new_connection(self):
+        """Opens a new connection to the database file. Transactions are started explicitly, and
+        waiting for another process to finish writing is left to SQLite.
+
+        :return: connection.
+        """
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+
+        return conn
+
+    def __write(self, operation: str, write):
+        """Runs a function in a single write transaction and records how long it took. The write
+        lock is taken up front, so the function sees and changes a consistent database.
+
+        :param operation: name of the operation, used as metric label.
+        :param write: function taking the connection.
+        :return: result of the function.
+        """
+        start = perf_counter()
+
+        with self.__lock:
+            try:
+                self.conn.execute('BEGIN IMMEDIATE')
+
+                try:
+                    result = write(self.conn)
+                except BaseException:
+                    self.conn.execute('ROLLBACK')
+                    raise
+
+                self.conn.execute('COMMIT')
+                return result
+            finally:
+                self._timed(operation, start)
+
+    def __query(self, operation: str, sql: str, params=()) -> list:
+        """Runs a query and records how long it took.
+
+        :param operation: name of the operation, used as metric label.
+        :param sql: query to run.
+        :param params: values bound to the query.
+        :return: list of rows.
+        """
+        start = perf_counter()
+
+        with self.__lock:
+            try:
+                return self.conn.execute(sql, params).fetchall()
+            finally:
+                self._timed(operation, start)
+
+    @staticmethod
+    def __select_in(conn, sql: str, values, params=()) -> list:
+        """Runs a query with an IN (...) list in chunks, as SQLite limits the number of bound
+        values.
+
+        :param conn: connection to run the query on.
+        :param sql: query with {0} in place of the IN list and params bound before it.
+        :param values: values of the IN list.
+        :param params: values bound before the IN list.
+        :return: list of rows of every chunk.
+        """
+        values = list(values)
+        rows = []
+
+        for i in range(0, len(values), SQLiteDatabase.max_variables):
+            chunk = values[i:i + SQLiteDatabase.max_variables]
+            query = sql.format(', '.join('?' * len(chunk)))
+            rows.extend(conn.execute(query, tuple(params) + tuple(chunk)).fetchall())
+
+        return rows
+
+    # Columns added to tables after they were first created, as (table, column, definition).
+    added_columns = [
+        ('work_queue', 'attempts', 'INTEGER NOT NULL DEFAULT 0')
+    ]
+
+    def __migrate(self, conn):
+        """Creates every table and index in the schema, and adds the columns tables created by
+        older versions are missing.
+
+        :param conn: connection in a write transaction.
+        """
+        for statement in self.schema:
+            conn.execute(statement)
+
+        for table, column, definition in self.added_columns:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info({0})'.format(table))]
+
+            if column not in columns:
+                conn.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(table, column, definition))
+
+    def migrate(self):
+        """Creates every table and index in the schema if they don't exist yet, then runs the
+        data migrations that haven't been run.
+        """
+        self.__write('migrate', self.__migrate)
+        self._migrate_data()
+
+    def _finished_migrations(self) -> set:
+        """Returns the names of the data migrations that have been run.
+
+        :return: set of names.
+        """
+        return {name for name, in self.__query('migrations', 'SELECT id FROM migrations')}
+
+    def _finish_migration(self, name: str):
+        """Records that a data migration has been run.
+
+        :param name: name of the migration.
+        """
+        self.__write('migrations', lambda conn: conn.execute(
+            'INSERT OR REPLACE INTO migrations (id, finished_at) VALUES (?, ?)',
+            (name, time.time())))
+
+    def _catalog_ids(self, texts: set) -> list:
+        """Returns the catalog entries of the given texts, adding the texts that are not in the
+        catalog yet. SQLite hands out the new IDs.
+
+        :param texts: meal, section and item names.
+        :return: list of {'id', 'text'} dicts.
+        """
+        def add(conn):
+            conn.executemany('INSERT OR IGNORE INTO catalog (text) VALUES (?)',
+                             [(t,) for t in sorted(texts)])
+            return self.__select_in(conn, 'SELECT id, text FROM catalog WHERE text IN ({0})', texts)
+
+        return [{'id': i, 'text': t} for i, t in self.__write('insert_catalog', add)]
+
+    def _catalog_texts(self, ids: set) -> list:
+        """Returns the catalog entries with the given IDs.
+
+        :param ids: catalog IDs.
+        :return: list of {'id', 'text'} dicts.
+        """
+        start = perf_counter()
+
+        with self.__lock:
+            try:
+                rows = self.__select_in(self.conn, 'SELECT id, text FROM catalog WHERE id IN ({0})',
+                                        ids)
+            finally:
+                self._timed('get_catalog', start)
+
+        return [{'id': i, 'text': t} for i, t in rows]
+
+    @staticmethod
+    def __put_menus(conn, menus: list, dates: list = None) -> int:
+        """Inserts or replaces menus, stamping them with the next version.
+
+        :param conn: connection in a write transaction.
+        :param menus: encoded menus with their primary key set.
+        :param dates: (optional) dates to store the menus under instead of their menu_date.
+        :return: number of menus written.
+        """
+        version = conn.execute('SELECT coalesce(max(version), 0) + 1 FROM menus').fetchone()[0]
+        dates = dates or [m.get('time_info').get('menu_date') for m in menus]
+
+        conn.executemany('INSERT OR REPLACE INTO menus (id, location, menu_date, url, sum, '
+                         'version, doc) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         [(m.get('id'), m.get('location').get('num'), d, m.get('url'),
+                           m.get('sum'), version, json.dumps(m)) for m, d in zip(menus, dates)])
+
+        return len(menus)
+
+    @staticmethod
+    def __patch_menus(conn, updates: list, sums: dict) -> list:
+        """Writes the changed fields and meals of stored menus, stamping them with the next
+        version. A menu is only patched if its stored sum is still the one it was compared with.
+
+        :param conn: connection in a write transaction.
+        :param updates: (document, fields, patches) tuples, see Database._deltas.
+        :param sums: stored sum of every menu, by primary key.
+        :return: documents of the menus that changed since they were read, to be written whole.
+        """
+        version = conn.execute('SELECT coalesce(max(version), 0) + 1 FROM menus').fetchone()[0]
+        stale = []
+
+        for doc, fields, patches in updates:
+            paths = []
+
+            for key, value in fields.items():
+                paths.extend(('$.' + key, json.dumps(value)))
+
+            for index, meal in patches:
+                paths.extend(('$.menus[{0}]'.format(index), json.dumps(meal)))
+
+            if not paths:
+                continue
+
+            cursor = conn.execute('UPDATE menus SET url = ?, sum = ?, version = ?, '
+                                  'doc = json_set(doc, {0}) WHERE id = ? AND sum IS ?'.format(
+                                      ', '.join(['?, json(?)'] * (len(paths) // 2))),
+                                  (doc.get('url'), doc.get('sum'), version) + tuple(paths) +
+                                  (doc.get('id'), sums.get(doc.get('id'))))
+
+            if not cursor.rowcount:
+                stale.append(doc)
+
+        return stale
+
+    def __upsert(self, conn, inserts: list, updates: list, history: list, sums: dict) -> int:
+        """Writes the deltas of a chunk of menus and appends their history.
+
+        :param conn: connection in a write transaction.
+        :param inserts: encoded menus to write whole.
+        :param updates: (document, fields, patches) tuples of stored menus.
+        :param history: menu history documents.
+        :param sums: stored sum of every menu, by primary key.
+        :return: number of menus written.
+        """
+        # Stale updates are written whole, but still count once, as updates.
+        written = len(inserts) + len(updates)
+        inserts = inserts + self.__patch_menus(conn, updates, sums)
+
+        if inserts:
+            self.__put_menus(conn, inserts)
+
+        conn.executemany('INSERT INTO menu_history (id, location, menu_date, changed_at, doc) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         [(h.get('id'), h.get('location'), h.get('menu_date'),
+                           h.get('changed_at'), json.dumps(h)) for h in history])
+
+        return written
+
+    def upsert_menus(self, menus: list, chunk_size: int = 200) -> int:
+        """Inserts new menus and updates stored ones with what changed, recording the changes in
+        the menu history. Stored menus are read first and each chunk is written in a single
+        transaction.
+
+        :param menus: menus to write to the 'menus' table.
+        :param chunk_size: maximum number of menus written in a single transaction.
+        :return: number of menus written.
+        """
+        written = 0
+
+        for i in range(0, len(menus), chunk_size):
+            chunk = menus[i:i + chunk_size]
+            keys = [self._with_key(m).get('id') for m in chunk]
+            start = perf_counter()
+
+            with self.__lock:
+                try:
+                    rows = self.__select_in(self.conn,
+                                            'SELECT id, doc FROM menus WHERE id IN ({0})', keys)
+                finally:
+                    self._timed('get_stored', start)
+
+            stored = {k: json.loads(doc) for k, doc in rows}
+            sums = {k: doc.get('sum') for k, doc in stored.items()}
+            inserts, updates, history = self._deltas(chunk, stored)
+
+            written += self.__write('upsert', lambda conn: self.__upsert(conn, inserts, updates,
+                                                                         history, sums))
+
+        rows_written_total.inc(written)
+
+        return written
+
+    def update_menu_on_date(self, date: str, menu: dict):
+        """Replace menu for specific date in 'menus' table.
+
+        :param date: date to replace menu entry on.
+        :param menu: menu to replace with.
+        """
+        key = self.menu_key(menu.get('location').get('num'), date)
+        menu = dict(self._encode([menu])[0], id=key)
+
+        self.__write('replace', lambda conn: self.__put_menus(conn, [menu], [date]))
+        rows_written_total.inc()
+
+    def get_menu_history(self, location_num: str, start_date: str, end_date: str) -> list:
+        """Returns the changes to the menus of a location between two dates (both included).
+
+        :param location_num: location number of the dining hall.
+        :param start_date: ISO 8601 date of the first menu.
+        :param end_date: ISO 8601 date of the last menu.
+        :return: list of history documents, by menu date and then in the order they were made.
+        """
+        rows = self.__query('history',
+                            'SELECT doc FROM menu_history WHERE location = ? AND menu_date >= ? '
+                            'AND menu_date <= ? ORDER BY menu_date, changed_at, rowid',
+                            (location_num, start_date, end_date))
+
+        return [json.loads(doc) for doc, in rows]
+
+    def replace_item_postings(self, menu_ids: list, postings: list, chunk_size: int = 1000):
+        """Replaces every search index posting of the given menus in a single transaction.
+
+        :param menu_ids: primary keys of the menus whose postings are replaced.
+        :param postings: new postings for those menus.
+        :param chunk_size: maximum number of postings bound in a single statement.
+        """
+        def replace(conn):
+            for i in range(0, len(menu_ids), self.max_variables):
+                chunk = menu_ids[i:i + self.max_variables]
+                conn.execute('DELETE FROM items WHERE menu_id IN ({0})'.format(
+                    ', '.join('?' * len(chunk))), chunk)
+
+            for i in range(0, len(postings), chunk_size):
+                conn.executemany('INSERT OR REPLACE INTO items (id, token, menu_id, menu_date, '
+                                 'doc) VALUES (?, ?, ?, ?, ?)',
+                                 [(p.get('id'), p.get('token'), p.get('menu_id'),
+                                   p.get('menu_date'), json.dumps(p))
+                                  for p in postings[i:i + chunk_size]])
+
+        self.__write('replace_postings', replace)
+
+    def find_item_postings(self, token: str, prefix: bool = False, start_date: str = None,
+                           end_date: str = None) -> list:
+        """Returns the search index postings of a token.
+
+        :param token: normalized token to look up.
+        :param prefix: if true, return postings of every token starting with the given one.
+        :param start_date: (optional) ISO 8601 date of the earliest menu to include.
+        :param end_date: (optional) ISO 8601 date of the latest menu to include.
+        :return: list of postings.
+        """
+        dates = (start_date or '', end_date or '\uffff')
+
+        if not prefix:
+            rows = self.__query('find_postings',
+                                'SELECT doc FROM items WHERE token = ? AND menu_date >= ? '
+                                'AND menu_date <= ?', (token,) + dates)
+        else:
+            rows = self.__query('find_postings',
+                                'SELECT doc FROM items WHERE token >= ? AND token < ? '
+                                'AND menu_date >= ? AND menu_date <= ?',
+                                (token, token + '\uffff') + dates)
+
+        return [json.loads(doc) for doc, in rows]
+
+    def enqueue_work(self, items: list) -> int:
+        """Adds items to the work queue, ready to be claimed. Items that are already queued are
+        left as they are.
+
+        :param items: queue items with 'id' and 'url' fields.
+        :return: number of items added.
+        """
+        def enqueue(conn):
+            before = conn.total_changes
+            conn.executemany('INSERT OR IGNORE INTO work_queue (id, url, day, owner, lease_until) '
+                             'VALUES (?, ?, ?, NULL, 0)',
+                             [(i.get('id'), i.get('url'), i.get('day')) for i in items])
+            return conn.total_changes - before
+
+        return self.__write('enqueue_work', enqueue)
+
+    def claim_work(self, owner: str, lease_seconds: int, limit: int) -> list:
+        """Leases up to limit queue items whose lease has run out (or that were never leased).
+        Claims happen in a write transaction, so two workers never get the same item. Leases are
+        timed by the local clock, which all workers sharing the database file must agree on.
+
+        :param owner: id of the claiming worker.
+        :param lease_seconds: length of the lease.
+        :param limit: maximum number of items to claim.
+        :return: list of claimed items.
+        """
+        def claim(conn):
+            now = time.time()
+            rows = conn.execute('SELECT id, url, day, attempts + 1 FROM work_queue '
+                                'WHERE lease_until <= ? ORDER BY lease_until LIMIT ?',
+                                (now, limit)).fetchall()
+            lease_until = now + lease_seconds
+
+            conn.executemany('UPDATE work_queue SET owner = ?, lease_until = ?, attempts = ? '
+                             'WHERE id = ?', [(owner, lease_until, a, i) for i, _, _, a in rows])
+
+            return [{'id': i, 'url': u, 'day': d, 'owner': owner, 'lease_until': lease_until,
+                     'attempts': a} for i, u, d, a in rows]
+
+        return self.__write('claim_work', claim)
+
+    def renew_work(self, owner: str, ids: list, lease_seconds: int):
+        """Extends the lease of queue items, unless another worker has claimed them since.
+
+        :param owner: id of the worker holding the lease.
+        :param ids: ids of the leased items.
+        :param lease_seconds: length of the new lease, from now.
+        """
+        self.__write('renew_work', lambda conn: conn.executemany(
+            'UPDATE work_queue SET lease_until = ? WHERE id = ? AND owner = ?',
+            [(time.time() + lease_seconds, i, owner) for i in ids]))
+
+    def release_work(self, owner: str, ids: list):
+        """Removes finished items from the work queue, unless another worker has claimed them
+        since.
+
+        :param owner: id of the worker holding the lease.
+        :param ids: ids of the leased items.
+        """
+        self.__write('release_work', lambda conn: conn.executemany(
+            'DELETE FROM work_queue WHERE id = ? AND owner = ?', [(i, owner) for i in ids]))
+
+    def count_work(self) -> int:
+        """Returns the number of items in the work queue.
+
+        :return: number of items.
+        """
+        return self.__query('count_work', 'SELECT count(*) FROM work_queue')[0][0]
+
+    def get_page_info_within_range(self, day_delta: int) -> list:
+        """Returns the sum and url of every menu from the current date to n days from now.
+
+        :param day_delta: number of days from the current date to pull.
+        :return: list of {'sum', 'url'} dicts.
+        """
+        start_date = datetime.now().date().isoformat()
+        end_date = (datetime.now().date() + timedelta(days=day_delta)).isoformat()
+
+        rows = self.__query('page_info',
+                            'SELECT sum, url FROM menus WHERE menu_date >= ? AND menu_date < ?',
+                            (start_date, end_date))
+
+        return [{'sum': s, 'url': u} for s, u in rows]
+
+    def get_menu(self, location_num: str, menu_date: str) -> dict:
+        """Returns the menu of a location on a given date.
+
+        :param location_num: location number of the dining hall.
+        :param menu_date: ISO 8601 date of the menu.
+        :return: menu document, or None if there is none.
+        """
+        rows = self.__query('get', 'SELECT doc FROM menus WHERE id = ?',
+                            (self.menu_key(location_num, menu_date),))
+
+        return self._decode([json.loads(rows[0][0])])[0] if rows else None
+
+    def get_menus(self, location_num: str, start_date: str, end_date: str) -> list:
+        """Returns the menus of a location between two dates (both included), in date order.
+
+        :param location_num: location number of the dining hall.
+        :param start_date: ISO 8601 date of the first menu.
+        :param end_date: ISO 8601 date of the last menu.
+        :return: list of menu documents.
+        """
+        rows = self.__query('range',
+                            'SELECT doc FROM menus WHERE location = ? AND menu_date >= ? '
+                            'AND menu_date <= ? ORDER BY menu_date',
+                            (location_num, start_date, end_date))
+
+        return self._decode([json.loads(doc) for doc, in rows])
+
+    def export_watermark(self) -> int:
+        """Returns the version of the menus written last.
+
+        :return: watermark.
+        """
+        return self.__query('watermark', 'SELECT coalesce(max(version), 0) FROM menus')[0][0]
+
+    def stream_menus(self, start_date: str = None, end_date: str = None, since: int = None,
+                     until: int = None, batch_size: int = 500):
+        """Streams the menus between two dates (both included) in date order. Every batch is a
+        separate query that carries on after the last menu of the one before, through the
+        (menu_date, id) index, so the database is never locked for the whole export.
+
+        :param start_date: (optional) ISO 8601 date of the first menu.
+        :param end_date: (optional) ISO 8601 date of the last menu.
+        :param since: (optional) watermark; only menus written after it are returned.
+        :param until: (optional) watermark; menus written after it are left out.
+        :param batch_size: number of menus read at once.
+        :return: generator of menu documents.
+        """
+        params = (end_date or '\uffff', since or 0, until if until is not None else 2 ** 63 - 1)
+        last = (start_date or '', '')
+        first = True
+
+        while True:
+            # The first batch includes menus on start_date with any id.
+            rows = self.__query('stream',
+                                'SELECT menu_date, id, doc FROM menus WHERE (menu_date, id) {0} '
+                                '(?, ?) AND menu_date <= ? AND version > ? AND version <= ? '
+                                'ORDER BY menu_date, id LIMIT ?'.format('>=' if first else '>'),
+                                last + params + (batch_size,))
+
+            if not rows:
+                return
+
+            yield from self._decode([json.loads(doc) for _, _, doc in rows])
+
+            last = rows[-1][:2]
+            first = False
+
+    def menu_changes(self):
+        """Subscribes to changed menus on a separate connection. The subscription is in place once
+        this method returns.
+
+        :return: generator of (location number, menu date) tuples for every changed menu.
+        """
+        conn = self.__new_connection()
+        version = conn.execute('SELECT coalesce(max(version), 0) FROM menus').fetchone()[0]
+
+        return self.__changed_keys(conn, version)
+
+    def __changed_keys(self, conn, version: int):
+        """Polls the database for menus written after the given version.
+
+        :param conn: connection used for polling; closed when the generator is.
+        :param version: version of the last menus already seen.
+        :return: generator of (location number, menu date) tuples.
+        """
+        data_version = None
+
+        try:
+            while True:
+                # data_version changes whenever another connection commits.
+                current = conn.execute('PRAGMA data_version').fetchone()[0]
+
+                if current == data_version:
+                    time.sleep(self.poll_interval)
+                    continue
+
+                data_version = current
+                rows = conn.execute('SELECT location, menu_date, version FROM menus '
+                                    'WHERE version > ? ORDER BY version', (version,)).fetchall()
+
+                for location, menu_date, row_version in rows:
+                    version = max(version, row_version)
+                    yield (location, menu_date)
+        finally:
+            conn.close()
+
+    def disconnect(self):
+        """Closes the connection to the database.
+        """
+        self.conn.close()
@@ -0,0 +1,431 @@
+import time
+from time import perf_counter
+from uuid import uuid4
+from itertools import islice
+from ucrfood.catalog import ItemCatalog
+from ucrfood.menu_diff import MenuDiff
+from ucrfood.search import ItemIndex
+from ucrfood.metrics import metrics
+
+# Round trips to the database by operation, menus written and menu history records appended.
+db_seconds = metrics.histogram('ucrfood_db_seconds', 'Time spent on database round trips.')
+rows_written_total = metrics.counter('ucrfood_db_rows_written_total', 'Menus written.')
+history_written_total = metrics.counter('ucrfood_db_history_written_total',
+                                        'Menu history records written.')
+
+
+class Database:
+    """
+    Description: storage interface used by the crawler and the read service. Backends store menus
+    dictionary-encoded against the item catalog (see ucrfood.catalog), the history of changes to
+    every menu, the item search postings and the distributed work queue. Menus that are already
+    stored are updated in place with only the fields and meals that changed (see ucrfood.menu_diff).
+    Methods:
+    - from_config : connects to the backend described by a database configuration file.
+    - migrate : creates everything the backend needs to store data.
+    - menu_key : builds the primary key of a menu.
+    - add_menu_data, upsert_menus, update_menu_on_date : write menus.
+    - get_menu, get_menus, get_page_info_within_range : read menus.
+    - get_menu_history : reads what changed in menus.
+    - export_watermark, stream_menus : stream menus out for bulk exports.
+    - menu_changes : subscribes to changed menus.
+    - replace_item_postings, find_item_postings : maintain and query the item search index.
+    - enqueue_work, claim_work, renew_work, release_work, count_work : maintain the work queue.
+    - disconnect : closes the connection.
+    """
+    name = None
+
+    def __init__(self):
+        # Menus are stored with their text replaced by catalog IDs.
+        self.catalog = ItemCatalog()
+
+    @staticmethod
+    def from_config(db_conf) -> 'Database':
+        """Connects to the database described by a database configuration file. The backend is
+        chosen with Backend in the [STORAGE] section; files without it use RethinkDB.
+
+        :param db_conf: Config for db.ini.
+        :return: connected Database.
+        """
+        check_params = ['DBUsername', 'Host', 'Port', 'DBPassword']
+
+        if db_conf.config.has_section('STORAGE'):
+            check_params = ['Backend', 'Path'] + check_params
+
+        db_conf.construct_dict(check_params=check_params)
+        backend = (db_conf.get('STORAGE') or {}).get('backend') or 'rethinkdb'
+
+        # Backends are imported when used, so only the client library of the chosen one is loaded.
+        if backend == 'rethinkdb':
+            from ucrfood.db import RethinkDatabase
+
+            return RethinkDatabase(host=db_conf.get('CONNECTION').get('host'),
+                                   port=db_conf.get('CONNECTION').get('port'),
+                                   uname=db_conf.get('DB_INFO').get('dbusername'),
+                                   db_pass=db_conf.get('AUTH').get('dbpassword'))
+        elif backend == 'sqlite':
+            from ucrfood.sqlite_db import SQLiteDatabase
+
+            return SQLiteDatabase(path=db_conf.get('STORAGE').get('path') or 'ucrfood.sqlite3')
+
+        raise ValueError('Unknown storage backend: {0}.'.format(backend))
+
+    @staticmethod
+    def menu_key(location_num: str, menu_date: str) -> str:
+        """Builds the primary key of a menu. There is only ever one menu per location and date, so
+        writing the same menu twice replaces it instead of creating a duplicate.
+
+        :param location_num: location number of the dining hall.
+        :param menu_date: ISO 8601 date of the menu.
+        :return: primary key for the menu document.
+        """
+        return '{0}_{1}'.format(location_num, menu_date)
+
+    def _with_key(self, menu: dict) -> dict:
+        """Returns a copy of the menu with its primary key set.
+
+        :param menu: menu to set the key on.
+        :return: menu with 'id' field.
+        """
+        key = self.menu_key(menu.get('location').get('num'),
+                            menu.get('time_info').get('menu_date'))
+        return dict(menu, id=key)
+
+    @staticmethod
+    def _timed(operation: str, start: float):
+        """Records how long a round trip took.
+
+        :param operation: name of the operation, used as metric label.
+        :param start: perf_counter value from when the round trip started.
+        """
+        db_seconds.observe(perf_counter() - start, operation=operation)
+
+    def _catalog_ids(self, texts: set) -> list:
+        """Returns the catalog entries of the given texts, giving texts that are not in the catalog
+        yet a new ID.
+
+        :param texts: meal, section and item names.
+        :return: list of {'id', 'text'} dicts.
+        """
+        raise NotImplementedError
+
+    def _catalog_texts(self, ids: set) -> list:
+        """Returns the catalog entries with the given IDs.
+
+        :param ids: catalog IDs.
+        :return: list of {'id', 'text'} dicts.
+        """
+        raise NotImplementedError
+
+    def _encode(self, menus: list) -> list:
+        """Returns copies of the menus with their text replaced by catalog IDs. Catalog entries
+        that are new are written first, so stored menus can always be decoded.
+
+        :param menus: menus as created by FoodSort.
+        :return: encoded menus.
+        """
+        missing = set()
+
+        for menu in menus:
+            missing.update(self.catalog.missing_texts(menu.get('menus')))
+
+        if missing:
+            self.catalog.learn(self._catalog_ids(missing))
+
+        return [dict(m, menus=self.catalog.encode(m.get('menus')), encoding=self.catalog.name)
+                for m in menus]
+
+    def _decode(self, menus: list) -> list:
+        """Replaces the catalog IDs of stored menus with their text, loading the catalog entries
+        that are not known yet in one round trip. Menus written before the catalog existed are
+        returned as they are.
+
+        :param menus: stored menu documents.
+        :return: menus as created by FoodSort.
+        """
+        encoded = [m for m in menus if m and m.get('encoding') == self.catalog.name]
+        unknown = set()
+
+        for menu in encoded:
+            unknown.update(self.catalog.unknown_ids(menu.get('menus')))
+
+        if unknown:
+            self.catalog.learn(self._catalog_texts(unknown))
+
+        for menu in encoded:
+            menu['menus'] = self.catalog.decode(menu.get('menus'))
+            del menu['encoding']
+
+        return menus
+
+    def _deltas(self, menus: list, stored: dict) -> tuple:
+        """Works out how to write crawled menus, given the versions already stored. Menus that are
+        not stored yet (or were stored before the catalog existed) are written whole. Stored menus
+        only get the top level fields and the meals that changed; if meals were added, removed or
+        reordered, the whole list of meals is rewritten. Every menu whose items changed gets a
+        history record.
+
+        :param menus: menus as created by FoodSort.
+        :param stored: stored menu documents (still encoded) by primary key.
+        :return: (inserts, updates, history) where inserts are encoded documents to write whole,
+        updates are (document, fields, patches) tuples with the whole encoded document, the fields
+        that changed and a list of (meal index, meal) patches, and history the menu history
+        documents to append.
+        """
+        encoded = [self._with_key(m) for m in self._encode(menus)]
+        old_docs = [stored.get(m.get('id')) for m in encoded]
+
+        # Decoded copies of the stored menus, for the history.
+        old_menus = {d.get('id'): d.get('menus')
+                     for d in self._decode([dict(d) for d in old_docs if d])}
+
+        changed_at = time.time()
+        inserts, updates, history = [], [], []
+
+        for menu, new, old in zip(menus, encoded, old_docs):
+            if old is None or old.get('encoding') != new.get('encoding'):
+                inserts.append(new)
+            else:
+                patches = MenuDiff.meal_patches(old.get('menus'), new.get('menus'))
+                fields = {k: v for k, v in new.items() if k != 'menus' and old.get(k) != v}
+
+                if patches is None:
+                    fields['menus'] = new.get('menus')
+                    patches = []
+
+                updates.append((new, fields, patches))
+
+            changes = MenuDiff.changes(old_menus.get(new.get('id')), menu.get('menus'))
+
+            if changes:
+                # Every record gets its own key, so a menu that changes back to an earlier
+                # version keeps both records.
+                history.append({'id': uuid4().hex,
+                                'menu_id': new.get('id'),
+                                'location': new.get('location').get('num'),
+                                'menu_date': new.get('time_info').get('menu_date'),
+                                'changed_at': changed_at,
+                                'changes': changes})
+
+        history_written_total.inc(len(history))
+
+        return inserts, updates, history
+
+    def migrate(self):
+        """Creates every table and index if they don't exist yet, then runs the data migrations
+        that haven't been run (see _migrate_data). Safe to run on every start; the rest of this
+        class assumes it has been run.
+        """
+        raise NotImplementedError
+
+    def _finished_migrations(self) -> set:
+        """Returns the names of the data migrations that have been run.
+
+        :return: set of names.
+        """
+        raise NotImplementedError
+
+    def _finish_migration(self, name: str):
+        """Records that a data migration has been run.
+
+        :param name: name of the migration.
+        """
+        raise NotImplementedError
+
+    def _migrate_data(self):
+        """Runs every one-time data migration that hasn't been run yet, in order. A migration
+        interrupted halfway is run again in full, so each must be safe to repeat.
+        """
+        migrations = [('backfill_menus', self.__backfill_menus)]
+        finished = self._finished_migrations()
+
+        for name, migration in migrations:
+            if name not in finished:
+                migration()
+                self._finish_migration(name)
+
+    def __backfill_menus(self, batch_size: int = 200):
+        """Rewrites menus stored before the catalog existed in encoded form, and indexes every
+        stored menu for search. Menus are only encoded and indexed when they are written, and
+        unchanged pages are never written again, so older menus would otherwise stay unencoded and
+        invisible to searches. Menus that are already encoded are not written again.
+
+        :param batch_size: number of menus read and written at once.
+        """
+        index = ItemIndex(self)
+        menus = self.stream_menus(batch_size=batch_size)
+
+        while True:
+            batch = list(islice(menus, batch_size))
+
+            if not batch:
+                break
+
+            self.upsert_menus(batch, chunk_size=batch_size)
+            index.update(batch)
+
+    def add_menu_data(self, menu: dict):
+        """Inserts or replaces a single menu.
+
+        :param menu: menu to write.
+        """
+        self.upsert_menus([menu])
+
+    def upsert_menus(self, menus: list, chunk_size: int = 200) -> int:
+        """Inserts new menus and updates stored ones with what changed (see _deltas), recording
+        the changes in the menu history. Uses a few round trips per chunk.
+
+        :param menus: menus to write.
+        :param chunk_size: maximum number of menus written at once.
+        :return: number of menus written.
+        """
+        raise NotImplementedError
+
+    def update_menu_on_date(self, date: str, menu: dict):
+        """Replace menu for specific date.
+
+        :param date: date to replace menu entry on.
+        :param menu: menu to replace with.
+        """
+        raise NotImplementedError
+
+    def get_menu_history(self, location_num: str, start_date: str, end_date: str) -> list:
+        """Returns the changes to the menus of a location between two dates (both included).
+
+        :param location_num: location number of the dining hall.
+        :param start_date: ISO 8601 date of the first menu.
+        :param end_date: ISO 8601 date of the last menu.
+        :return: list of history documents ({'menu_id', 'location', 'menu_date', 'changed_at',
+        'changes'}), by menu date and then in the order the changes were made.
+        """
+        raise NotImplementedError
+
+    def replace_item_postings(self, menu_ids: list, postings: list, chunk_size: int = 1000):
+        """Replaces every search index posting of the given menus.
+
+        :param menu_ids: primary keys of the menus whose postings are replaced.
+        :param postings: new postings for those menus.
+        :param chunk_size: maximum number of postings written at once.
+        """
+        raise NotImplementedError
+
+    def find_item_postings(self, token: str, prefix: bool = False, start_date: str = None,
+                           end_date: str = None) -> list:
+        """Returns the search index postings of a token.
+
+        :param token: normalized token to look up.
+        :param prefix: if true, return postings of every token starting with the given one.
+        :param start_date: (optional) ISO 8601 date of the earliest menu to include.
+        :param end_date: (optional) ISO 8601 date of the latest menu to include.
+        :return: list of postings.
+        """
+        raise NotImplementedError
+
+    def enqueue_work(self, items: list) -> int:
+        """Adds items to the work queue, ready to be claimed. Items that are already queued are
+        left as they are.
+
+        :param items: queue items with 'id' and 'url' fields.
+        :return: number of items added.
+        """
+        raise NotImplementedError
+
+    def claim_work(self, owner: str, lease_seconds: int, limit: int) -> list:
+        """Leases up to limit queue items whose lease has run out (or that were never leased).
+        Two workers racing for the same item never both get it, and every claim adds one to the
+        item's attempts.
+
+        :param owner: id of the claiming worker.
+        :param lease_seconds: length of the lease.
+        :param limit: maximum number of items to claim.
+        :return: list of claimed items.
+        """
+        raise NotImplementedError
+
+    def renew_work(self, owner: str, ids: list, lease_seconds: int):
+        """Extends the lease of queue items, unless another worker has claimed them since.
+
+        :param owner: id of the worker holding the lease.
+        :param ids: ids of the leased items.
+        :param lease_seconds: length of the new lease, from now.
+        """
+        raise NotImplementedError
+
+    def release_work(self, owner: str, ids: list):
+        """Removes finished items from the work queue, unless another worker has claimed them
+        since.
+
+        :param owner: id of the worker holding the lease.
+        :param ids: ids of the leased items.
+        """
+        raise NotImplementedError
+
+    def count_work(self) -> int:
+        """Returns the number of items in the work queue.
+
+        :return: number of items.
+        """
+        raise NotImplementedError
+
+    def get_page_info_within_range(self, day_delta: int) -> list:
+        """Returns the sum and url of every menu from the current date to n days from now.
+
+        :param day_delta: number of days from the current date to pull.
+        :return: list of {'sum', 'url'} dicts.
+        """
+        raise NotImplementedError
+
+    def get_menu(self, location_num: str, menu_date: str) -> dict:
+        """Returns the menu of a location on a given date.
+
+        :param location_num: location number of the dining hall.
+        :param menu_date: ISO 8601 date of the menu.
+        :return: menu document, or None if there is none.
+        """
+        raise NotImplementedError
+
+    def get_menus(self, location_num: str, start_date: str, end_date: str) -> list:
+        """Returns the menus of a location between two dates (both included), in date order.
+
+        :param location_num: location number of the dining hall.
+        :param start_date: ISO 8601 date of the first menu.
+        :param end_date: ISO 8601 date of the last menu.
+        :return: list of menu documents.
+        """
+        raise NotImplementedError
+
+    def export_watermark(self):
+        """Returns a mark of every menu written so far. Menus written after this call compare
+        newer than it, so an export up to this watermark can be continued from it later.
+
+        :return: watermark (a number).
+        """
+        raise NotImplementedError
+
+    def stream_menus(self, start_date: str = None, end_date: str = None, since=None, until=None,
+                     batch_size: int = 500):
+        """Streams the menus between two dates (both included) in date order, a batch at a time,
+        so exports of any size run in constant memory.
+
+        :param start_date: (optional) ISO 8601 date of the first menu.
+        :param end_date: (optional) ISO 8601 date of the last menu.
+        :param since: (optional) watermark of an earlier export; only menus written after it are
+        returned.
+        :param until: (optional) watermark; menus written after it are left out.
+        :param batch_size: number of menus read from the database at once.
+        :return: generator of menu documents.
+        """
+        raise NotImplementedError
+
+    def menu_changes(self):
+        """Subscribes to changed menus on a separate connection. The subscription is in place once
+        this method returns.
+
+        :return: generator of (location number, menu date) tuples for every changed menu.
+        """
+        raise NotImplementedError
+
+    def disconnect(self):
+        """Closes the connection to the database.
+        """
+        raise NotImplementedError
@@ -0,0 +1,98 @@
+import os
+import socket
+from hashlib import md5
+
+
+class WorkQueue:
+    """
+    Description: queue of urls to crawl shared by any number of worker processes through the
+    'work_queue' table. Workers claim urls with a lease that runs out after a while, renew it while
+    they are still crawling and release the urls once their menus are written. Urls whose lease
+    ran out (e.g. because their worker crashed) are claimed again by another worker. On RethinkDB,
+    lease times are taken from the database server's clock, so workers on different hosts agree on
+    them. SQLite has no server, so lease times come from each worker's own clock; workers sharing a
+    database file normally run on the same machine, and otherwise need their clocks in sync. Every
+    claim counts as an attempt, and urls that keep failing are dropped after max_attempts.
+    Methods:
+    - enqueue : adds urls to the queue.
+    - claim : leases the next batch of urls.
+    - renew : extends the lease of claimed urls.
+    - release : removes finished urls from the queue.
+    - exhausted : returns the claimed urls that ran out of attempts.
+    - remaining : returns the number of urls in the queue.
+    """
+    def __init__(self, database, worker_id: str = None, lease_seconds: int = 120,
+                 batch_size: int = 50, max_attempts: int = 5):
+        """
+        :param database: Database holding the 'work_queue' table. Its connection should not be
+        shared with other threads.
+        :param worker_id: (optional) name of this worker. Defaults to host name and process id.
+        :param lease_seconds: how long claimed urls stay leased without being renewed.
+        :param batch_size: maximum number of urls claimed at once.
+        :param max_attempts: number of times a url is claimed before it is given up on if it
+        keeps failing.
+        """
+        self.database = database
+        self.worker_id = worker_id or '{0}-{1}'.format(socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+
+    @staticmethod
+    def item_key(url: str) -> str:
+        """Returns the primary key of a url in the queue. Urls can be longer than RethinkDB allows
+        primary keys to be, so they are hashed.
+
+        :param url: url to crawl.
+        :return: md5sum of the url.
+        """
+        return md5(url.encode('utf-8')).hexdigest()
+
+    def enqueue(self, block_urls: list) -> int:
+        """Adds urls to the queue. Urls already in it keep their place and lease, so the same urls
+        can be enqueued again without being crawled twice.
+
+        :param block_urls: list of (url, day) tuples, as generated by FoodService.
+        :return: number of urls added.
+        """
+        items = [{'id': self.item_key(u), 'url': u, 'day': d} for u, d in block_urls]
+        return self.database.enqueue_work(items)
+
+    def claim(self) -> list:
+        """Leases the next batch of urls that are not leased by another worker.
+
+        :return: list of claimed queue items ({'id', 'url', 'day', 'attempts', ...}), where
+        attempts includes this claim.
+        """
+        return self.database.claim_work(self.worker_id, self.lease_seconds, self.batch_size)
+
+    def renew(self, items: list):
+        """Extends the lease of urls claimed by this worker.
+
+        :param items: queue items returned by claim.
+        """
+        self.database.renew_work(self.worker_id, [i.get('id') for i in items], self.lease_seconds)
+
+    def release(self, items: list):
+        """Removes urls claimed by this worker from the queue once they are done.
+
+        :param items: queue items returned by claim.
+        """
+        self.database.release_work(self.worker_id, [i.get('id') for i in items])
+
+    def exhausted(self, items: list) -> list:
+        """Returns the claimed urls that have been claimed max_attempts times. If they failed
+        again, they should be released instead of being left for another attempt; enqueuing them
+        again later gives them a fresh set of attempts.
+
+        :param items: queue items returned by claim.
+        :return: queue items out of attempts.
+        """
+        return [i for i in items if (i.get('attempts') or 0) >= self.max_attempts]
+
+    def remaining(self) -> int:
+        """Returns the number of urls waiting or being crawled.
+
+        :return: number of queue items.
+        """
+        return self.database.count_work()